@@ -0,0 +1,100 @@
+"""Gzip files made of independent blocks that can be found without decompressing.
+
+Each block is a complete gzip member whose header has an extra field (like
+BGZF) that records the size of the member and the number of lines in it. Any
+gzip reader can read these files as normal, but we can also walk the headers to
+find where every block starts and jump to one without decompressing the blocks
+before it.
+"""
+
+import dataclasses
+import struct
+import zlib
+from typing import BinaryIO, Iterator, List, Optional
+
+# ID1, ID2, CM (deflate), FLG (FEXTRA), MTIME, XFL, OS (unknown), XLEN
+HEADER = struct.Struct("<BBBBIBBH")
+# SI1, SI2, LEN, member size, lines
+EXTRA = struct.Struct("<BBHII")
+# CRC32, ISIZE
+TRAILER = struct.Struct("<II")
+SUBFIELD_ID = (ord("C"), ord("P"))
+FEXTRA = 0x04
+
+
+@dataclasses.dataclass
+class Block:
+    """Where a block lives in a blocked gzip file."""
+
+    offset: int
+    compressed_size: int
+    lines: int
+
+
+def compress_block(data: bytes, lines: int, compresslevel: int = 9) -> bytes:
+    """Compress `data`, which has `lines` lines, into a single gzip member.
+
+    zlib releases the GIL while compressing, so these can run in parallel on
+    threads.
+    """
+    compressor = zlib.compressobj(compresslevel, zlib.DEFLATED, -zlib.MAX_WBITS)
+    deflated = compressor.compress(data) + compressor.flush()
+    size = HEADER.size + EXTRA.size + len(deflated) + TRAILER.size
+    return b"".join(
+        (
+            HEADER.pack(0x1F, 0x8B, 8, FEXTRA, 0, 0, 255, EXTRA.size),
+            EXTRA.pack(*SUBFIELD_ID, EXTRA.size - 4, size, lines),
+            deflated,
+            TRAILER.pack(zlib.crc32(data), len(data) & 0xFFFFFFFF),
+        )
+    )
+
+
+def read_blocks(f: BinaryIO) -> List[Block]:
+    """Find the blocks in a blocked gzip file by reading only the headers.
+
+    Raises a ValueError if the file isn't made of our blocks, e.g. a gzip file
+    that is one big member.
+    """
+    blocks = []
+    offset = 0
+    f.seek(0)
+    while header := f.read(HEADER.size + EXTRA.size):
+        if len(header) < HEADER.size + EXTRA.size:
+            raise ValueError(f"Truncated gzip header at {offset}.")
+        id1, id2, _, flags, _, _, _, xlen = HEADER.unpack_from(header)
+        si1, si2, _, size, lines = EXTRA.unpack_from(header, HEADER.size)
+        if (id1, id2) != (0x1F, 0x8B) or not flags & FEXTRA:
+            raise ValueError(f"No gzip member with an extra field at {offset}.")
+        if xlen != EXTRA.size or (si1, si2) != SUBFIELD_ID:
+            raise ValueError(f"Gzip member at {offset} isn't a block.")
+        blocks.append(Block(offset, size, lines))
+        offset += size
+        f.seek(offset)
+    return blocks
+
+
+def is_blocked(f: BinaryIO) -> bool:
+    """Does the gzip file `f` start with one of our blocks, only reads the header."""
+    f.seek(0)
+    header = f.read(HEADER.size + EXTRA.size)
+    if len(header) < HEADER.size + EXTRA.size:
+        return False
+    id1, id2, _, flags, _, _, _, xlen = HEADER.unpack_from(header)
+    si1, si2 = EXTRA.unpack_from(header, HEADER.size)[:2]
+    return (
+        (id1, id2) == (0x1F, 0x8B)
+        and bool(flags & FEXTRA)
+        and xlen == EXTRA.size
+        and (si1, si2) == SUBFIELD_ID
+    )
+
+
+def read_block_data(
+    f: BinaryIO, blocks: List[Block], start: int = 0, stop: Optional[int] = None
+) -> Iterator[bytes]:
+    """Decompress blocks [start, stop) without touching the ones before them."""
+    for block in blocks[start:stop]:
+        f.seek(block.offset)
+        # wbits=31 expects (and skips) a gzip header.
+        yield zlib.decompress(f.read(block.compressed_size), wbits=31)
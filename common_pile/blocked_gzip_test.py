@@ -0,0 +1,53 @@
+"""Tests for gzip files made of independent blocks."""
+
+import gzip
+import io
+
+import pytest
+
+from common_pile import blocked_gzip
+
+
+def make_blocks(n=5, lines=10):
+    chunks = [
+        "".join(f"block {b} line {i}\n" for i in range(lines)).encode("utf-8")
+        for b in range(n)
+    ]
+    data = b"".join(blocked_gzip.compress_block(c, lines) for c in chunks)
+    return chunks, data
+
+
+def test_blocks_are_valid_gzip():
+    chunks, data = make_blocks()
+    assert gzip.decompress(data) == b"".join(chunks)
+
+
+def test_read_blocks_finds_every_block():
+    chunks, data = make_blocks()
+    f = io.BytesIO(data)
+    blocks = blocked_gzip.read_blocks(f)
+    assert len(blocks) == len(chunks)
+    assert blocks[0].offset == 0
+    assert sum(b.compressed_size for b in blocks) == len(data)
+    assert all(b.lines == 10 for b in blocks)
+    for a, b in zip(blocks, blocks[1:]):
+        assert b.offset == a.offset + a.compressed_size
+
+
+def test_read_block_data_seeks_to_a_range():
+    chunks, data = make_blocks()
+    f = io.BytesIO(data)
+    blocks = blocked_gzip.read_blocks(f)
+    assert list(blocked_gzip.read_block_data(f, blocks, 2, 4)) == chunks[2:4]
+    assert list(blocked_gzip.read_block_data(f, blocks, 3)) == chunks[3:]
+    # A block can be read without the ones before it.
+    block = blocks[4]
+    assert gzip.decompress(data[block.offset :]) == chunks[4]
+
+
+def test_plain_gzip_is_not_blocked():
+    data = gzip.compress(b"one big member\n")
+    assert not blocked_gzip.is_blocked(io.BytesIO(data))
+    assert blocked_gzip.is_blocked(io.BytesIO(make_blocks()[1]))
+    with pytest.raises(ValueError):
+        blocked_gzip.read_blocks(io.BytesIO(data))
@@ -0,0 +1,131 @@
+"""A single json codec for reading/writing dolma, uses orjson or msgspec if installed.
+
+The backend can be forced with the `COMMON_PILE_JSON` environment variable
+(`orjson`, `msgspec`, or `json`), otherwise the fastest available one is used.
+
+Every backend writes the same bytes, so shards don't depend on which packages
+are installed: non-ascii characters are written as utf-8 instead of escaped,
+there are no spaces after separators, and datetimes are in isoformat (UTC is
+`+00:00`). Strings with lone surrogates can't be utf-8, so documents that have
+them are written with everything escaped. The exception is floats, the stdlib
+writes them with `repr`, e.g. `1e+20` instead of `1e20`.
+"""
+
+import datetime
+import json
+import os
+import re
+
+__all__ = ["BACKEND", "JSONDecodeError", "dumps", "loads", "serialize_datetime"]
+
+
+_SURROGATE = re.compile("[\ud800-\udfff]")
+
+
+def serialize_datetime(obj):
+    """Convert datetime.datetime to ISO format string for JSON serialization.
+
+    Dates and times are converted too, like orjson and msgspec do.
+    """
+    if isinstance(obj, (datetime.date, datetime.time)):
+        return obj.isoformat()
+    else:
+        raise ValueError(f"Object of type {type(obj)} is not serializable.")
+
+
+def _stdlib_dumps(obj, default=serialize_datetime) -> str:
+    # Written like the fast backends, utf-8 without spaces.
+    s = json.dumps(obj, default=default, ensure_ascii=False, separators=(",", ":"))
+    if _SURROGATE.search(s):
+        # Lone surrogates can't be encoded as utf-8, so escape them.
+        s = json.dumps(obj, default=default, separators=(",", ":"))
+    return s
+
+
+def _select_backend() -> str:
+    requested = os.environ.get("COMMON_PILE_JSON")
+    backends = (requested,) if requested else ("orjson", "msgspec")
+    for backend in backends:
+        if backend in ("json", "stdlib"):
+            return "json"
+        try:
+            __import__(backend)
+            return backend
+        except ImportError:
+            if requested:
+                raise
+    return "json"
+
+
+BACKEND = _select_backend()
+
+if BACKEND == "orjson":
+    import orjson
+
+    JSONDecodeError = orjson.JSONDecodeError
+    # orjson rejects dicts with int keys by default, json converts them to str.
+    _ORJSON_OPTIONS = orjson.OPT_NON_STR_KEYS
+
+    def dumps(obj, default=serialize_datetime) -> str:
+        """Serialize `obj` to a json string, `default` handles unknown types."""
+        try:
+            return orjson.dumps(obj, default=default, option=_ORJSON_OPTIONS).decode(
+                "utf-8"
+            )
+        except TypeError:
+            # orjson is stricter, e.g. it doesn't support ints larger than 64
+            # bits or lone surrogates, let the stdlib have a go.
+            return _stdlib_dumps(obj, default=default)
+
+    loads = orjson.loads
+
+elif BACKEND == "msgspec":
+    import msgspec
+
+    # msgspec's error isn't a subclass of json.JSONDecodeError, catching this
+    # tuple catches both.
+    JSONDecodeError = (json.JSONDecodeError, msgspec.DecodeError)
+    _decoder = msgspec.json.Decoder()
+    _encoder = msgspec.json.Encoder(enc_hook=serialize_datetime)
+
+    def _isoformat_datetimes(obj):
+        """`obj` with its datetimes and times replaced by their isoformat."""
+        if isinstance(obj, (datetime.datetime, datetime.time)):
+            return obj.isoformat()
+        if isinstance(obj, dict):
+            return {k: _isoformat_datetimes(v) for k, v in obj.items()}
+        if isinstance(obj, (list, tuple, set, frozenset)):
+            return [_isoformat_datetimes(v) for v in obj]
+        return obj
+
+    def dumps(obj, default=serialize_datetime) -> str:
+        """Serialize `obj` to a json string, `default` handles unknown types."""
+        encoder = (
+            _encoder
+            if default is serialize_datetime
+            else msgspec.json.Encoder(enc_hook=default)
+        )
+        try:
+            s = encoder.encode(obj).decode("utf-8")
+            # msgspec writes UTC datetimes with a `Z` and always handles them
+            # itself. Only documents that could have one pay for converting
+            # them to isoformat first.
+            if 'Z"' in s:
+                s = encoder.encode(_isoformat_datetimes(obj)).decode("utf-8")
+            return s
+        except (TypeError, UnicodeEncodeError, msgspec.EncodeError):
+            # i.e. lone surrogates or ints larger than 64 bits.
+            return _stdlib_dumps(obj, default=default)
+
+    def loads(s):
+        """Parse a json string (or bytes) into python objects."""
+        return _decoder.decode(s)
+
+else:
+    JSONDecodeError = json.JSONDecodeError
+
+    def dumps(obj, default=serialize_datetime) -> str:
+        """Serialize `obj` to a json string, `default` handles unknown types."""
+        return _stdlib_dumps(obj, default=default)
+
+    loads = json.loads
@@ -0,0 +1,67 @@
+"""Tests that every json backend writes the same bytes."""
+
+import datetime
+import importlib.util
+
+import pytest
+
+from common_pile import codec
+
+DOCUMENTS = [
+    {"id": "1", "text": "plain ascii", "metadata": {"authors": [["a", ""]]}},
+    {"id": 2, "text": "café, 日本語, and emoji 🙂", "score": 1.5, "ok": True},
+    {"text": 'escapes " \\ \n \t \x01 \x7f </script>', "none": None},
+    {"metadata": {1: "int keys", "nested": [[1, 2], (3, 4)]}},
+    {
+        "created": datetime.datetime(2020, 1, 1, tzinfo=datetime.timezone.utc),
+        "added": datetime.datetime(2021, 2, 3, 4, 5, 6, 789),
+        "offset": datetime.datetime(
+            2022, 1, 1, tzinfo=datetime.timezone(datetime.timedelta(hours=-5))
+        ),
+        "date": datetime.date(2020, 1, 1),
+        "time": datetime.time(12, 30, tzinfo=datetime.timezone.utc),
+    },
+    {"text": "a lone surrogate \ud800 and café"},
+    {"big": 2**70},
+    {"text": "ends with a Z", "id": "Z"},
+]
+
+
+def load_codec(backend, monkeypatch):
+    """A fresh copy of `codec` using `backend`."""
+    monkeypatch.setenv("COMMON_PILE_JSON", backend)
+    spec = importlib.util.spec_from_file_location(f"codec_{backend}", codec.__file__)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    assert module.BACKEND == backend
+    return module
+
+
+@pytest.mark.parametrize("backend", ["orjson", "msgspec"])
+def test_backends_write_the_same_bytes(backend, monkeypatch):
+    pytest.importorskip(backend)
+    stdlib = load_codec("json", monkeypatch)
+    fast = load_codec(backend, monkeypatch)
+    for document in DOCUMENTS:
+        assert fast.dumps(document) == stdlib.dumps(document)
+
+
+def test_stdlib_output():
+    stdlib_dumps = codec._stdlib_dumps
+    assert stdlib_dumps({"a": [1, "é"]}) == '{"a":[1,"é"]}'
+    assert (
+        stdlib_dumps({"t": datetime.datetime(2020, 1, 1, tzinfo=datetime.timezone.utc)})
+        == '{"t":"2020-01-01T00:00:00+00:00"}'
+    )
+    assert stdlib_dumps({"a": "é\ud800"}) == '{"a":"\\u00e9\\ud800"}'
+
+
+@pytest.mark.parametrize("backend", ["json", "orjson", "msgspec"])
+def test_backends_round_trip(backend, monkeypatch):
+    if backend != "json":
+        pytest.importorskip(backend)
+    module = load_codec(backend, monkeypatch)
+    document = {"id": "1", "text": "café", "metadata": {"n": [1, 2.5, None]}}
+    assert module.loads(module.dumps(document)) == document
+    with pytest.raises(module.JSONDecodeError):
+        module.loads('{"id": ')
@@ -0,0 +1,381 @@
+"""Line up the documents in two versions of a dolma dataset by id.
+
+Both versions are read through their `.idx` sidecar indices (see
+`common_pile.index`), built if they are missing, so only the id hashes are held
+in memory and documents are read one at a time when they are needed.
+
+`AlignedDatasets` is for looking at documents one by one, `diff_datasets`
+summarizes what changed across all of them in parallel.
+"""
+
+import collections
+import html
+import multiprocessing as mp
+import re
+from functools import partial
+from typing import Dict, Optional, Sequence, Tuple
+
+import numpy as np
+import tqdm
+
+from common_pile import codec, index, parallel
+from common_pile.logs import get_logger
+from common_pile.sketches import LogHistogram, QuantileSketch
+
+QUANTILES = (0.01, 0.1, 0.5, 0.9, 0.99)
+# Changed lines are grouped by pattern, longer lines are cut to this length.
+MAX_PATTERN = 120
+
+
+def _in_sorted(sorted_hashes: np.ndarray, hashes: np.ndarray) -> np.ndarray:
+    """A mask of which `hashes` are in `sorted_hashes`."""
+    if not len(sorted_hashes):
+        return np.zeros(len(hashes), dtype=bool)
+    positions = np.searchsorted(sorted_hashes, hashes)
+    np.minimum(positions, len(sorted_hashes) - 1, out=positions)
+    return sorted_hashes[positions] == hashes
+
+
+class AlignedDatasets:
+    """The documents that are in both the `old` and `new` version of a dataset.
+
+    Documents are in the order of the old version, so paging through them is
+    like reading the old files line by line. Documents removed by the new
+    version are skipped.
+    """
+
+    def __init__(
+        self, old_paths: Sequence[str], new_paths: Sequence[str], build: bool = True
+    ):
+        self.old = index.IndexedDataset(sorted(old_paths), build=build)
+        self.new = index.IndexedDataset(sorted(new_paths), build=build)
+        new_hashes = self.new.id_hashes()
+        self._new_order = np.argsort(new_hashes, kind="stable")
+        self._new_sorted = new_hashes[self._new_order]
+        old_hashes = self.old.id_hashes()
+        # The position in the old dataset of each aligned document.
+        self.positions = np.flatnonzero(_in_sorted(self._new_sorted, old_hashes))
+        self._hashes = old_hashes[self.positions]
+        self._order = np.argsort(self._hashes, kind="stable")
+        self._sorted = self._hashes[self._order]
+
+    def __len__(self) -> int:
+        return len(self.positions)
+
+    def id(self, i: int):
+        """The id of the `i`th aligned document."""
+        return index.line_id(self.old.line(int(self.positions[i])))
+
+    def find(self, doc_id) -> Optional[int]:
+        """Where the document with `doc_id` is in the alignment, None if it isn't."""
+        h = np.uint64(index.id_hash(doc_id))
+        start = np.searchsorted(self._sorted, h, side="left")
+        stop = np.searchsorted(self._sorted, h, side="right")
+        # Check the ids themselves in case of a hash collision.
+        for i in sorted(int(i) for i in self._order[start:stop]):
+            if str(self.id(i)) == str(doc_id):
+                return i
+        return None
+
+    def new_position(self, i: int) -> int:
+        """The position in the new dataset of the `i`th aligned document."""
+        doc_id = str(self.id(i))
+        h = self._hashes[i]
+        start = np.searchsorted(self._new_sorted, h, side="left")
+        stop = np.searchsorted(self._new_sorted, h, side="right")
+        for position in sorted(int(p) for p in self._new_order[start:stop]):
+            if str(index.line_id(self.new.line(position))) == doc_id:
+                return position
+        # Only a hash collision with a document that was removed gets here.
+        raise KeyError(f"Document {doc_id} is not in the new dataset.")
+
+    def __getitem__(self, i: int) -> Tuple[dict, dict]:
+        """The (old, new) versions of the `i`th aligned document."""
+        return self.old[int(self.positions[i])], self.new[self.new_position(i)]
+
+    def sample(self, rng: Optional[np.random.Generator] = None) -> int:
+        """A random position in the alignment."""
+        rng = np.random.default_rng() if rng is None else rng
+        return int(rng.integers(len(self)))
+
+    def close(self):
+        self.old.close()
+        self.new.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def line_pattern(line: str) -> str:
+    """Group similar lines, numbers become 0 and runs of whitespace a space."""
+    return re.sub(r"\d+", "0", " ".join(line.split()))[:MAX_PATTERN]
+
+
+def _line_patterns(text: str) -> collections.Counter:
+    return collections.Counter(
+        line_pattern(line) for line in text.split("\n") if line.strip()
+    )
+
+
+class DiffStats:
+    """What changed between the aligned documents of two datasets, mergeable.
+
+    The length changes are kept in sketches. Changed line patterns are counted
+    exactly until there are more than `max_patterns`, then only the most
+    common half is kept, so the top patterns are approximate.
+    """
+
+    def __init__(self, max_patterns: int = 100_000):
+        self.max_patterns = max_patterns
+        self.aligned = 0
+        self.changed = 0
+        # Documents only in the old, or only in the new, dataset.
+        self.dropped = 0
+        self.added = 0
+        # How much longer or shorter, in characters, changed documents got.
+        self.grown = LogHistogram()
+        self.shrunk = LogHistogram()
+        # New length / old length for changed documents.
+        self.length_ratio = QuantileSketch()
+        self.removed_lines = collections.Counter()
+        self.added_lines = collections.Counter()
+
+    def _prune(self, counter: collections.Counter):
+        if len(counter) > self.max_patterns:
+            kept = counter.most_common(self.max_patterns // 2)
+            counter.clear()
+            counter.update(dict(kept))
+
+    def add(self, old_texts: Sequence[str], new_texts: Sequence[str]):
+        """Add the old and new versions of some aligned documents."""
+        changed = np.array([o != n for o, n in zip(old_texts, new_texts)], dtype=bool)
+        self.aligned += len(changed)
+        self.changed += int(changed.sum())
+        old_lengths = np.array([len(t) for t in old_texts], dtype=np.int64)[changed]
+        new_lengths = np.array([len(t) for t in new_texts], dtype=np.int64)[changed]
+        deltas = new_lengths - old_lengths
+        self.grown.add(deltas[deltas > 0])
+        self.shrunk.add(-deltas[deltas < 0])
+        self.length_ratio.add(new_lengths / np.maximum(old_lengths, 1))
+        for i in np.flatnonzero(changed):
+            old, new = _line_patterns(old_texts[i]), _line_patterns(new_texts[i])
+            self.removed_lines.update(old - new)
+            self.added_lines.update(new - old)
+        self._prune(self.removed_lines)
+        self._prune(self.added_lines)
+
+    def merge(self, other: "DiffStats"):
+        self.aligned += other.aligned
+        self.changed += other.changed
+        self.dropped += other.dropped
+        self.added += other.added
+        self.grown.merge(other.grown)
+        self.shrunk.merge(other.shrunk)
+        self.length_ratio.merge(other.length_ratio)
+        self.removed_lines.update(other.removed_lines)
+        self.added_lines.update(other.added_lines)
+        self._prune(self.removed_lines)
+        self._prune(self.added_lines)
+
+    def summary(self, top: int = 50) -> Dict:
+        old_documents = self.aligned + self.dropped
+        new_documents = self.aligned + self.added
+        return {
+            "old_documents": old_documents,
+            "new_documents": new_documents,
+            "aligned": self.aligned,
+            "changed": self.changed,
+            "dropped": self.dropped,
+            "added": self.added,
+            "changed_share": self.changed / max(self.aligned, 1),
+            "dropped_share": self.dropped / max(old_documents, 1),
+            "added_share": self.added / max(new_documents, 1),
+            "length_ratio": {
+                f"p{round(q * 100)}": self.length_ratio.quantile(q) for q in QUANTILES
+            },
+            "length_delta": {
+                "grown": list(self.grown.buckets()),
+                "shrunk": list(self.shrunk.buckets()),
+            },
+            "removed_lines": self.removed_lines.most_common(top),
+            "added_lines": self.added_lines.most_common(top),
+        }
+
+
+def ensure_index(path: str) -> str:
+    if not index.has_index(path):
+        index.build_index(path)
+    return path
+
+
+_DATASETS: Dict[Tuple[str, ...], index.IndexedDataset] = {}
+
+
+def _open_dataset(paths: Sequence[str]) -> index.IndexedDataset:
+    """Open (once per process) the dataset made of `paths`."""
+    paths = tuple(paths)
+    if paths not in _DATASETS:
+        _DATASETS[paths] = index.IndexedDataset(paths, build=False)
+    return _DATASETS[paths]
+
+
+def diff_shard(task, new_paths: Sequence[str], chunk_size: int = 10_000) -> DiffStats:
+    """Diff an old shard against the new dataset.
+
+    `task` is the old shard's path and, for each of its documents, its position
+    in the new dataset or -1 when it was dropped. Documents are read a chunk at
+    a time, in order from the old shard and sorted by position from the new
+    one, so each block is decompressed about once when the order is the same.
+    """
+    path, new_positions = task
+    stats = DiffStats()
+    new = _open_dataset(new_paths)
+    with index.IndexedShard(path, build=False) as old:
+        aligned = np.flatnonzero(new_positions >= 0)
+        stats.dropped += len(new_positions) - len(aligned)
+        for start in range(0, len(aligned), chunk_size):
+            positions = aligned[start : start + chunk_size]
+            olds = [codec.loads(old.line(int(p))) for p in positions]
+            news = [None] * len(positions)
+            targets = new_positions[positions]
+            for j in np.argsort(targets, kind="stable"):
+                news[j] = codec.loads(new.line(int(targets[j])))
+            # A hash collision between different ids counts as a dropped document.
+            pairs = [(o, n) for o, n in zip(olds, news) if o["id"] == n["id"]]
+            stats.dropped += len(positions) - len(pairs)
+            stats.add(
+                [o.get("text") or "" for o, _ in pairs],
+                [n.get("text") or "" for _, n in pairs],
+            )
+    return stats
+
+
+def diff_datasets(
+    old_paths: Sequence[str],
+    new_paths: Sequence[str],
+    processes: Optional[int] = None,
+    chunk_size: int = 10_000,
+) -> DiffStats:
+    """Compare every document in the old and new datasets, joined by id.
+
+    Shards without an index are indexed first, ordinary (not blocked) gzip
+    shards included. Each old shard is diffed
+    against the new dataset in a worker process, the main process only holds
+    the id hashes of the new dataset and the positions for one shard at a time.
+    """
+    logger = get_logger()
+    old_paths, new_paths = sorted(old_paths), sorted(new_paths)
+    with mp.get_context("spawn").Pool(processes) as pool:
+        for _ in tqdm.tqdm(
+            pool.imap_unordered(ensure_index, old_paths + new_paths),
+            total=len(old_paths) + len(new_paths),
+            desc="indexing",
+        ):
+            pass
+        new_hashes = np.concatenate(
+            [np.empty(0, dtype=np.uint64)]
+            + [index.load_index(p)["id_hash"] for p in new_paths]
+        )
+        new_order = np.argsort(new_hashes, kind="stable")
+        new_sorted = new_hashes[new_order]
+        del new_hashes
+        old_sorted = []
+
+        def tasks():
+            for path in old_paths:
+                hashes = np.asarray(index.load_index(path)["id_hash"])
+                old_sorted.append(np.sort(hashes))
+                found = _in_sorted(new_sorted, hashes)
+                new_positions = np.full(len(hashes), -1, dtype=np.int64)
+                new_positions[found] = new_order[
+                    np.searchsorted(new_sorted, hashes[found])
+                ]
+                yield path, new_positions
+
+        stats = DiffStats()
+        logger.info("Diffing %d old shards against %d", len(old_paths), len(new_paths))
+        for shard_stats in tqdm.tqdm(
+            parallel.bounded_imap(
+                partial(diff_shard, new_paths=new_paths, chunk_size=chunk_size),
+                tasks(),
+                pool=pool,
+                ordered=False,
+            ),
+            total=len(old_paths),
+            desc="shards",
+        ):
+            stats.merge(shard_stats)
+    old_sorted = np.sort(np.concatenate([np.empty(0, dtype=np.uint64)] + old_sorted))
+    stats.added = int((~_in_sorted(old_sorted, new_sorted)).sum())
+    return stats
+
+
+def _html_row(tag: str, row: Sequence) -> str:
+    return "".join(f"<{tag}>{html.escape(str(cell))}</{tag}>" for cell in row)
+
+
+def _html_table(header: Sequence[str], rows: Sequence[Sequence]) -> str:
+    lines = [f"<tr>{_html_row('th', header)}</tr>"]
+    lines.extend(f"<tr>{_html_row('td', row)}</tr>" for row in rows)
+    return "<table>\n{}\n</table>".format("\n".join(lines))
+
+
+def summary_html(summary: Dict, title: str = "Dataset diff") -> str:
+    """A standalone html page for the output of `DiffStats.summary`."""
+    counts = [
+        (name, summary[name], f"{summary[share]:.2%}" if share else "")
+        for name, share in (
+            ("old_documents", None),
+            ("new_documents", None),
+            ("aligned", None),
+            ("changed", "changed_share"),
+            ("dropped", "dropped_share"),
+            ("added", "added_share"),
+        )
+    ]
+    sections = [
+        ("Documents", _html_table(("", "count", "share"), counts)),
+        (
+            "Length ratio of changed documents (new / old)",
+            _html_table(("quantile", "ratio"), summary["length_ratio"].items()),
+        ),
+    ]
+    for name in ("grown", "shrunk"):
+        sections.append(
+            (
+                f"Characters {name} by, for changed documents",
+                _html_table(
+                    ("from", "to (exclusive)", "documents"),
+                    summary["length_delta"][name],
+                ),
+            )
+        )
+    for name in ("removed_lines", "added_lines"):
+        sections.append(
+            (
+                name.replace("_", " ").capitalize(),
+                _html_table(("pattern", "count"), summary[name]),
+            )
+        )
+    body = "\n".join(f"<h2>{html.escape(h)}</h2>\n{t}" for h, t in sections)
+    return f"""<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>{html.escape(title)}</title>
+<style>
+body {{ font-family: sans-serif; }}
+table {{ border-collapse: collapse; }}
+td, th {{ border: 1px solid #ccc; padding: 2px 8px; text-align: left; }}
+td {{ font-family: monospace; white-space: pre-wrap; }}
+</style>
+</head>
+<body>
+<h1>{html.escape(title)}</h1>
+{body}
+</body>
+</html>
+"""
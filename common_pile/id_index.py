@@ -0,0 +1,209 @@
+"""A sorted, on-disk index of document ids and the shard each one is in.
+
+Holding every id of a large dataset in a python dict or set takes tens of GB.
+Here ids are hashed to a fixed width 64-bit value (see `index.id_hash`) and
+saved, sorted, as NumPy arrays in a directory:
+
+  ids.npy: The sorted id hashes.
+  shards.npy: The shard each id is in, a position in `shards.json`.
+  shards.json: The name of each shard, the `00000` prefix of its filename.
+
+The arrays are memory mapped, so a lookup is a binary search that only touches
+a few pages and membership tests for a batch of ids are a single
+`searchsorted`. Distinct ids can share a hash, with 64 bits this is unlikely
+until there are billions of ids, but lookups can have false positives.
+
+The index is built with an external merge sort. Workers read shards in
+parallel and save sorted runs of at most `run_size` ids to disk, then the runs
+are merged, a block at a time, into the final arrays.
+"""
+
+import json
+import multiprocessing as mp
+import os
+import re
+import tempfile
+from array import array
+from functools import partial
+from typing import Iterator, List, Optional, Sequence
+
+import numpy as np
+import tqdm
+
+from common_pile import index, utils
+from common_pile.logs import get_logger
+
+IDS = "ids.npy"
+SHARDS = "shards.npy"
+SHARD_NAMES = "shards.json"
+RUN_DTYPE = np.dtype([("id_hash", "<u8"), ("shard", "<u4")])
+
+
+def shard_name(path: str) -> str:
+    """The shard number from the filename of `path`, the filename if it has none."""
+    name = os.path.basename(path)
+    if shard := re.search(r"^(\d{5})_", name):
+        return shard.group(1)
+    return name
+
+
+def line_hashes(lines: Sequence[str]) -> np.ndarray:
+    """The id hashes for the documents in json `lines`."""
+    return np.fromiter(
+        (index.id_hash(index.line_id(line)) for line in lines),
+        dtype=np.uint64,
+        count=len(lines),
+    )
+
+
+def _save_run(run_dir: str, shard: int, part: int, hashes: array) -> str:
+    run = np.empty(len(hashes), dtype=RUN_DTYPE)
+    run["id_hash"] = np.frombuffer(hashes, dtype=np.uint64)
+    run["shard"] = shard
+    run.sort(order="id_hash", kind="stable")
+    path = os.path.join(run_dir, f"{shard:08}-{part:05}.npy")
+    np.save(path, run, allow_pickle=False)
+    return path
+
+
+def sort_shard(task, run_dir: str, run_size: int) -> List[str]:
+    """Save the ids in a shard as sorted runs, returns the paths of the runs."""
+    shard, path = task
+    runs = []
+    hashes = array("Q")
+    with utils.open_dolma(path) as f:
+        for line in f:
+            if line.strip():
+                # Only the id is decoded.
+                hashes.append(index.id_hash(index.line_id(line)))
+            if len(hashes) >= run_size:
+                runs.append(_save_run(run_dir, shard, len(runs), hashes))
+                hashes = array("Q")
+    if hashes or not runs:
+        runs.append(_save_run(run_dir, shard, len(runs), hashes))
+    return runs
+
+
+def merge_runs(
+    runs: List[np.ndarray],
+    ids: np.ndarray,
+    shards: np.ndarray,
+    block_size: int = 1024 * 1024,
+):
+    """Merge the sorted `runs` into `ids` and `shards`.
+
+    Each step looks at the next `block_size` entries of every run. Everything
+    up to the smallest of their last hashes is in its final place once sorted,
+    so it is merged and written out. Memory is bounded by `block_size` times
+    the number of runs.
+    """
+    positions = [0] * len(runs)
+    written = 0
+    while active := [i for i, run in enumerate(runs) if positions[i] < len(run)]:
+        stops = {i: min(positions[i] + block_size, len(runs[i])) for i in active}
+        bound = min(runs[i]["id_hash"][stops[i] - 1] for i in active)
+        parts = []
+        for i in active:
+            block = runs[i][positions[i] : stops[i]]
+            end = int(np.searchsorted(block["id_hash"], bound, side="right"))
+            parts.append(block[:end])
+            positions[i] += end
+        merged = np.concatenate(parts)
+        merged = merged[np.argsort(merged["id_hash"], kind="stable")]
+        ids[written : written + len(merged)] = merged["id_hash"]
+        shards[written : written + len(merged)] = merged["shard"]
+        written += len(merged)
+
+
+def build_id_index(
+    paths: Sequence[str],
+    output: str,
+    processes: Optional[int] = None,
+    run_size: int = 10_000_000,
+    tmp_dir: Optional[str] = None,
+) -> "IdIndex":
+    """Index the ids in the dolma shards at `paths` and save it in the `output` dir.
+
+    Sorted runs are saved in a temporary directory under `tmp_dir` (or
+    `output`), they take about as much space as the final index.
+    """
+    logger = get_logger()
+    paths = sorted(paths)
+    os.makedirs(output, exist_ok=True)
+    logger.info("Indexing the ids in %d shards into %s", len(paths), output)
+    with tempfile.TemporaryDirectory(dir=tmp_dir or output) as run_dir:
+        runs = []
+        with mp.get_context("spawn").Pool(processes) as pool:
+            for shard_runs in tqdm.tqdm(
+                pool.imap_unordered(
+                    partial(sort_shard, run_dir=run_dir, run_size=run_size),
+                    enumerate(paths),
+                ),
+                total=len(paths),
+                desc="shards",
+            ):
+                runs.extend(shard_runs)
+        runs = [np.load(run, mmap_mode="r", allow_pickle=False) for run in sorted(runs)]
+        total = sum(len(run) for run in runs)
+        logger.info("Merging %d sorted runs with %d ids", len(runs), total)
+        ids = np.lib.format.open_memmap(
+            os.path.join(output, IDS), mode="w+", dtype=np.uint64, shape=(total,)
+        )
+        shards = np.lib.format.open_memmap(
+            os.path.join(output, SHARDS), mode="w+", dtype=np.uint32, shape=(total,)
+        )
+        merge_runs(runs, ids, shards)
+        ids.flush()
+        shards.flush()
+        del ids, shards, runs
+    with open(os.path.join(output, SHARD_NAMES), "w") as wf:
+        json.dump([shard_name(p) for p in paths], wf)
+    return IdIndex(output)
+
+
+class IdIndex:
+    """Look up which shard an id is in, and compare sets of ids, without loading them."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.ids = np.load(os.path.join(path, IDS), mmap_mode="r")
+        self.shards = np.load(os.path.join(path, SHARDS), mmap_mode="r")
+        with open(os.path.join(path, SHARD_NAMES)) as f:
+            self.shard_names = json.load(f)
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def find(self, doc_id) -> Optional[int]:
+        """The position of `doc_id` in the index, None if it isn't there."""
+        h = np.uint64(index.id_hash(doc_id))
+        i = int(np.searchsorted(self.ids, h))
+        if i < len(self.ids) and self.ids[i] == h:
+            return i
+        return None
+
+    def __contains__(self, doc_id) -> bool:
+        return self.find(doc_id) is not None
+
+    def shard(self, doc_id) -> Optional[str]:
+        """The name of the shard `doc_id` is in, None if it isn't in any."""
+        if (i := self.find(doc_id)) is None:
+            return None
+        return self.shard_names[self.shards[i]]
+
+    def contains(self, hashes: np.ndarray) -> np.ndarray:
+        """A mask of which of the id `hashes` are in the index."""
+        hashes = np.asarray(hashes, dtype=np.uint64)
+        if not len(self.ids):
+            return np.zeros(len(hashes), dtype=bool)
+        positions = np.searchsorted(self.ids, hashes)
+        np.minimum(positions, len(self.ids) - 1, out=positions)
+        return self.ids[positions] == hashes
+
+    def difference(
+        self, other: "IdIndex", block_size: int = 1024 * 1024
+    ) -> Iterator[np.ndarray]:
+        """Yield blocks of the positions in this index of ids that aren't in `other`."""
+        for start in range(0, len(self), block_size):
+            block = np.asarray(self.ids[start : start + block_size])
+            yield start + np.flatnonzero(~other.contains(block))
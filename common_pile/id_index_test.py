@@ -0,0 +1,55 @@
+"""Tests for the sorted, on-disk id index."""
+
+import numpy as np
+import pytest
+
+from common_pile import id_index
+from common_pile.write import ShardWriter
+
+
+def make_run(hashes, shard):
+    run = np.empty(len(hashes), dtype=id_index.RUN_DTYPE)
+    run["id_hash"] = hashes
+    run["shard"] = shard
+    run.sort(order="id_hash", kind="stable")
+    return run
+
+
+@pytest.mark.parametrize("block_size", [1, 3, 1024])
+def test_merge_runs_with_duplicate_hashes(block_size):
+    rng = np.random.default_rng(0)
+    # Few distinct values, so there are duplicates within and across runs, and
+    # long stretches of one value straddle the blocks.
+    runs = [
+        make_run(rng.integers(0, 20, size=n), i) for i, n in enumerate([50, 0, 7, 33])
+    ]
+    runs.append(make_run(np.full(10, 5), len(runs)))
+    total = sum(len(run) for run in runs)
+    ids = np.zeros(total, dtype=np.uint64)
+    shards = np.zeros(total, dtype=np.uint32)
+    id_index.merge_runs(runs, ids, shards, block_size=block_size)
+    assert np.all(ids[1:] >= ids[:-1])
+    merged = sorted(zip(ids.tolist(), shards.tolist()))
+    expected = sorted(
+        (h, s) for run in runs for h, s in zip(run["id_hash"].tolist(), run["shard"])
+    )
+    assert merged == expected
+
+
+def test_build_id_index(tmp_path):
+    paths = []
+    for shard in range(3):
+        path = tmp_path / f"{shard:05}_shard.jsonl.gz"
+        with ShardWriter(str(path)) as writer:
+            for i in range(shard * 10, shard * 10 + 10):
+                writer.write(f'{{"id":"doc-{i}","text":""}}')
+        paths.append(str(path))
+    ids = id_index.build_id_index(paths, str(tmp_path / "ids"), processes=2, run_size=4)
+    assert len(ids) == 30
+    assert ids.shard("doc-0") == "00000"
+    assert ids.shard("doc-25") == "00002"
+    assert ids.shard("doc-30") is None
+    assert "doc-12" in ids
+    other = id_index.build_id_index(paths[:2], str(tmp_path / "other"), processes=1)
+    missing = np.concatenate(list(ids.difference(other)))
+    assert sorted(ids.shards[missing].tolist()) == [2] * 10
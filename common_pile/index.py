@@ -0,0 +1,462 @@
+"""A sidecar index for random access to the documents in a dolma shard.
+
+For a shard at `path` the index is saved at `path.idx` as a NumPy array with
+one record per document, in file order:
+
+  id_hash: A 64-bit hash of the document id, see `id_hash`.
+  block_offset: Where the block holding the document starts in the (compressed)
+    file.
+  offset: Where the line starts in the decompressed block.
+
+Shards written by `common_pile.write.ShardWriter` are made of independent
+blocks (gzip members or zstd frames), so reading document N, or the document
+with a given id, only decompresses the one block it is in. The index is a
+plain `.npy` file, so local ones are memory mapped instead of read.
+
+Ordinary gzip shards, like the ones written before we wrote blocks, are indexed
+like uncompressed ones, `block_offset` is where the line starts in the
+decompressed stream. As they are read the decompressor state is saved every
+few MB (like zlib's zran example), so going back to a document only
+decompresses from the checkpoint before it.
+"""
+
+import bisect
+import gzip
+import hashlib
+import io
+import os
+import zlib
+from array import array
+from typing import BinaryIO, Dict, Iterator, List, Optional, Sequence, Tuple
+
+import numpy as np
+import smart_open
+
+from common_pile import blocked_gzip, codec, rawjson
+
+INDEX_DTYPE = np.dtype([("id_hash", "<u8"), ("block_offset", "<u8"), ("offset", "<u4")])
+# How a line starts when the id is the first field and a string.
+_ID_PREFIX = '{"id":"'
+
+
+def index_path(path: str) -> str:
+    """Where the index for the shard at `path` is saved."""
+    return f"{path}.idx"
+
+
+def id_hash(doc_id) -> int:
+    """A stable 64-bit hash of a document id, python's `hash` changes per process."""
+    digest = hashlib.blake2b(str(doc_id).encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "little")
+
+
+def line_id(line: str):
+    """The id of the document in the json `line`, without decoding the rest of it."""
+    # Our writers put the id first, in that case just find the closing quote.
+    if line.startswith(_ID_PREFIX):
+        end = line.find('"', len(_ID_PREFIX))
+        if end != -1 and "\\" not in line[len(_ID_PREFIX) : end]:
+            return line[len(_ID_PREFIX) : end]
+    location = rawjson.locate(line, ("id",))
+    if not location.found:
+        raise ValueError(f"Document has no id: `{line[:80]}...`")
+    return codec.loads(line[location.start : location.end])
+
+
+def _compression(path: str) -> Optional[str]:
+    # Avoid a circular import, write uses this module to build indices.
+    from common_pile.write import compression_type
+
+    return compression_type(path)
+
+
+class IndexBuilder:
+    """Collect index entries as documents are written.
+
+    Documents are added with the number of the block they are in, the offset of
+    each block is only known once it has been written, see `add_block`.
+    """
+
+    def __init__(self):
+        self.id_hashes = array("Q")
+        self.blocks = array("Q")
+        self.offsets = array("I")
+        self.block_offsets = array("Q")
+
+    def __len__(self):
+        return len(self.id_hashes)
+
+    def add(self, line: str, block: int, offset: int, doc_id=None):
+        """Add the document in `line`, its id is read from the line if not given."""
+        self.id_hashes.append(id_hash(line_id(line) if doc_id is None else doc_id))
+        self.blocks.append(block)
+        self.offsets.append(offset)
+
+    def add_block(self, block_offset: int):
+        """Record where the next block starts, blocks are added in order."""
+        self.block_offsets.append(block_offset)
+
+    def entries(self) -> np.ndarray:
+        entries = np.empty(len(self), dtype=INDEX_DTYPE)
+        entries["id_hash"] = np.frombuffer(self.id_hashes, dtype=np.uint64)
+        block_offsets = np.frombuffer(self.block_offsets, dtype=np.uint64)
+        entries["block_offset"] = block_offsets[
+            np.frombuffer(self.blocks, dtype=np.uint64).astype(np.intp)
+        ]
+        entries["offset"] = np.frombuffer(self.offsets, dtype=np.uint32)
+        return entries
+
+    def save(self, path: str):
+        save_index(path, self.entries())
+
+
+def save_index(path: str, entries: np.ndarray):
+    """Save the `entries` for the shard at `path`."""
+    with smart_open.open(index_path(path), "wb", compression="disable") as wf:
+        np.save(wf, entries, allow_pickle=False)
+
+
+def load_index(path: str) -> np.ndarray:
+    """Load the index for the shard at `path`, memory mapped when it is local."""
+    idx = index_path(path)
+    if os.path.exists(idx):
+        return np.load(idx, mmap_mode="r", allow_pickle=False)
+    with smart_open.open(idx, "rb", compression="disable") as f:
+        return np.load(io.BytesIO(f.read()), allow_pickle=False)
+
+
+def has_index(path: str) -> bool:
+    idx = index_path(path)
+    if "://" not in idx:
+        return os.path.exists(idx)
+    try:
+        with smart_open.open(idx, "rb", compression="disable"):
+            return True
+    except Exception:
+        return False
+
+
+def _block_lines(data: bytes) -> Iterator[tuple]:
+    """Yield (offset, line) for each line in a decompressed block."""
+    start = 0
+    while start < len(data):
+        end = data.find(b"\n", start)
+        end = len(data) if end == -1 else end + 1
+        yield start, data[start:end].decode("utf-8", "surrogatepass")
+        start = end
+
+
+def _index_lines(f: BinaryIO, builder: IndexBuilder):
+    """Index a file of lines, each line is its own "block" at its offset."""
+    offset = 0
+    for line in f:
+        if line.strip():
+            builder.add_block(offset)
+            builder.add(
+                line.decode("utf-8", "surrogatepass"),
+                len(builder.block_offsets) - 1,
+                0,
+            )
+        offset += len(line)
+
+
+def build_index(path: str) -> np.ndarray:
+    """Index an existing shard and save it next to it.
+
+    zstd shards have to end with a seek table, i.e. be written by `ShardWriter`,
+    other zstd files raise a ValueError. Gzip files that aren't made of blocks
+    are indexed by their offsets in the decompressed stream.
+    """
+    builder = IndexBuilder()
+    compression = _compression(path)
+    with smart_open.open(path, "rb", compression="disable") as f:
+        if compression is None:
+            _index_lines(f, builder)
+        elif compression == "gz" and not blocked_gzip.is_blocked(f):
+            f.seek(0)
+            with gzip.GzipFile(fileobj=f) as lines:
+                _index_lines(lines, builder)
+        else:
+            if compression == "gz":
+                blocks = blocked_gzip.read_blocks(f)
+                offsets = [b.offset for b in blocks]
+                data = blocked_gzip.read_block_data(f, blocks)
+            else:
+                from common_pile import zstd
+
+                frames = zstd.read_seek_table(f)
+                offsets = [fr.offset for fr in frames]
+                data = zstd.read_frames(f, frames)
+            for block, (block_offset, block_data) in enumerate(zip(offsets, data)):
+                builder.add_block(block_offset)
+                for offset, line in _block_lines(block_data):
+                    if line.strip():
+                        builder.add(line, block, offset)
+    entries = builder.entries()
+    save_index(path, entries)
+    return entries
+
+
+def _inflate(d, data: bytes) -> Tuple[object, bytes]:
+    """Decompress `data` with `d`, starting new decompressors for new gzip members."""
+    out = []
+    while data:
+        if d.eof:
+            d = zlib.decompressobj(wbits=31)
+        out.append(d.decompress(data))
+        data = d.unused_data if d.eof else b""
+    return d, b"".join(out)
+
+
+class _GzipStream:
+    """Read lines at offsets in the decompressed stream of an ordinary gzip file.
+
+    The decompressor state is saved about every `spacing` decompressed bytes
+    the first time a read gets that far, so reading the file in order is a
+    single pass. Later reads start from the checkpoint before the line, or
+    carry on from the last read when going forward.
+    """
+
+    def __init__(self, f: BinaryIO, spacing: int = 4 * 1024 * 1024, chunk=1 << 16):
+        self.f = f
+        self.spacing = spacing
+        self.chunk = chunk
+        # (compressed offset, decompressed offset, decompressor state)
+        self.checkpoints = [(0, 0, zlib.decompressobj(wbits=31))]
+        self._starts = [0]
+        self._d = None
+
+    def _restore(self, position: int):
+        checkpoint = bisect.bisect_right(self._starts, position) - 1
+        compressed, self._out, d = self.checkpoints[checkpoint]
+        self._d, self._in, self._buffer = d.copy(), compressed, b""
+
+    def _more(self) -> bool:
+        """Decompress the next chunk into the buffer, False at the end of the file."""
+        self.f.seek(self._in)
+        if not (data := self.f.read(self.chunk)):
+            return False
+        self._in += len(data)
+        self._d, out = _inflate(self._d, data)
+        self._buffer += out
+        end = self._out + len(self._buffer)
+        # Only reads past the last checkpoint add new ones.
+        if end - self._starts[-1] >= self.spacing:
+            self.checkpoints.append((self._in, end, self._d.copy()))
+            self._starts.append(end)
+        return True
+
+    def line(self, position: int) -> bytes:
+        """The line starting at `position` in the decompressed stream."""
+        checkpoint = self._starts[bisect.bisect_right(self._starts, position) - 1]
+        # Carry on from the last read unless a checkpoint gets closer.
+        if self._d is None or position < self._out or checkpoint > self._out:
+            self._restore(position)
+        while self._out + len(self._buffer) <= position:
+            # Nothing buffered is needed, drop it.
+            self._out += len(self._buffer)
+            self._buffer = b""
+            if not self._more():
+                raise IndexError(f"{position} is past the end of the stream.")
+        start = position - self._out
+        while (end := self._buffer.find(b"\n", start)) == -1:
+            # Only drop the bytes before the line when the buffer grows, so
+            # reading lines in order doesn't copy the buffer for each one.
+            self._buffer = self._buffer[start:]
+            self._out, start = position, 0
+            if not self._more():
+                end = len(self._buffer)
+                break
+        return self._buffer[start:end]
+
+
+class IndexedShard:
+    """Random access to the documents in a shard by position or by id.
+
+    The index is built (and saved) if the shard doesn't have one yet. The last
+    decompressed block is kept around, so reading documents in order only
+    decompresses each block once. Ordinary gzip shards are read through
+    checkpoints of the decompressor, see `_GzipStream`.
+    """
+
+    def __init__(self, path: str, build: bool = True):
+        self.path = path
+        self.compression = _compression(path)
+        if not has_index(path):
+            if not build:
+                raise FileNotFoundError(f"{index_path(path)} does not exist.")
+            build_index(path)
+        self.entries = load_index(path)
+        self._f = None
+        # zstd frames by offset, read from the seek table on first use.
+        self._frames = None
+        # Set on the first read of a gzip shard that isn't made of blocks.
+        self._stream: Optional[_GzipStream] = None
+        self._blocked: Optional[bool] = None
+        self._cached_offset = None
+        self._cached_block = None
+        self._by_hash = None
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def _file(self):
+        if self._f is None:
+            self._f = smart_open.open(self.path, "rb", compression="disable")
+        return self._f
+
+    def _gzip_stream(self) -> Optional[_GzipStream]:
+        """The reader for an ordinary gzip shard, None if it is made of blocks."""
+        if self._blocked is None:
+            self._blocked = blocked_gzip.is_blocked(self._file())
+            if not self._blocked:
+                self._stream = _GzipStream(self._file())
+        return self._stream
+
+    def _block(self, block_offset: int) -> bytes:
+        if block_offset == self._cached_offset:
+            return self._cached_block
+        f = self._file()
+        if self.compression == "gz":
+            f.seek(block_offset)
+            header = f.read(blocked_gzip.HEADER.size + blocked_gzip.EXTRA.size)
+            size = blocked_gzip.EXTRA.unpack_from(header, blocked_gzip.HEADER.size)[3]
+            data = next(
+                blocked_gzip.read_block_data(
+                    f, [blocked_gzip.Block(block_offset, size, 0)]
+                )
+            )
+        else:
+            from common_pile import zstd
+
+            if self._frames is None:
+                self._frames = {fr.offset: fr for fr in zstd.read_seek_table(f)}
+            data = next(zstd.read_frames(f, [self._frames[block_offset]]))
+        self._cached_offset, self._cached_block = block_offset, data
+        return data
+
+    def line(self, position: int) -> str:
+        """The raw json line for the document at `position`."""
+        if position < 0:
+            position += len(self)
+        if not 0 <= position < len(self):
+            raise IndexError(f"Document {position} is out of range for {self.path}.")
+        entry = self.entries[position]
+        block_offset, offset = int(entry["block_offset"]), int(entry["offset"])
+        if self.compression is None:
+            f = self._file()
+            f.seek(block_offset + offset)
+            return f.readline().decode("utf-8", "surrogatepass").rstrip("\n")
+        if self.compression == "gz" and (stream := self._gzip_stream()) is not None:
+            return stream.line(block_offset + offset).decode("utf-8", "surrogatepass")
+        data = self._block(block_offset)
+        end = data.find(b"\n", offset)
+        end = len(data) if end == -1 else end
+        return data[offset:end].decode("utf-8", "surrogatepass")
+
+    def __getitem__(self, position: int) -> Dict:
+        return codec.loads(self.line(position))
+
+    def __iter__(self) -> Iterator[Dict]:
+        return (self[i] for i in range(len(self)))
+
+    def lines(self, start: int = 0) -> Iterator[str]:
+        """The raw lines of the documents from `start` to the end of the shard."""
+        return (self.line(i) for i in range(start, len(self)))
+
+    def positions(self, doc_id) -> List[int]:
+        """The positions of the documents with `doc_id`, ids should be unique."""
+        if self._by_hash is None:
+            # Sorted on first use, so readers that only go by position don't pay for it.
+            self._by_hash = np.argsort(self.entries["id_hash"], kind="stable")
+            self._sorted_hashes = self.entries["id_hash"][self._by_hash]
+        h = np.uint64(id_hash(doc_id))
+        start = np.searchsorted(self._sorted_hashes, h, side="left")
+        stop = np.searchsorted(self._sorted_hashes, h, side="right")
+        # Check the ids themselves in case of a hash collision.
+        return sorted(
+            int(i)
+            for i in self._by_hash[start:stop]
+            if str(line_id(self.line(int(i)))) == str(doc_id)
+        )
+
+    def position(self, doc_id) -> Optional[int]:
+        """The position of the first document with `doc_id`, None if there isn't one."""
+        positions = self.positions(doc_id)
+        return positions[0] if positions else None
+
+    def __contains__(self, doc_id) -> bool:
+        return self.position(doc_id) is not None
+
+    def get(self, doc_id, default=None) -> Optional[Dict]:
+        """The document with `doc_id`, or `default` if it isn't in this shard."""
+        if (position := self.position(doc_id)) is None:
+            return default
+        return self[position]
+
+    def close(self):
+        if self._f is not None:
+            self._f.close()
+            self._f = None
+        # The stream reads from the file, it is remade if the shard is reopened.
+        self._stream = self._blocked = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class IndexedDataset:
+    """Random access across several shards, positions run through them in order."""
+
+    def __init__(self, paths: Sequence[str], build: bool = True):
+        self.shards = [IndexedShard(p, build=build) for p in paths]
+        self.starts = np.cumsum([0] + [len(s) for s in self.shards])
+
+    def __len__(self) -> int:
+        return int(self.starts[-1])
+
+    def locate(self, position: int):
+        """The (shard, position in that shard) for dataset `position`."""
+        if position < 0:
+            position += len(self)
+        if not 0 <= position < len(self):
+            raise IndexError(f"Document {position} is out of range.")
+        shard = int(np.searchsorted(self.starts, position, side="right")) - 1
+        return self.shards[shard], position - int(self.starts[shard])
+
+    def line(self, position: int) -> str:
+        shard, position = self.locate(position)
+        return shard.line(position)
+
+    def __getitem__(self, position: int) -> Dict:
+        return codec.loads(self.line(position))
+
+    def id_hashes(self) -> np.ndarray:
+        """The id hash of every document, in dataset order."""
+        if not self.shards:
+            return np.empty(0, dtype=np.uint64)
+        return np.concatenate([s.entries["id_hash"] for s in self.shards])
+
+    def position(self, doc_id) -> Optional[int]:
+        for start, shard in zip(self.starts, self.shards):
+            if (position := shard.position(doc_id)) is not None:
+                return int(start) + position
+        return None
+
+    def get(self, doc_id, default=None) -> Optional[Dict]:
+        if (position := self.position(doc_id)) is None:
+            return default
+        return self[position]
+
+    def close(self):
+        for shard in self.shards:
+            shard.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,72 @@
+"""Tests for the sidecar index of a dolma shard."""
+
+import gzip
+import os
+
+import numpy as np
+import pytest
+
+from common_pile import index
+from common_pile.write import ShardWriter
+
+DOCUMENTS = [{"id": f"doc-{i}", "text": f"document {i} " * (i % 7)} for i in range(50)]
+
+
+def write_shard(path, build):
+    with ShardWriter(str(path), frame_documents=8, index=not build) as writer:
+        for document in DOCUMENTS:
+            writer.write(f'{{"id":"{document["id"]}","text":"{document["text"]}"}}')
+    if build:
+        index.build_index(str(path))
+
+
+@pytest.mark.parametrize("extension", ["jsonl", "jsonl.gz", "jsonl.zst"])
+def test_writer_and_build_index_agree(tmp_path, extension):
+    written = tmp_path / f"written.{extension}"
+    built = tmp_path / f"built.{extension}"
+    write_shard(written, build=False)
+    write_shard(built, build=True)
+    np.testing.assert_array_equal(
+        index.load_index(str(written)), index.load_index(str(built))
+    )
+
+
+@pytest.mark.parametrize("extension", ["jsonl", "jsonl.gz", "jsonl.zst"])
+def test_indexed_shard_random_access(tmp_path, extension):
+    path = tmp_path / f"shard.{extension}"
+    write_shard(path, build=False)
+    with index.IndexedShard(str(path), build=False) as shard:
+        assert len(shard) == len(DOCUMENTS)
+        for i in [49, 0, 17, 8, 7, -1]:
+            assert shard[i] == DOCUMENTS[i]
+        assert shard.get("doc-23") == DOCUMENTS[23]
+        assert shard.position("doc-40") == 40
+        assert "doc-50" not in shard
+        with pytest.raises(IndexError):
+            shard.line(len(DOCUMENTS))
+        assert list(shard) == DOCUMENTS
+
+
+def test_plain_gzip_random_access(tmp_path):
+    path = tmp_path / "shard.jsonl.gz"
+    with gzip.open(path, "wt") as wf:
+        for document in DOCUMENTS:
+            wf.write(f'{{"id":"{document["id"]}","text":"{document["text"]}"}}\n')
+    assert not os.path.exists(index.index_path(str(path)))
+    with index.IndexedShard(str(path)) as shard:
+        assert os.path.exists(index.index_path(str(path)))
+        for i in [30, 2, 49, 0]:
+            assert shard[i] == DOCUMENTS[i]
+
+
+def test_indexed_dataset_runs_through_shards(tmp_path):
+    paths = []
+    for i in range(3):
+        path = tmp_path / f"{i:05}_shard.jsonl.gz"
+        write_shard(path, build=False)
+        paths.append(str(path))
+    with index.IndexedDataset(paths) as dataset:
+        assert len(dataset) == 3 * len(DOCUMENTS)
+        assert dataset[len(DOCUMENTS) + 5] == DOCUMENTS[5]
+        assert dataset.position("doc-3") == 3
+        assert len(dataset.id_hashes()) == len(dataset)
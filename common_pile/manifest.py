@@ -0,0 +1,183 @@
+"""A manifest of the shards in an output directory and what made them.
+
+Each output directory has a `.manifest.jsonl` with one entry per output shard:
+the input it was made from (size, mtime, and a checksum when the storage
+provides one), the processor class, its version, a digest of the options it
+was run with, and the sha256 and size of the output. A rerun reads this one
+file to decide which shards are stale, only checking that each output is still
+there, instead of opening every output.
+
+Workers can't safely append to a shared (possibly remote) file, so each one
+writes its entry to `.manifest/<key>.json`, these are folded into the
+manifest at the end of a run (or at the start of the next one if a run dies).
+"""
+
+import datetime
+import hashlib
+from typing import Any, Dict, Optional
+
+import fsspec
+
+from common_pile import codec
+
+MANIFEST = ".manifest.jsonl"
+PENDING = ".manifest"
+# Options that change how a processor runs, but not what it outputs.
+IGNORED_OPTIONS = frozenset(
+    (
+        "overwrite",
+        "debug",
+        "update_interval",
+        "retries_on_error",
+        "write_behind",
+        "checkpoint_interval",
+        "batch_size",
+        "shadow",
+    )
+)
+
+
+def _join(root: str, name: str) -> str:
+    return f"{root.rstrip('/')}/{name}"
+
+
+def relative_path(root: str, path: str) -> str:
+    """`path` relative to the output directory `root`."""
+    root = root.rstrip("/") + "/"
+    if not path.startswith(root):
+        raise ValueError(f"{path} is not in {root}")
+    return path[len(root) :]
+
+
+def file_info(path: str) -> Dict[str, Any]:
+    """The size, mtime, and (if the storage has one) checksum of `path`."""
+    fs, fs_path = fsspec.core.url_to_fs(path)
+    info = fs.info(fs_path)
+    mtime = info.get("mtime", info.get("LastModified", info.get("updated")))
+    if isinstance(mtime, datetime.datetime):
+        mtime = mtime.isoformat()
+    checksum = info.get("ETag", info.get("md5Hash", info.get("crc32c")))
+    return {"size": info["size"], "mtime": mtime, "checksum": checksum}
+
+
+def options_digest(options: Dict[str, Any]) -> str:
+    """A digest of the options that can change the output of a processor."""
+    relevant = {k: v for k, v in sorted(options.items()) if k not in IGNORED_OPTIONS}
+    return hashlib.sha256(codec.dumps(relevant, default=repr).encode()).hexdigest()
+
+
+def file_sha256(path: str, chunk_size: int = 16 * 1024 * 1024) -> str:
+    digest = hashlib.sha256()
+    with fsspec.open(path, "rb") as f:
+        while chunk := f.read(chunk_size):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def make_entry(
+    output: str,
+    source: str,
+    source_info: Dict[str, Any],
+    processor: str,
+    version: str,
+    options: str,
+    output_sha256: Optional[str],
+    output_size: Optional[int] = None,
+) -> Dict[str, Any]:
+    return {
+        "output": output,
+        "input": {"path": source, **source_info},
+        "processor": processor,
+        "version": version,
+        "options": options,
+        "output_sha256": output_sha256,
+        "output_size": output_size,
+        "time": datetime.datetime.now().isoformat(),
+    }
+
+
+def record(root: str, entry: Dict[str, Any]):
+    """Save the `entry` for one output shard, called from the workers."""
+    key = hashlib.sha1(entry["output"].encode("utf-8")).hexdigest()
+    fs, path = fsspec.core.url_to_fs(_join(_join(root, PENDING), f"{key}.json"))
+    fs.makedirs(fs._parent(path), exist_ok=True)
+    with fs.open(path, "w") as wf:
+        wf.write(codec.dumps(entry))
+
+
+class Manifest:
+    """The entries for the shards in the output directory `root`, by relative path."""
+
+    def __init__(self, root: str):
+        self.root = root
+        self.fs, self.path = fsspec.core.url_to_fs(_join(root, MANIFEST))
+        self.root_path = fsspec.core.url_to_fs(root)[1]
+        self.pending = fsspec.core.url_to_fs(_join(root, PENDING))[1]
+        self.entries: Dict[str, Dict[str, Any]] = {}
+        self.pending_files = []
+        if self.fs.exists(self.path):
+            with self.fs.open(self.path, "r") as f:
+                for line in f:
+                    if line.strip():
+                        entry = codec.loads(line)
+                        self.entries[entry["output"]] = entry
+        self._read_pending()
+
+    def _read_pending(self):
+        if not self.fs.exists(self.pending):
+            return
+        for path in self.fs.glob(f"{self.pending}/*.json"):
+            with self.fs.open(path, "r") as f:
+                entry = codec.loads(f.read())
+            self.entries[entry["output"]] = entry
+            self.pending_files.append(path)
+
+    def __bool__(self):
+        return bool(self.entries)
+
+    def is_current(
+        self,
+        output: str,
+        source_info: Dict[str, Any],
+        processor: str,
+        version: str,
+        options: str,
+    ) -> bool:
+        """Is the shard at `output` (relative to `root`) up to date?
+
+        The output has to still exist, with the size it was recorded with (when
+        there is one), so deleting an output makes it stale.
+        """
+        if (entry := self.entries.get(output)) is None:
+            return False
+        recorded = entry["input"]
+        if not (
+            all(recorded.get(k) == v for k, v in source_info.items())
+            and entry["processor"] == processor
+            and entry["version"] == version
+            and entry["options"] == options
+        ):
+            return False
+        try:
+            info = self.fs.info(_join(self.root_path, output))
+        except FileNotFoundError:
+            return False
+        size = entry.get("output_size")
+        return size is None or info["size"] == size
+
+    def save(self):
+        """Fold in the entries written by workers and rewrite the manifest."""
+        self._read_pending()
+        if not self.entries:
+            return
+        self.fs.makedirs(self.fs._parent(self.path), exist_ok=True)
+        # Write then move, so a crash never leaves a half written manifest.
+        with self.fs.open(f"{self.path}.tmp", "w") as wf:
+            for output in sorted(self.entries):
+                wf.write(codec.dumps(self.entries[output]) + "\n")
+        self.fs.mv(f"{self.path}.tmp", self.path)
+        for path in set(self.pending_files):
+            self.fs.rm(path)
+        self.pending_files = []
+        if self.fs.exists(self.pending) and not self.fs.ls(self.pending):
+            self.fs.rm(self.pending, recursive=True)
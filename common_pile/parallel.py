@@ -0,0 +1,333 @@
+"""Helpers for running work in parallel.
+
+`ParallelProcessor` is a dolma parallel processor base with cheap, shared
+memory, progress bars. Dolma's processors report progress by putting a tuple on
+a Manager queue for every update. Each put is a round trip to the manager
+process, so with many workers this is a lot of IPC (and `qsize()` takes a lock
+too). Here each worker gets its own slot in a block of shared memory instead.
+Updates are just adds to local memory and the progress bar thread sums the
+slots on a fixed interval.
+
+`bounded_imap` is `Pool.imap` with a limit on how many results can be in
+flight, so a slow consumer (like `to_dolma`) applies backpressure to the
+workers instead of results piling up in memory.
+"""
+
+import collections
+import ctypes
+import dataclasses
+import itertools
+import multiprocessing as mp
+import pickle
+import queue
+import threading
+import time
+from contextlib import ExitStack
+from functools import partial
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+)
+
+import tqdm
+from dolma.core.parallel import BaseParallelProcessor
+
+from common_pile.logs import get_logger
+
+__all__ = ["MapStats", "ParallelProcessor", "ProgressCounters", "bounded_imap"]
+
+# The counters for this worker process, set by the pool initializer.
+_WORKER_COUNTERS: Optional["ProgressCounters"] = None
+
+
+def _worker_counters() -> "ProgressCounters":
+    return _WORKER_COUNTERS
+
+
+def _init_worker(counters: "ProgressCounters"):
+    global _WORKER_COUNTERS
+    counters.attach()
+    _WORKER_COUNTERS = counters
+
+
+class ProgressCounters:
+    """One row of counters per worker in shared memory.
+
+    A worker only ever writes to its own row, so no locks are needed, and the
+    values are int64, which are read and written atomically.
+
+    This is passed to `process_single` as its `queue`. It is shared with the
+    workers when the pool starts; when it is pickled for a task, it unpickles
+    as the worker's own copy.
+    """
+
+    def __init__(self, names: Sequence[str], slots: int, ctx=mp):
+        self.names = tuple(names)
+        self.slots = slots
+        self.values = ctx.RawArray(ctypes.c_int64, slots * len(self.names))
+        self.next_slot = ctx.Value(ctypes.c_int, 0)
+        self.slot = None
+        self.attach()
+
+    def attach(self):
+        """Claim a row for this process."""
+        with self.next_slot.get_lock():
+            # If the pool replaces a dead worker rows get reused, the worst
+            # case is a few lost updates.
+            self.slot = self.next_slot.value % self.slots
+            self.next_slot.value += 1
+
+    def add(self, values: Sequence[int]):
+        offset = self.slot * len(self.names)
+        for i, value in enumerate(values):
+            if value:
+                self.values[offset + i] += value
+
+    def totals(self) -> List[int]:
+        width = len(self.names)
+        return [sum(self.values[i::width]) for i in range(width)]
+
+    def __reduce__(self):
+        if mp.context.get_spawning_popen() is not None:
+            # Starting a worker, send the shared memory itself.
+            return (
+                _rebuild_counters,
+                (self.names, self.slots, self.values, self.next_slot),
+            )
+        return (_worker_counters, ())
+
+
+def _rebuild_counters(names, slots, values, next_slot) -> ProgressCounters:
+    counters = ProgressCounters.__new__(ProgressCounters)
+    counters.names, counters.slots = names, slots
+    counters.values, counters.next_slot = values, next_slot
+    counters.slot = None
+    return counters
+
+
+class ParallelProcessor(BaseParallelProcessor):
+    """Base for our processors, progress is tracked with `ProgressCounters`.
+
+    Subclasses define `increment_progressbar` with the counters they track,
+    just like with dolma, and call it from `process_single` as often as they
+    like; it no longer needs to be throttled.
+    """
+
+    # How often, in seconds, the progress bars are refreshed.
+    progress_interval: float = 0.5
+
+    @classmethod
+    def get_logger(cls):
+        return get_logger()
+
+    @classmethod
+    def increment_progressbar(cls, queue, /, **kwargs: int) -> Dict[str, int]:
+        if isinstance(queue, ProgressCounters):
+            queue.add(tuple(kwargs.values()))
+            return kwargs
+        if queue is None:
+            # Used to find the names of the counters.
+            return kwargs
+        return super().increment_progressbar(queue, **kwargs)
+
+    @classmethod
+    def counter_names(cls) -> Tuple[str, ...]:
+        return tuple(cls.increment_progressbar(None))
+
+    def _run_progressbars(self, counters: ProgressCounters, done: threading.Event):
+        with ExitStack() as stack:
+            pbars = [
+                stack.enter_context(
+                    tqdm.tqdm(desc=name, unit=name[:1], position=i, unit_scale=True)
+                )
+                for i, name in enumerate(counters.names)
+            ]
+            last = [0] * len(pbars)
+            while True:
+                finished = done.wait(self.progress_interval)
+                totals = counters.totals()
+                for pbar, total, previous in zip(pbars, totals, last):
+                    if total != previous:
+                        pbar.update(total - previous)
+                last = totals
+                if finished:
+                    break
+
+    def _run_all(
+        self,
+        processes: int,
+        all_source_paths: List[str],
+        all_destination_paths: List[str],
+        all_metadata_paths: List[str],
+        all_process_kwargs: Optional[List[Dict]] = None,
+        **process_single_kwargs: Any,
+    ):
+        ctx = mp.get_context("spawn")
+        all_process_kwargs = all_process_kwargs or [{} for _ in all_source_paths]
+        tasks = list(
+            zip(
+                all_source_paths,
+                all_destination_paths,
+                all_metadata_paths,
+                all_process_kwargs,
+            )
+        )
+        processes = min(processes, len(tasks))
+        # Row 0 is this process, which is what runs the tasks when debugging.
+        counters = ProgressCounters(self.counter_names(), processes + 1, ctx)
+        done = threading.Event()
+        thread = threading.Thread(
+            target=self._run_progressbars, args=(counters, done), daemon=True
+        )
+        thread.start()
+        try:
+            calls = [
+                partial(
+                    self._process_single_and_save_status,
+                    source_path=source_path,
+                    destination_path=destination_path,
+                    metadata_path=metadata_path,
+                    queue=counters,
+                    serialized_kwargs=pickle.dumps(
+                        {**process_kwargs, **process_single_kwargs}
+                    ),
+                )
+                for source_path, destination_path, metadata_path, process_kwargs in tasks
+            ]
+            if not processes or self.debug:
+                for call in calls:
+                    call()
+                return
+            with ctx.Pool(
+                processes=processes, initializer=_init_worker, initargs=(counters,)
+            ) as pool:
+                results = [pool.apply_async(call) for call in calls]
+                for result in results:
+                    result.get()
+                pool.close()
+                pool.join()
+        finally:
+            done.set()
+            thread.join()
+
+    def _multiprocessing_run_all(self, *args, **kwargs):
+        self._run_all(self.num_processes, *args, **kwargs)
+
+    def _debug_run_all(self, *args, **kwargs):
+        self._run_all(1, *args, **kwargs)
+
+
+@dataclasses.dataclass
+class MapStats:
+    """Where the time went in a `bounded_imap`.
+
+    consumer_wait: Seconds the consumer spent waiting for a result, i.e. the
+      workers are the bottleneck.
+    producer_wait: Seconds the workers were held back because `max_in_flight`
+      results were waiting on the consumer, i.e. the consumer is the bottleneck.
+    """
+
+    items: int = 0
+    consumer_wait: float = 0.0
+    producer_wait: float = 0.0
+
+    def __str__(self):
+        return (
+            f"{self.items} items, {self.consumer_wait:.1f}s waiting on workers, "
+            f"{self.producer_wait:.1f}s waiting on the consumer"
+        )
+
+
+def _apply_chunk(fn: Callable, chunk: List) -> List:
+    return [fn(x) for x in chunk]
+
+
+def bounded_imap(
+    fn: Callable,
+    iterable: Iterable,
+    pool=None,
+    processes: Optional[int] = None,
+    max_in_flight: Optional[int] = None,
+    ordered: bool = True,
+    chunksize: int = 1,
+    stats: Optional[MapStats] = None,
+) -> Iterator:
+    """Like `pool.imap(fn, iterable)`, but with at most `max_in_flight` items
+    submitted and not yet consumed.
+
+    `Pool.imap` reads the whole input and buffers every result it hasn't
+    yielded yet. Here input is only read, and work only submitted, as results
+    are consumed, so memory is bounded by `max_in_flight` (default 4 chunks
+    per process). With `ordered=False` results are yielded as they finish like
+    `imap_unordered`. Uses `pool` if given, otherwise a new pool of
+    `processes`. Pass a `MapStats` to see whether the workers or the consumer
+    are the bottleneck, it is also logged at the end.
+    """
+    stats = stats if stats is not None else MapStats()
+    own_pool = pool is None
+    if own_pool:
+        pool = mp.Pool(processes)
+    if max_in_flight is None:
+        max_in_flight = 4 * chunksize * (processes or mp.cpu_count())
+    max_chunks = max(1, max_in_flight // chunksize)
+    inputs = iter(iterable)
+    # Ordered results wait on the oldest chunk, unordered ones on whichever
+    # chunk finishes first, which the pool reports through a callback.
+    pending = collections.deque()
+    finished = queue.Queue()
+    in_flight = 0
+
+    def submit():
+        nonlocal in_flight
+        while in_flight < max_chunks and (
+            chunk := list(itertools.islice(inputs, chunksize))
+        ):
+            if ordered:
+                pending.append(pool.apply_async(_apply_chunk, (fn, chunk)))
+            else:
+                pool.apply_async(
+                    _apply_chunk,
+                    (fn, chunk),
+                    callback=lambda r: finished.put((r, None)),
+                    error_callback=lambda e: finished.put((None, e)),
+                )
+            in_flight += 1
+
+    def workers_idle() -> bool:
+        if ordered:
+            return all(r.ready() for r in pending)
+        return finished.qsize() >= in_flight
+
+    try:
+        submit()
+        while in_flight:
+            start = time.perf_counter()
+            if ordered:
+                results = pending.popleft().get()
+            else:
+                results, error = finished.get()
+                if error is not None:
+                    raise error
+            stats.consumer_wait += time.perf_counter() - start
+            in_flight -= 1
+            # Top the workers up before handing results to the consumer.
+            submit()
+            for result in results:
+                start = time.perf_counter()
+                yield result
+                # The workers finished everything they were allowed to while
+                # the consumer had control.
+                if workers_idle():
+                    stats.producer_wait += time.perf_counter() - start
+                stats.items += 1
+    finally:
+        if own_pool:
+            pool.terminate()
+        get_logger().info("bounded_imap: %s", stats)
@@ -0,0 +1,94 @@
+"""Tests for the parallel helpers."""
+
+import multiprocessing as mp
+import random
+import time
+
+import pytest
+
+from common_pile import parallel
+
+
+def square(x):
+    return x * x
+
+
+def slow_square(x):
+    # Finish out of order.
+    time.sleep(random.random() / 100)
+    return x * x
+
+
+def fail_on_seven(x):
+    if x == 7:
+        raise ValueError("seven")
+    return x
+
+
+@pytest.mark.parametrize("chunksize", [1, 3])
+def test_bounded_imap_is_ordered(chunksize):
+    results = parallel.bounded_imap(
+        slow_square, range(50), processes=2, chunksize=chunksize
+    )
+    assert list(results) == [x * x for x in range(50)]
+
+
+def test_bounded_imap_unordered_yields_everything():
+    results = parallel.bounded_imap(slow_square, range(50), processes=2, ordered=False)
+    assert sorted(results) == [x * x for x in range(50)]
+
+
+@pytest.mark.parametrize("ordered", [True, False])
+@pytest.mark.parametrize("chunksize", [1, 2])
+def test_bounded_imap_backpressure(ordered, chunksize):
+    read = 0
+
+    def inputs():
+        nonlocal read
+        for x in range(100):
+            read += 1
+            yield x
+
+    stats = parallel.MapStats()
+    consumed = 0
+    for _ in parallel.bounded_imap(
+        square,
+        inputs(),
+        processes=2,
+        max_in_flight=4,
+        ordered=ordered,
+        chunksize=chunksize,
+        stats=stats,
+    ):
+        consumed += 1
+        # Input is only read as results are consumed.
+        assert read - consumed < 4 + chunksize
+        time.sleep(0.001)
+    assert consumed == read == stats.items == 100
+
+
+@pytest.mark.parametrize("ordered", [True, False])
+def test_bounded_imap_raises_worker_errors(ordered):
+    with pytest.raises(ValueError, match="seven"):
+        list(
+            parallel.bounded_imap(
+                fail_on_seven, range(20), processes=2, ordered=ordered
+            )
+        )
+
+
+def add_progress(counters, n):
+    for _ in range(n):
+        counters.add((1, 0, 2))
+    return counters.slot
+
+
+def test_progress_counters_sum_every_worker():
+    ctx = mp.get_context("spawn")
+    counters = parallel.ProgressCounters(("shards", "skipped", "documents"), 3, ctx)
+    counters.add((1, 0, 0))
+    with ctx.Pool(2, initializer=parallel._init_worker, initargs=(counters,)) as pool:
+        slots = pool.starmap(add_progress, [(counters, 100)] * 10)
+    # Row 0 is this process, each worker writes to its own row.
+    assert set(slots) <= {1, 2}
+    assert counters.totals() == [1001, 0, 2000]
@@ -0,0 +1,250 @@
+"""Read and update a few fields of a json line without parsing the whole thing.
+
+Dolma documents are mostly `text` and `metadata`, when a processor only needs
+one small field, decoding and re-encoding everything else is wasted work. These
+helpers scan the raw line to find where a field's value is, decode just that
+value, and splice a new encoding of it back into the original line. Everything
+else is copied through untouched.
+
+Fields are given as dotted paths, i.e. `metadata.authors` is
+`example["metadata"]["authors"]`, so keys that include a `.` can't be used.
+"""
+
+import json
+import re
+from typing import Dict, Iterator, List, Sequence, Tuple
+
+from common_pile import codec
+
+_WS = re.compile(r"[ \t\n\r]*")
+_SCALAR = re.compile(r"[^,}\]\s]+")
+_STRUCTURE = re.compile(r'[\[\]{}"]')
+
+
+def _error(msg: str, s: str, pos: int):
+    return json.JSONDecodeError(msg, s, min(pos, len(s)))
+
+
+def skip_string(s: str, i: int) -> int:
+    """Find the end of the json string that starts at `s[i]`."""
+    # str.find is much faster than a regex over long text fields.
+    j = i + 1
+    while (j := s.find('"', j)) != -1:
+        k = j
+        while s[k - 1] == "\\":
+            k -= 1
+        # An even number of backslashes means the quote isn't escaped.
+        if (j - k) % 2 == 0:
+            return j + 1
+        j += 1
+    raise _error("Unterminated string", s, i)
+
+
+def skip_value(s: str, i: int) -> int:
+    """Find the end of the json value that starts at `s[i]`, without decoding it."""
+    try:
+        c = s[i]
+    except IndexError:
+        raise _error("Expecting value", s, i) from None
+    if c == '"':
+        return skip_string(s, i)
+    if c in "[{":
+        depth = 0
+        while (m := _STRUCTURE.search(s, i)) is not None:
+            if m.group() == '"':
+                i = skip_string(s, m.start())
+                continue
+            depth += 1 if m.group() in "[{" else -1
+            i = m.end()
+            if depth == 0:
+                return i
+        raise _error(f"Unterminated {'object' if c == '{' else 'array'}", s, i)
+    if (m := _SCALAR.match(s, i)) is None:
+        raise _error("Expecting value", s, i)
+    return m.end()
+
+
+def members(s: str, start: int = 0) -> Iterator[Tuple[str, int, int, int]]:
+    """Yield (key, key start, value start, value end) for the object at `s[start]`."""
+    i = _WS.match(s, start).end()
+    if s[i : i + 1] != "{":
+        raise _error("Expecting object", s, i)
+    i = _WS.match(s, i + 1).end()
+    if s[i : i + 1] == "}":
+        return
+    while True:
+        if s[i : i + 1] != '"':
+            raise _error("Expecting property name enclosed in double quotes", s, i)
+        key, j = json.decoder.scanstring(s, i + 1)
+        j = _WS.match(s, j).end()
+        if s[j : j + 1] != ":":
+            raise _error("Expecting ':' delimiter", s, j)
+        value = _WS.match(s, j + 1).end()
+        end = skip_value(s, value)
+        yield key, i, value, end
+        j = _WS.match(s, end).end()
+        if s[j : j + 1] == "}":
+            return
+        if s[j : j + 1] != ",":
+            raise _error("Expecting ',' delimiter", s, j)
+        i = _WS.match(s, j + 1).end()
+
+
+class Location:
+    """Where the value for `path` is in a line, or where it would be added.
+
+    When the field exists, `start` and `end` are the span of its value and
+    `key_start` is where its key starts. When it doesn't, `start` and `end`
+    are the span of the deepest object on the path that does exist and
+    `missing` is the rest of the path below it. If the path runs into a value
+    that isn't an object, like `"metadata": null`, the field is missing and
+    `blocked` is set, as it can't be added without replacing that value.
+    """
+
+    __slots__ = ("key_start", "start", "end", "missing", "blocked")
+
+    def __init__(
+        self,
+        key_start: int,
+        start: int,
+        end: int,
+        missing: Sequence[str],
+        blocked: bool = False,
+    ):
+        self.key_start = key_start
+        self.start = start
+        self.end = end
+        self.missing = tuple(missing)
+        self.blocked = blocked
+
+    @property
+    def found(self) -> bool:
+        return not self.missing
+
+
+def locate(s: str, path: Sequence[str], start: int = 0) -> Location:
+    """Find the field at `path` in the json object in `s`."""
+    start = _WS.match(s, start).end()
+    for key, key_start, value, end in members(s, start):
+        if key == path[0]:
+            if len(path) == 1:
+                return Location(key_start, value, end, ())
+            if s[value] == "{":
+                return locate(s, path[1:], value)
+            # Not an object, so the rest of the path can't exist.
+            return Location(key_start, value, end, path[1:], blocked=True)
+    return Location(-1, start, skip_value(s, start), path)
+
+
+def parse_fields(fields: Sequence[str]) -> List[Tuple[str, ...]]:
+    """Split dotted fields into paths, checking that none overlap."""
+    paths = sorted(tuple(f.split(".")) for f in fields)
+    for a, b in zip(paths, paths[1:]):
+        if b[: len(a)] == a:
+            raise ValueError(f"Field {'.'.join(b)} is inside {'.'.join(a)}.")
+    return paths
+
+
+class PartialDocument:
+    """A json line where only the values at `paths` are decoded."""
+
+    def __init__(self, line: str, paths: Sequence[Tuple[str, ...]]):
+        self.line = line.rstrip("\n")
+        self.locations = {path: locate(self.line, path) for path in paths}
+
+    def example(self) -> Dict:
+        """A (nested) dict of just the fields that were found."""
+        example = {}
+        for path, location in self.locations.items():
+            if location.found:
+                parent = example
+                for key in path[:-1]:
+                    parent = parent.setdefault(key, {})
+                parent[path[-1]] = codec.loads(self.line[location.start : location.end])
+        return example
+
+    def update(self, example: Dict) -> str:
+        """The original line with the fields replaced by their values in `example`.
+
+        Fields that are missing from `example` are removed from the line and
+        new ones are added to the end of the innermost object that exists.
+        """
+        edits = []
+        removed = set()
+        for path, location in self.locations.items():
+            value = _lookup(example, path)
+            if location.found:
+                if value is _MISSING:
+                    if path[:-1] in removed:
+                        # The spans of neighbouring members overlap on the
+                        # comma between them, so only one member per object
+                        # is removed in place.
+                        return self._reencode(example)
+                    removed.add(path[:-1])
+                    edits.append(self._remove(location))
+                else:
+                    edits.append((location.start, location.end, codec.dumps(value)))
+            elif value is not _MISSING:
+                if location.blocked:
+                    return self._reencode(example)
+                for key in reversed(location.missing[1:]):
+                    value = {key: value}
+                member = f"{codec.dumps(location.missing[0])}:{codec.dumps(value)}"
+                # Insert before the closing brace, with a comma if needed.
+                at = location.end - 1
+                empty = _WS.match(self.line, location.start + 1).end() == at
+                edits.append((at, at, member if empty else f",{member}"))
+        if any(start == end for start, end, _ in edits) and any(
+            not text for _, _, text in edits
+        ):
+            # Adding and removing members in the same object can leave stray
+            # commas, this is rare enough to just re-encode everything.
+            return self._reencode(example)
+        line = self.line
+        for start, end, text in sorted(edits, reverse=True):
+            line = f"{line[:start]}{text}{line[end:]}"
+        return line
+
+    def _reencode(self, example: Dict) -> str:
+        full = codec.loads(self.line)
+        for path in self.locations:
+            value, parent = _lookup(example, path), full
+            if value is _MISSING:
+                parent = _lookup(full, path[:-1])
+                if isinstance(parent, dict):
+                    parent.pop(path[-1], None)
+                continue
+            for key in path[:-1]:
+                # Values that aren't objects are replaced, like a null metadata.
+                if not isinstance(parent.get(key), dict):
+                    parent[key] = {}
+                parent = parent[key]
+            parent[path[-1]] = value
+        return codec.dumps(full)
+
+    def _remove(self, location: Location) -> Tuple[int, int, str]:
+        s = self.line
+        after = _WS.match(s, location.end).end()
+        if s[after] == ",":
+            # Remove this member and the comma that follows it.
+            return location.key_start, _WS.match(s, after + 1).end(), ""
+        # The last member, remove the comma before it (if there is one).
+        before = location.key_start
+        while before > 0 and s[before - 1] in " \t\n\r":
+            before -= 1
+        if s[before - 1] == ",":
+            before -= 1
+        return before, location.end, ""
+
+
+_MISSING = object()
+
+
+def _lookup(example: Dict, path: Sequence[str]):
+    """The value at `path` in a nested dict, or `_MISSING`."""
+    value = example
+    for key in path:
+        if not isinstance(value, dict) or key not in value:
+            return _MISSING
+        value = value[key]
+    return value
@@ -0,0 +1,68 @@
+"""Tests for reading and updating fields of raw json lines."""
+
+import json
+
+import pytest
+
+from common_pile import rawjson
+
+
+def update(line, fields, example):
+    document = rawjson.PartialDocument(line, rawjson.parse_fields(fields))
+    return json.loads(document.update(example))
+
+
+@pytest.mark.parametrize(
+    "removed,expected",
+    [
+        (("a",), {"b": 2, "c": 3}),
+        (("b",), {"a": 1, "c": 3}),
+        (("c",), {"a": 1, "b": 2}),
+        (("a", "b"), {"c": 3}),
+        (("a", "c"), {"b": 2}),
+        (("b", "c"), {"a": 1}),
+        (("a", "b", "c"), {}),
+    ],
+)
+def test_update_removes_members(removed, expected):
+    line = '{"a": 1, "b": 2, "c": 3}'
+    assert update(line, removed, {}) == expected
+
+
+def test_update_removes_nested_members():
+    line = '{"x":0,"metadata":{"a":1,"b":2},"text":"hi"}'
+    assert update(line, ("metadata.a", "metadata.b"), {}) == {
+        "x": 0,
+        "metadata": {},
+        "text": "hi",
+    }
+
+
+def test_update_keeps_untouched_bytes():
+    line = '{"text": "caf\\u00e9",  "metadata": {"authors": ["a"]}}'
+    document = rawjson.PartialDocument(line, rawjson.parse_fields(["metadata.authors"]))
+    assert document.example() == {"metadata": {"authors": ["a"]}}
+    assert (
+        document.update({"metadata": {"authors": [["a", ""]]}})
+        == '{"text": "caf\\u00e9",  "metadata": {"authors": [["a",""]]}}'
+    )
+
+
+def test_update_adds_missing_members():
+    line = '{"text":"hi","metadata":{}}'
+    assert update(line, ("metadata.authors",), {"metadata": {"authors": []}}) == {
+        "text": "hi",
+        "metadata": {"authors": []},
+    }
+
+
+def test_non_object_intermediate_is_missing():
+    line = '{"text":"hi","metadata":null}'
+    document = rawjson.PartialDocument(line, rawjson.parse_fields(["metadata.authors"]))
+    assert document.example() == {}
+    # Nothing to write, so the line is unchanged.
+    assert document.update({}) == line
+    assert json.loads(document.update({"metadata": {"authors": []}})) == {
+        "text": "hi",
+        "metadata": {"authors": []},
+    }
@@ -1,10 +1,27 @@
-"""Shared Utilities related to scraping."""
+"""Shared Utilities related to scraping.
 
+Requests go through one `requests.Session` per process, so connections to a
+host are kept alive and reused instead of paying for a new TCP and TLS
+handshake on every page. `requests` only speaks HTTP/1.1, keep-alive is most of
+the win. Requests can also be rate limited per host with `set_rate_limit`.
+
+`download_all` fetches many pages to disk with asyncio instead, so each request
+in flight is a coroutine rather than a thread or process. It needs `aiohttp`.
+"""
+
+import asyncio
+import collections
+import contextlib
 import logging
-from typing import Dict, Optional
+import os
+import threading
+import time
+import urllib.parse
+from typing import Dict, Iterable, Optional, Tuple
 
 import requests
-from tenacity import retry, stop_after_attempt, wait_random_exponential
+from requests.adapters import HTTPAdapter
+from tenacity import AsyncRetrying, retry, stop_after_attempt, wait_random_exponential
 
 # A user agent that says we are compatible with most websites (most browsers
 # start with Mozilla/5.0) and also tells that we are a bot and includes a link
@@ -14,6 +31,103 @@ USER_AGENT = "Mozilla/5.0 (compatible; Common-Pile-bot/0.1; +http://www.github.c
 
 DEFAULT_HEADERS = {"User-Agent": USER_AGENT}
 
+# How many connections to keep open to each host, enough for a thread pool.
+POOL_SIZE = 16
+
+
+class TokenBucket:
+    """Allow `rate` requests a second on average, in bursts of up to `burst`.
+
+    Tokens are reserved, so callers that have to wait are spaced out by
+    1 / `rate` seconds instead of all waking up when the next token is ready.
+    """
+
+    def __init__(self, rate: float, burst: int = 1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self) -> float:
+        """Take a token, returns how long to wait before it can be used."""
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(
+                self.burst, self.tokens + (now - self.updated) * self.rate
+            )
+            self.updated = now
+            self.tokens -= 1
+            return max(0.0, -self.tokens / self.rate)
+
+    def acquire(self):
+        """Block until a request can be made."""
+        if (wait := self.reserve()) > 0:
+            time.sleep(wait)
+
+
+# host -> (requests per second, burst), the None host is the default for all.
+_RATE_LIMITS: Dict[Optional[str], Tuple[float, int]] = {}
+_SESSION: Optional[requests.Session] = None
+_BUCKETS: Dict[str, TokenBucket] = {}
+_STATE_LOCK = threading.Lock()
+
+
+def _reset_after_fork():
+    # Open connections and locks can't be shared with a forked process, it
+    # makes its own session and buckets. Rate limits are kept.
+    global _SESSION, _BUCKETS, _STATE_LOCK
+    _SESSION = None
+    _BUCKETS = {}
+    _STATE_LOCK = threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def get_session() -> requests.Session:
+    """The session for this process, it keeps connections alive between requests."""
+    global _SESSION
+    with _STATE_LOCK:
+        if _SESSION is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            _SESSION = session
+        return _SESSION
+
+
+def set_rate_limit(rate: Optional[float], burst: int = 1, host: Optional[str] = None):
+    """Limit requests to `host` (all hosts by default) to `rate` per second.
+
+    Limits are per process. They are inherited by forked processes, e.g. a
+    `multiprocessing.Pool` made after this is called, otherwise call this in
+    the pool's `initializer`. A `rate` of None removes the limit.
+    """
+    with _STATE_LOCK:
+        if rate is None:
+            _RATE_LIMITS.pop(host, None)
+        else:
+            _RATE_LIMITS[host] = (rate, burst)
+        # Buckets are remade with the new limit on their next use.
+        if host is None:
+            _BUCKETS.clear()
+        else:
+            _BUCKETS.pop(host, None)
+
+
+def rate_limiter(host: str) -> Optional[TokenBucket]:
+    """The token bucket for `host` in this process, None if it isn't limited."""
+    with _STATE_LOCK:
+        if (bucket := _BUCKETS.get(host)) is None:
+            limit = _RATE_LIMITS.get(host, _RATE_LIMITS.get(None))
+            if limit is None:
+                return None
+            bucket = _BUCKETS[host] = TokenBucket(*limit)
+        return bucket
+
 
 @retry(stop=stop_after_attempt(5), wait=wait_random_exponential(multiplier=1, max=30))
 def get_page(
@@ -26,7 +140,10 @@ def get_page(
     headers = headers if headers is not None else {}
     # Unpack the defaults first so the user provided ones can override them.
     headers = {**DEFAULT_HEADERS, **headers}
-    resp = requests.get(url, params=params, headers=headers)
+    # Each retry waits for the rate limit too.
+    if (bucket := rate_limiter(urllib.parse.urlsplit(url).netloc)) is not None:
+        bucket.acquire()
+    resp = get_session().get(url, params=params, headers=headers)
     logging.debug(f"Sending GET to {resp.url}")
     if resp.status_code != 200:
         # TODO: Update logger
@@ -35,3 +152,118 @@ def get_page(
         )
         raise RuntimeError(f"Failed request to {resp.url}")
     return resp
+
+
+async def _download(
+    session,
+    url: str,
+    path: str,
+    headers: Dict[str, str],
+    retries: int,
+    backoff: float,
+    chunk_size: int,
+):
+    """Stream `url` to `path`, it is written to a `.part` file and then renamed.
+
+    Writes go through `asyncio.to_thread`, so a slow disk doesn't stall the
+    other downloads. A `.part` file left by a failed download is removed.
+    """
+    host = urllib.parse.urlsplit(url).netloc
+    tmp_path = f"{path}.part"
+    try:
+        async for attempt in AsyncRetrying(
+            stop=stop_after_attempt(retries),
+            wait=wait_random_exponential(multiplier=backoff, max=30),
+            reraise=True,
+        ):
+            with attempt:
+                # Each retry waits for the rate limit too.
+                if (bucket := rate_limiter(host)) is not None:
+                    if (wait := bucket.reserve()) > 0:
+                        await asyncio.sleep(wait)
+                async with session.get(url, headers=headers) as resp:
+                    logging.debug(f"Sending GET to {resp.url}")
+                    if resp.status != 200:
+                        logging.warning(
+                            f"Failed request to {resp.url}: {resp.status}, {resp.reason}"
+                        )
+                        raise RuntimeError(f"Failed request to {resp.url}")
+                    wf = await asyncio.to_thread(open, tmp_path, "wb")
+                    try:
+                        async for chunk in resp.content.iter_chunked(chunk_size):
+                            await asyncio.to_thread(wf.write, chunk)
+                    finally:
+                        await asyncio.to_thread(wf.close)
+    except BaseException:
+        # Includes cancellation, so an interrupted run doesn't leave them.
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(tmp_path)
+        raise
+    # Only finished downloads get the real name, so a partial file is never
+    # mistaken for a finished one when resuming.
+    os.replace(tmp_path, path)
+
+
+async def download_all_async(
+    records: Iterable[Tuple[str, str]],
+    concurrency: int = 64,
+    per_host: int = 8,
+    overwrite: bool = False,
+    headers: Optional[Dict[str, str]] = None,
+    retries: int = 5,
+    backoff: float = 1,
+    timeout: float = 300,
+    chunk_size: int = 64 * 1024,
+) -> Dict[str, int]:
+    """Download each (url, destination) record, see `download_all`."""
+    import aiohttp
+
+    headers = {**DEFAULT_HEADERS, **(headers if headers is not None else {})}
+    counts = collections.Counter(downloaded=0, skipped=0, failed=0)
+    # The workers share one iterator, so records are read as they are needed,
+    # not all scheduled up front.
+    records = iter(records)
+
+    async def worker(session):
+        for url, path in records:
+            if not overwrite and os.path.exists(path):
+                logging.debug(f"{path} already exists, not downloading {url}")
+                counts["skipped"] += 1
+                continue
+            try:
+                await _download(
+                    session, url, path, headers, retries, backoff, chunk_size
+                )
+                counts["downloaded"] += 1
+            except Exception as e:
+                logging.error(f"Failed to fetch {url}: {e}")
+                counts["failed"] += 1
+
+    connector = aiohttp.TCPConnector(limit=concurrency, limit_per_host=per_host)
+    async with aiohttp.ClientSession(
+        connector=connector, timeout=aiohttp.ClientTimeout(total=timeout)
+    ) as session:
+        await asyncio.gather(*(worker(session) for _ in range(concurrency)))
+    return dict(counts)
+
+
+def download_all(records: Iterable[Tuple[str, str]], **kwargs) -> Dict[str, int]:
+    """Download many pages to disk, with at most `concurrency` requests in flight.
+
+    Args:
+      records: (url, destination path) pairs, read lazily.
+      concurrency: The number of requests in flight at once.
+      per_host: The number of requests in flight to a single host.
+      overwrite: Download pages that already exist at their destination,
+        otherwise they are skipped so an interrupted run can be resumed.
+      headers: Added to, or overriding, our default headers.
+      retries: How many times to try each page, backing off exponentially
+        (scaled by `backoff`) between tries like `get_page`.
+      timeout: Seconds a single request can take.
+      chunk_size: Pages are streamed to disk in chunks of this many bytes.
+
+    Requests follow the per-host rate limits from `set_rate_limit`. Failures
+    are logged and don't stop the other downloads. Returns the number of
+    pages that were downloaded, skipped, and failed.
+    """
+    return asyncio.run(download_all_async(records, **kwargs))
@@ -0,0 +1,117 @@
+"""Tests for downloading pages against a local http server."""
+
+import collections
+import http.server
+import os
+import threading
+import time
+
+import pytest
+
+from common_pile import scrape
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    # Paths -> how many times they were requested, shared with the tests.
+    requests = collections.Counter()
+
+    def do_GET(self):
+        self.requests[self.path] += 1
+        if self.path.startswith("/page/"):
+            self.reply(200, f"content of {self.path}".encode("utf-8"))
+        elif self.path == "/flaky" and self.requests[self.path] == 1:
+            self.reply(503, b"try again")
+        elif self.path == "/flaky":
+            self.reply(200, b"finally")
+        elif self.path == "/truncated":
+            # Promise more than we send, so the client sees the body end early.
+            self.send_response(200)
+            self.send_header("Content-Length", "1000")
+            self.end_headers()
+            self.wfile.write(b"only part of it")
+            self.close_connection = True
+        else:
+            self.reply(404, b"not found")
+
+    def reply(self, status, body):
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    Handler.requests.clear()
+    httpd = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{httpd.server_port}"
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def read(path):
+    with open(path) as f:
+        return f.read()
+
+
+def test_download_all(server, tmp_path):
+    records = [(f"{server}/page/{i}", str(tmp_path / f"{i}.html")) for i in range(20)]
+    counts = scrape.download_all(records, concurrency=4)
+    assert counts == {"downloaded": 20, "skipped": 0, "failed": 0}
+    for i in range(20):
+        assert read(tmp_path / f"{i}.html") == f"content of /page/{i}"
+
+
+def test_download_all_retries_failures(server, tmp_path):
+    records = [
+        (f"{server}/flaky", str(tmp_path / "flaky.html")),
+        (f"{server}/missing", str(tmp_path / "missing.html")),
+    ]
+    counts = scrape.download_all(records, retries=3, backoff=0.01)
+    assert counts == {"downloaded": 1, "skipped": 0, "failed": 1}
+    assert read(tmp_path / "flaky.html") == "finally"
+    assert Handler.requests["/flaky"] == 2
+    assert Handler.requests["/missing"] == 3
+    assert os.listdir(tmp_path) == ["flaky.html"]
+
+
+def test_download_all_skips_existing_pages(server, tmp_path):
+    (tmp_path / "0.html").write_text("from an earlier run")
+    records = [(f"{server}/page/{i}", str(tmp_path / f"{i}.html")) for i in range(2)]
+    counts = scrape.download_all(records)
+    assert counts == {"downloaded": 1, "skipped": 1, "failed": 0}
+    assert read(tmp_path / "0.html") == "from an earlier run"
+    assert Handler.requests["/page/0"] == 0
+    counts = scrape.download_all(records, overwrite=True)
+    assert counts == {"downloaded": 2, "skipped": 0, "failed": 0}
+    assert read(tmp_path / "0.html") == "content of /page/0"
+
+
+def test_download_all_removes_partial_files(server, tmp_path):
+    records = [(f"{server}/truncated", str(tmp_path / "truncated.html"))]
+    counts = scrape.download_all(records, retries=2, backoff=0.01)
+    assert counts == {"downloaded": 0, "skipped": 0, "failed": 1}
+    assert Handler.requests["/truncated"] == 2
+    assert os.listdir(tmp_path) == []
+
+
+def test_download_all_is_rate_limited(server, tmp_path):
+    host = server.removeprefix("http://")
+    scrape.set_rate_limit(20, host=host)
+    try:
+        records = [
+            (f"{server}/page/{i}", str(tmp_path / f"{i}.html")) for i in range(10)
+        ]
+        start = time.monotonic()
+        counts = scrape.download_all(records)
+        elapsed = time.monotonic() - start
+    finally:
+        scrape.set_rate_limit(None, host=host)
+    assert counts["downloaded"] == 10
+    # The first request uses the burst, the other 9 are 1/20s apart.
+    assert elapsed >= 9 / 20 * 0.9
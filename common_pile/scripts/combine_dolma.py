@@ -5,19 +5,22 @@ alignment of shards when multiple versions need to be combined.
 """
 
 import argparse
+import collections
 import contextlib
 import copy
 import glob
+import itertools
 import json
+import multiprocessing as mp
 import os
-from typing import Dict, List
+from functools import partial
+from typing import Dict, List, Tuple
 
 import contextual_logger
-import smart_open
 
-from common_pile import utils
+from common_pile import index, parallel, split, utils
 from common_pile.logs import configure_logging, get_logger
-from common_pile.write import shard_name
+from common_pile.write import ShardWriter, SizePolicy, shard_name
 
 parser = argparse.ArgumentParser(
     description="Combine many dolma files into one. "
@@ -40,6 +43,13 @@ parser.add_argument("--filename", help="The name to give the combined shards.")
 parser.add_argument(
     "--shard_size", type=int, default=1, help="The size each combined shard will be."
 )
+parser.add_argument(
+    "--size_policy",
+    choices=[p.value for p in SizePolicy],
+    default=SizePolicy.BYTES.value,
+    help="How shard size is measured, uncompressed bytes, compressed bytes, or "
+    "documents (then --shard_size is a document count instead of GB).",
+)
 parser.add_argument(
     "--shard_to_files", help="A path to a shard -> source file mapping."
 )
@@ -47,11 +57,34 @@ parser.add_argument(
     "--shard_to_first_id", help="A path to a shard -> starting id mapping."
 )
 parser.add_argument("--shard_to_last_id", help="A path to a shard -> final id mapping.")
+parser.add_argument(
+    "--processes",
+    type=int,
+    default=1,
+    help="Build shards in parallel with this many workers, the maps are the "
+    "same as a serial run.",
+)
+
 
+def read_dolma_lines(path):
+    """Read the raw json lines from `path`, examples are copied without decoding
+    them so the output is byte for byte the same as the input."""
+    with utils.open_dolma(path) as f:
+        yield from (l.rstrip("\n") for l in f if l)
 
-def read_dolma_file(path):
-    with smart_open.open(path) as f:
-        yield from (json.loads(l) for l in f if l)
+
+def read_dolma_lines_from(path, first_id):
+    """Read lines from `path`, starting at `first_id` if the file is indexed.
+
+    Without an index (or if `first_id` isn't in the file) this reads the whole
+    file, the caller still needs to skip up to `first_id`.
+    """
+    if index.has_index(path):
+        with index.IndexedShard(path, build=False) as shard:
+            if (start := shard.position(first_id)) is not None:
+                yield from shard.lines(start)
+                return
+    yield from read_dolma_lines(path)
 
 
 def combine_dolma_files(
@@ -60,12 +93,32 @@ def combine_dolma_files(
     filename: str,
     shard_size: int = 1,
     quiet: bool = False,
+    size_policy: SizePolicy = SizePolicy.BYTES,
+    processes: int = 1,
 ):
+    """Copy the examples under `input_dir` into shards of about `shard_size`.
+
+    With `processes` > 1 this is done in parallel phases, see
+    `combine_dolma_files_parallel`.
+    """
     logger = get_logger()
     # Make sure the input_dir ends with documents
     input_dir = utils.dolma_output(input_dir)
-    # Find all .jsonl.gz files under input_dir
-    files = glob.iglob(os.path.join(input_dir, "**", "*.jsonl.gz"), recursive=True)
+    # Find all .jsonl.gz (or .jsonl.zst) files under input_dir
+    files = itertools.chain.from_iterable(
+        glob.iglob(os.path.join(input_dir, "**", pattern), recursive=True)
+        for pattern in utils.DOLMA_PATTERNS
+    )
+    if processes > 1:
+        return combine_dolma_files_parallel(
+            list(files),
+            input_dir,
+            output_dir,
+            filename,
+            shard_size,
+            size_policy,
+            processes,
+        )
     # Make sure output_dir ends with /documents
     logger.info(
         "Combining dolma shards into larger files, writing results to %s", output_dir
@@ -76,8 +129,8 @@ def combine_dolma_files(
     os.makedirs(output_dir, exist_ok=True)
 
     shard_idx = 0
-    size = 0
-    max_bytes = shard_size * 1000 * 1000 * 1000
+    size_policy = SizePolicy(size_policy)
+    max_size = size_policy.max_size(shard_size)
 
     # Convert shard n to -> 0000n_{filename}
     shard = shard_name(filename, shard_idx)
@@ -96,7 +149,7 @@ def combine_dolma_files(
 
     shard_file = os.path.join(output_dir, shard)
     with contextlib.ExitStack() as stack:
-        wf = stack.enter_context(smart_open.open(shard_file, "w"))
+        wf = stack.enter_context(ShardWriter(shard_file, size_policy))
         stack.enter_context(logger(shard=shard_file))
         for dolma_file in files:
             # Only save the part relative to the root, this lets us find this
@@ -106,14 +159,12 @@ def combine_dolma_files(
                 "Starting to copy examples from %s into %s", dolma_file, shard_file
             )
             # Read example (via iterator) so we don't have them all in memory
-            # at once.
-            for example in read_dolma_file(dolma_file):
-                # Serialize the data
-                data = json.dumps(example)
-                # Check if the new data will go over the size limit.
-                size += len(data)
-                # We need to make a new shard.
-                if size >= max_bytes:
+            # at once. Only the id is decoded, the line is copied as is.
+            for data in read_dolma_lines(dolma_file):
+                eid = index.line_id(data)
+                # Check if the new data will go over the size limit, if so we
+                # need to make a new shard.
+                if wf.full(data, max_size):
                     logger.close()
                     # Close the last shard, note that the /current/ data is *not*
                     # part of the just closed shard.
@@ -134,13 +185,11 @@ def combine_dolma_files(
                     shard_idx += 1
                     shard = shard_name(filename, shard_idx)
                     shard_file = os.path.join(output_dir, shard)
-                    wf = stack.enter_context(smart_open.open(shard_file, "w"))
+                    wf = stack.enter_context(ShardWriter(shard_file, size_policy))
                     stack.enter_context(logger(shard=shard_file))
                     logger.info(
                         "Shard size exceeded, creating new shard at %s", shard_file
                     )
-                    # Reset size checker
-                    size = 0
                     # Reset the active files to be empty, as long as the next
                     # data item is written, the current file will get added to
                     # the list.
@@ -156,12 +205,12 @@ def combine_dolma_files(
                 # Write the data and update the last_id to point to this item,
                 # which will become the previous item in the next iteration of
                 # the loop
-                wf.write(data + "\n")
-                last_id = example["id"]
+                wf.write(data, eid)
+                last_id = eid
                 # We only let the first id be written once per shard, by the
                 # first example that was output.
                 if first_id is None:
-                    first_id = example["id"]
+                    first_id = eid
                 # Only add the current file to the active for this shard list
                 # if the current bit of data is actually written to it. By doing
                 # this /after/ the data is written, we avoid having a false
@@ -188,13 +237,190 @@ def combine_dolma_files(
     return shard_to_files, shard_to_first_id, shard_to_last_id
 
 
+def measure_dolma_file(path: str, size_policy: SizePolicy) -> Tuple[List, List[int]]:
+    """The ids of the examples in `path` and how much each adds to a shard."""
+    ids, sizes = [], []
+    for line in read_dolma_lines(path):
+        ids.append(index.line_id(line))
+        sizes.append(size_policy.measure(line))
+    return ids, sizes
+
+
+def plan_shards(
+    files: List[str],
+    input_dir: str,
+    filename: str,
+    shard_size: int = 1,
+    size_policy: SizePolicy = SizePolicy.BYTES,
+    processes: int = 1,
+):
+    """Work out which examples go into which shard, without writing anything.
+
+    The files are measured in parallel, then the shard boundaries are found
+    with the same size check `combine_dolma_files` uses, so the maps are
+    identical to a serial run. Returns the maps and, for each shard, the
+    (file, start, stop) ranges of examples that go into it.
+    """
+    logger = get_logger()
+    size_policy = SizePolicy(size_policy)
+    if size_policy is SizePolicy.COMPRESSED:
+        raise ValueError(
+            "Shards can't be planned by compressed size, it is only known once "
+            "they are written, use a serial combine instead."
+        )
+    max_size = size_policy.max_size(shard_size)
+    shard_to_files, shard_to_first_id, shard_to_last_id = {}, {}, {}
+    shard_to_ranges = {}
+    shard_idx = 0
+    shard = shard_name(filename, shard_idx)
+    ranges = []
+    documents = 0
+    size = 0
+    first_id = last_id = None
+
+    def finish_shard():
+        shard_to_files[shard] = [rel_dolma for rel_dolma, _, _ in ranges]
+        shard_to_first_id[shard] = first_id
+        shard_to_last_id[shard] = last_id
+        shard_to_ranges[shard] = ranges
+        logger.info("Shard %s made from %s up to %s", shard, ranges, last_id)
+
+    with mp.get_context("spawn").Pool(processes) as pool:
+        # Files are measured in parallel, the results come back in order.
+        measured = parallel.bounded_imap(
+            partial(measure_dolma_file, size_policy=size_policy),
+            files,
+            pool=pool,
+            processes=processes,
+        )
+        for (ids, sizes), dolma_file in zip(measured, files):
+            rel_dolma = os.path.relpath(dolma_file, input_dir)
+            start = 0
+            for i, (eid, example_size) in enumerate(zip(ids, sizes)):
+                if documents and size + example_size > max_size:
+                    if i > start:
+                        ranges.append((rel_dolma, start, i))
+                    finish_shard()
+                    shard_idx += 1
+                    shard = shard_name(filename, shard_idx)
+                    ranges = []
+                    start = i
+                    documents = 0
+                    size = 0
+                    first_id = None
+                documents += 1
+                size += example_size
+                last_id = eid
+                if first_id is None:
+                    first_id = eid
+            if len(ids) > start:
+                ranges.append((rel_dolma, start, len(ids)))
+    if ranges:
+        finish_shard()
+    return shard_to_files, shard_to_first_id, shard_to_last_id, shard_to_ranges
+
+
+def copy_file_ranges(
+    input_dir: str,
+    size_policy: SizePolicy,
+    task: Tuple[str, List[Tuple[str, int, int]]],
+) -> str:
+    """Copy (part, start, stop) ranges of examples from one file, phase two.
+
+    The ranges are in file order, so the file is only read once however many
+    shards it is split across.
+    """
+    rel_dolma, ranges = task
+    lines = read_dolma_lines(os.path.join(input_dir, rel_dolma))
+    position = 0
+    for part, start, stop in ranges:
+        # Ranges cover every example, so this normally skips nothing.
+        collections.deque(itertools.islice(lines, start - position), maxlen=0)
+        with ShardWriter(part, size_policy) as wf:
+            for line in itertools.islice(lines, stop - start):
+                wf.write(line)
+        position = stop
+    lines.close()
+    return rel_dolma
+
+
+def merge_shard(size_policy: SizePolicy, task: Tuple[str, List[str]]) -> str:
+    """Append the parts of a shard, in order, into the shard."""
+    shard, parts = task
+    if parts:
+        split.merge_parts(parts, shard)
+    else:
+        # Match the serial combine, which always creates the first shard.
+        ShardWriter(shard, size_policy).close()
+    return shard
+
+
+def combine_dolma_files_parallel(
+    files: List[str],
+    input_dir: str,
+    output_dir: str,
+    filename: str,
+    shard_size: int = 1,
+    size_policy: SizePolicy = SizePolicy.BYTES,
+    processes: int = mp.cpu_count(),
+):
+    """`combine_dolma_files` in phases that each use `processes` workers.
+
+    First the shards are planned from the ids and sizes of each file, see
+    `plan_shards`. Then each file is read once by a worker that copies its
+    ranges of examples into parts of the shards they belong to, and finally
+    the parts of each shard are appended together.
+    """
+    logger = get_logger()
+    size_policy = SizePolicy(size_policy)
+    output_dir = utils.dolma_output(output_dir)
+    os.makedirs(output_dir, exist_ok=True)
+    logger.info("Planning shards for %d files", len(files))
+    *maps, shard_to_ranges = plan_shards(
+        files, input_dir, filename, shard_size, size_policy, processes
+    )
+    if not shard_to_ranges:
+        shard_to_ranges[shard_name(filename, 0)] = []
+    file_ranges = collections.defaultdict(list)
+    shard_parts = {}
+    for shard, ranges in shard_to_ranges.items():
+        shard_path = os.path.join(output_dir, shard)
+        shard_parts[shard_path] = []
+        for k, (rel_dolma, start, stop) in enumerate(ranges):
+            part = split.part_path(shard_path, k)
+            file_ranges[rel_dolma].append((part, start, stop))
+            shard_parts[shard_path].append(part)
+    logger.info(
+        "Writing %d shards from %d files to %s",
+        len(shard_parts),
+        len(file_ranges),
+        output_dir,
+    )
+    with mp.get_context("spawn").Pool(processes) as pool:
+        for rel_dolma in pool.imap_unordered(
+            partial(copy_file_ranges, input_dir, size_policy),
+            file_ranges.items(),
+        ):
+            logger.info("Copied %s", rel_dolma)
+        for shard in pool.imap_unordered(
+            partial(merge_shard, size_policy), shard_parts.items()
+        ):
+            logger.info("Finished shard %s", shard)
+    return tuple(maps)
+
+
 def combine_dolma_with_shard_info(
     input_dir: str,
     output_dir: str,
     shard_to_files: Dict[str, List[str]],
     shard_to_first_id: Dict[str, str],
     shard_to_last_id: Dict[str, str],
+    processes: int = 1,
 ):
+    """Rebuild the shards described by the maps from `combine_dolma_files`.
+
+    With `processes` > 1 the shards are built concurrently.
+    """
     logger = get_logger()
     # Ensure both paths end with /documents
     input_dir = utils.dolma_output(input_dir)
@@ -202,50 +428,87 @@ def combine_dolma_with_shard_info(
     # Make sure the dir exists, the combining process removes any dir structure
     # from the input dir tree so we only need to make this file.
     os.makedirs(output_dir, exist_ok=True)
+    if processes > 1:
+        # Each shard is independent given the maps, so build them concurrently.
+        with mp.get_context("spawn").Pool(processes) as pool:
+            for shard in pool.imap_unordered(
+                partial(_fill_shard, input_dir, output_dir),
+                [
+                    (shard, files, shard_to_first_id[shard], shard_to_last_id[shard])
+                    for shard, files in shard_to_files.items()
+                ],
+            ):
+                logger.info("Finished shard %s", shard)
+        return
     # Iterate though the output shards we should generate.
     for shard, files in shard_to_files.items():
-        with logger(shard=shard):
-            logger.info("Starting to populate shard")
-            # Find the last id in the last file that we should write to this shard.
-            last_id = shard_to_last_id[shard]
-            # Find the first id in the first file that we should write to this shard.
-            first_id = shard_to_first_id[shard]
-            # Create the new shard.
-            with smart_open.open(
-                os.path.join(utils.dolma_output(output_dir), shard), "w"
-            ) as wf:
-                # Are we skipping through the starting examples because they
-                # were in an earlier shard?
-                skipping = True
-                # Iterate through the files that contributed to this shard.
-                for dolma_file in files:
-                    with logger(source=dolma_file):
-                        logger.info("Filling shard from new source.")
-                        # Write each example to the shard
-                        for example in read_dolma_file(
-                            os.path.join(input_dir, dolma_file)
-                        ):
-                            if (eid := example["id"]) == first_id:
-                                logger.info(
-                                    "Found first id in the first source file, start to fill",
-                                    extra={"first_id": first_id},
-                                )
-                                skipping = False
-                            if skipping:
-                                logger.debug(
-                                    "Skipping example, it was in the last shard.",
-                                    extra={"id": eid},
-                                )
-                                continue
-                            wf.write(json.dumps(example) + "\n")
-                            # If we are writing the final open file, stop after we write
-                            # the example with the final id.
-                            if dolma_file == files[-1] and eid == last_id:
-                                logger.info(
-                                    "Found last id in final source file, closing shard.",
-                                    extra={"last_id": last_id},
-                                )
-                                break
+        fill_shard(
+            input_dir,
+            output_dir,
+            shard,
+            files,
+            shard_to_first_id[shard],
+            shard_to_last_id[shard],
+        )
+
+
+def fill_shard(
+    input_dir: str,
+    output_dir: str,
+    shard: str,
+    files: List[str],
+    first_id: str,
+    last_id: str,
+):
+    """Populate `shard` with the examples from `first_id` in the first of `files`
+    up to and including `last_id` in the last."""
+    logger = get_logger()
+    with logger(shard=shard):
+        logger.info("Starting to populate shard")
+        # Create the new shard.
+        with ShardWriter(os.path.join(output_dir, shard)) as wf:
+            # Are we skipping through the starting examples because they
+            # were in an earlier shard?
+            skipping = True
+            # Iterate through the files that contributed to this shard.
+            for dolma_file in files:
+                with logger(source=dolma_file):
+                    logger.info("Filling shard from new source.")
+                    # Write each example to the shard, jumping straight to
+                    # the first id when the source has an index.
+                    source = os.path.join(input_dir, dolma_file)
+                    for line in (
+                        read_dolma_lines_from(source, first_id)
+                        if skipping
+                        else read_dolma_lines(source)
+                    ):
+                        if (eid := index.line_id(line)) == first_id:
+                            logger.info(
+                                "Found first id in the first source file, start to fill",
+                                extra={"first_id": first_id},
+                            )
+                            skipping = False
+                        if skipping:
+                            logger.debug(
+                                "Skipping example, it was in the last shard.",
+                                extra={"id": eid},
+                            )
+                            continue
+                        wf.write(line, eid)
+                        # If we are writing the final open file, stop after we write
+                        # the example with the final id.
+                        if dolma_file == files[-1] and eid == last_id:
+                            logger.info(
+                                "Found last id in final source file, closing shard.",
+                                extra={"last_id": last_id},
+                            )
+                            break
+
+
+def _fill_shard(input_dir: str, output_dir: str, task) -> str:
+    shard, files, first_id, last_id = task
+    fill_shard(input_dir, output_dir, shard, files, first_id, last_id)
+    return shard
 
 
 def read_shard_file(path):
@@ -274,7 +537,12 @@ def main():
             )
         logger.info("Combining files into shards and tracking which go where.")
         shard_to_files, shard_to_first_id, shard_to_last_id = combine_dolma_files(
-            args.input, args.output, args.filename, args.shard_size
+            args.input,
+            args.output,
+            args.filename,
+            args.shard_size,
+            size_policy=args.size_policy,
+            processes=args.processes,
         )
         logger.info("Created %d new larger shards", len(shard_to_files))
         logger.info(
@@ -290,7 +558,12 @@ def main():
         shard_to_first_id = read_shard_file(args.shard_to_first_id)
         shard_to_last_id = read_shard_file(args.shard_to_last_id)
         combine_dolma_with_shard_info(
-            args.input, args.output, shard_to_files, shard_to_first_id, shard_to_last_id
+            args.input,
+            args.output,
+            shard_to_files,
+            shard_to_first_id,
+            shard_to_last_id,
+            processes=args.processes,
         )
     else:
         raise ValueError(
@@ -1,25 +1,34 @@
-"""Compare data in the dolma format across different preprocessing stages."""
+"""Compare data in the dolma format across different preprocessing stages.
 
-import collections
+Run with `streamlit run compare_data.py` to browse examples side by side, or
+headless, `python compare_data.py --old ... --new ... --output report.json`,
+for a summary of what changed across every example.
+"""
+
+import argparse
 import glob
 import json
-import random
+import multiprocessing as mp
 import textwrap
 from enum import Enum
 
-import smart_open
-import streamlit as st
+from common_pile import compare, utils
+from common_pile.logs import configure_logging, get_logger
 
-from common_pile import utils
+Error = Enum("Error", "BOTH OLD NEW NO_OLD NO_NEW UNINDEXED")
 
-st.set_page_config(page_title="Compare", layout="wide")
-st.title("Compare different versions of dolma formatted data.")
 
-Index = collections.namedtuple("Index", ["old", "new"])
-Error = Enum("Error", "BOTH OLD NEW NO_OLD NO_NEW")
+def in_streamlit() -> bool:
+    """Is this being run by `streamlit run`, streamlit is only needed then."""
+    try:
+        from streamlit import runtime
+    except ImportError:
+        return False
+    return runtime.exists()
 
 
-@st.cache_data
+# The data isn't copied into the cache, we keep the open (indexed) datasets
+# around for the whole session, examples are only read when they are shown.
 def load_data(old, new):
     if not (old and new):
         error = Error.BOTH
@@ -27,188 +36,25 @@ def load_data(old, new):
             error = Error.NEW
         elif not old and new:
             error = Error.OLD
-        return (None, None, None, None, None, None, None), error
+        return None, error
     # Allow users to do things like glob for shard, specify dirs, or single files.
-    old = utils.dolma_input(old)
-    new = utils.dolma_input(new)
-
-    old_data = []
-    old_files = glob.glob(old)
-    if not old_files:
-        return (None, None, None, None, None, None, None), Error.NO_OLD
-    for o in old_files:
-        with smart_open.open(o) as f:
-            old_data.extend([json.loads(l) for l in f if l])
-
-    new_data = []
-    new_files = glob.glob(new)
+    old_files = glob.glob(utils.dolma_input(old))
     if not old_files:
-        return (None, None, None, None, None, None, None), Error.NO_NEW
-    for n in new_files:
-        with smart_open.open(n) as f:
-            new_data.extend([json.loads(l) for l in f if l])
-    # These are the names in the original iteration of the script, didn't seem
-    # worth changing it everywhere, just rename the data lists.
-    old = old_data
-    new = new_data
-
-    # Index of example_id -> position in dataset
-    old_idx = {o["id"]: i for i, o in enumerate(old)}
-    new_idx = {n["id"]: i for i, n in enumerate(new)}
-    # The ids aren't ordered so we can't to a posting merge like an inverted index
-    # Convert to a set as we will do a lot of `in` queries.
-    new_k = set(new_idx.keys())
-    # Find the intersection by iterating though the old idx and checking if that
-    # example is also in the new index, this will maintain the order as if we
-    # are looking line-by-line in the old files while making sure that the two
-    # documents are aligned when accessed by position (in the case of a record
-    # being deleted via preprocessing the new data might not be in the same spot
-    # in the file). Remove examples that don't appear in the new data.
+        return None, Error.NO_OLD
+    new_files = glob.glob(utils.dolma_input(new))
+    if not new_files:
+        return None, Error.NO_NEW
+    # This builds the id -> (file, offset) `.idx` index next to each shard that
+    # doesn't have one yet, later runs reuse them. Examples are aligned by id,
+    # in the order of the old files, and examples removed during preprocessing
+    # are skipped.
     # TODO: Add configuration option to keep examples that become nothing for
     #       preprocessing failure analysis.
-    both = [k for k in old_idx if k in new_k]
-    index = {k: Index(old_idx[k], new_idx[k]) for k in both}
-
-    # When paging though examples by position (next/prev) this maps the position
-    # to the id of an example
-    by_position = list(index.keys())
-    # When you jump to a given id, this can be used to find the logical position
-    # of that example as if you hit next/back a bunch. Note: This position need
-    # not be related to the position in the old/new example list.
-    by_id = {k: i for i, k in enumerate(by_position)}
-    # Create a mapping from ids to title for easier exploration.
-    id_to_title = {
-        id: title
-        for id, idx in index.items()
-        if (title := new[idx.new].get("metadata", {}).get("title"))
-    }
-    # Reverse mapping for easy sync of values.
-    title_to_id = {t: i for i, t in id_to_title.items()}
-
-    # old: A list of examples
-    # new: A list of examples
-    # index: A Dict mapping id: str -> (position in old, position in new)
-    return (old, new, index, by_position, by_id, id_to_title, title_to_id), None
-
-
-messages = st.text("Enter file paths to begin.")
-
-config = st.expander("config", expanded=True)
-with config:
-    old_path = st.text_input(label="Old Data")
-    new_path = st.text_input(label="New Data")
-
-    data_load_state = st.text(
-        f"Loading data from:\n\told data: {old_path}\n\tnew data: {new_path}"
-    )
-
-    messages.text("Loading...")
-    (old, new, index, by_position, by_id, id_to_title, title_to_id), error = load_data(
-        old_path, new_path
-    )
-
-    if error is not None:
-        if error is Error.OLD:
-            messages.text("Old file path required too.")
-        elif error is Error.NEW:
-            messages.text("New file path required too.")
-        elif error is Error.BOTH:
-            messages.text("Enter file paths to begin.")
-        elif error is Error.NO_OLD:
-            messages.text(f"Cannot find any files with {old}.")
-        elif error is Error.NO_NEW:
-            messages.text(f"Cannot find any files with {new}.")
-        exit()
-
-    data_load_state.text(f"Loaded {len(old)} examples")
-    messages.text(f"Loaded {len(old)} examples.")
-
-    # Display Configuration
-    wrap_width = st.number_input("Wrap Width:", value=88, key="width")
-    to_wrap = st.checkbox("Wrap?", value=True)
-    container_height = st.number_input("Text Hight:", value=500, key="height")
-
-if "index" not in st.session_state:
-    st.session_state.index = 0
-if "id" not in st.session_state:
-    st.session_state.id = by_position[st.session_state.index]
-# Don't set this here, as it will be set with the value of the number input.
-# if "width" not in st.session_state:
-#     st.session_state.width = 88
-# if "height" not in st.session_state:
-#     st.session_state.width = 500
-
-
-##
-# These function all use the global indices like by_position, etc. This is bad
-# practice but this is a pretty self-contained/one-off script.
-def update_index(i):
-    # Don't go outside the bounds.
-    if st.session_state.index == 0 and i < 0:
-        return
-    if st.session_state.index == len(by_position) - 1 and i > 0:
-        return
-    # We hit next/prev, so update the position.
-    st.session_state.index += i
-    # Now convert that position into an id
-    st.session_state.id = by_position[st.session_state.index]
-    if id_to_title:
-        st.session_state.title = id_to_title[st.session_state.id]
-
-
-def set_index(i):
-    st.session_state.index = i
-    st.session_state.id = by_position[st.session_state.index]
-    if id_to_title:
-        st.session_state.title = id_to_title[st.session_state.id]
-
-
-def fix_by_id():
-    # When the id is updated by a widget, make sure the index is updated to the
-    # correct position.
-    st.session_state.index = by_id[st.session_state.id]
-    if id_to_title:
-        st.session_state.title = id_to_title[st.session_state.id]
-
-
-def fix_by_index():
-    # When the position is updated by a widget, make sure the id is updated too.
-    st.session_state.id = by_position[st.session_state.index]
-    if id_to_title:
-        st.session_state.title = id_to_title[st.session_state.id]
-
-
-def fix_by_title():
-    if id_to_title:
-        id = title_to_id[st.session_state.title]
-        st.session_state.id = id
-        st.session_state.index = by_id[st.session_state.id]
-
-
-# Display the controls
-b1, b2 = st.columns(2)
-# Previous and Next Buttons
-with b1:
-    st.button("prev", on_click=update_index, args=[-1])
-    st.button("next", on_click=update_index, args=[1])
-    # random.randint is inclusive :/
-    st.button(
-        "random", on_click=set_index, args=[random.randint(0, len(by_position) - 1)]
-    )
-# Jump around widgets
-with b2:
-    index_input = st.number_input(
-        "Index:",
-        min_value=0,
-        max_value=len(by_position) - 1,
-        on_change=fix_by_index,
-        key="index",
-    )
-    id_input = st.selectbox("Id:", options=by_position, on_change=fix_by_id, key="id")
-    if id_to_title:
-        title_input = st.selectbox(
-            "Title:", options=title_to_id.keys(), on_change=fix_by_title, key="title"
-        )
+    try:
+        return compare.AlignedDatasets(old_files, new_files), None
+    except ValueError:
+        # zstd files need a seek table to be indexed, gzip files always work.
+        return None, Error.UNINDEXED
 
 
 def wrap(text, width=88):
@@ -232,37 +78,205 @@ def wrap(text, width=88):
     return "\n".join(map(str.strip, new_lines))
 
 
-# Display the examples
-old_col, new_col = st.columns(2)
-
-with old_col:
-    st.subheader("Old Text")
-    # Creating a container sets the height of it, this forces a scroll wheel that
-    # /only/ moves the text in this box. This makes it easy to scroll the two
-    # examples independently and align related sections.
-    with st.container(height=st.session_state.height):
-        # Get the text from the list based on the id -> position mapping, not the
-        # position of the cursor of the "next/prev" buttons.
-        text = old[index[st.session_state.id].old]["text"]
-        # Use st.text as `st.write` and `st.markdown` use markdown rules, removing
-        # single newlines and only counting doubles as new paragraphs. Text lets us
-        # keeep these newlines, but it the reason we needed our own wrap function.
-        if to_wrap:
-            st.text(wrap(text, st.session_state.width))
-        else:
-            st.text(text)
-
-# Same comments as above, but we index into the list of /new/ examples.
-with new_col:
-    st.subheader("New Text")
-    with st.container(height=st.session_state.height):
-        text = new[index[st.session_state.id].new]["text"]
-        if to_wrap:
-            st.text(wrap(text, st.session_state.width))
-        else:
-            st.text(text)
+def app():
+    import streamlit as st
+
+    st.set_page_config(page_title="Compare", layout="wide")
+    st.title("Compare different versions of dolma formatted data.")
 
-# Show the metadata for the example. We don't expect it to change much so we just
-# show it for the new version.
-st.header("Metadata")
-st.json(old[index[st.session_state.id].new]["metadata"], expanded=False)
+    messages = st.text("Enter file paths to begin.")
+
+    config = st.expander("config", expanded=True)
+    with config:
+        old_path = st.text_input(label="Old Data")
+        new_path = st.text_input(label="New Data")
+
+        data_load_state = st.text(
+            f"Loading data from:\n\told data: {old_path}\n\tnew data: {new_path}"
+        )
+
+        messages.text("Loading...")
+        data, error = st.cache_resource(load_data)(old_path, new_path)
+
+        if error is not None:
+            if error is Error.OLD:
+                messages.text("Old file path required too.")
+            elif error is Error.NEW:
+                messages.text("New file path required too.")
+            elif error is Error.BOTH:
+                messages.text("Enter file paths to begin.")
+            elif error is Error.NO_OLD:
+                messages.text(f"Cannot find any files with {old_path}.")
+            elif error is Error.NO_NEW:
+                messages.text(f"Cannot find any files with {new_path}.")
+            elif error is Error.UNINDEXED:
+                messages.text(
+                    "Cannot index the data, zstd files need a seek table, i.e. to be "
+                    "written by `common_pile.write.ShardWriter`."
+                )
+            return
+
+        data_load_state.text(f"Loaded {len(data)} examples")
+        messages.text(f"Loaded {len(data)} examples.")
+
+        # Display Configuration
+        wrap_width = st.number_input("Wrap Width:", value=88, key="width")
+        to_wrap = st.checkbox("Wrap?", value=True)
+        container_height = st.number_input("Text Hight:", value=500, key="height")
+
+    if not len(data):
+        messages.text("None of the old examples are in the new data.")
+        return
+
+    if "index" not in st.session_state:
+        st.session_state.index = 0
+    if "id" not in st.session_state:
+        st.session_state.id = str(data.id(st.session_state.index))
+    # Don't set this here, as it will be set with the value of the number input.
+    # if "width" not in st.session_state:
+    #     st.session_state.width = 88
+    # if "height" not in st.session_state:
+    #     st.session_state.width = 500
+
+    # These callbacks all use the data loaded above.
+    def update_index(i):
+        # Don't go outside the bounds.
+        if st.session_state.index == 0 and i < 0:
+            return
+        if st.session_state.index == len(data) - 1 and i > 0:
+            return
+        # We hit next/prev, so update the position.
+        st.session_state.index += i
+        # Now convert that position into an id
+        st.session_state.id = str(data.id(st.session_state.index))
+
+    def set_random_index():
+        st.session_state.index = data.sample()
+        st.session_state.id = str(data.id(st.session_state.index))
+
+    def fix_by_id():
+        # When the id is updated by a widget, make sure the index is updated to
+        # the correct position.
+        if (i := data.find(st.session_state.id)) is None:
+            messages.text(f"Cannot find an example with id {st.session_state.id}.")
+            st.session_state.id = str(data.id(st.session_state.index))
+            return
+        st.session_state.index = i
+
+    def fix_by_index():
+        # When the position is updated by a widget, make sure the id is updated too.
+        st.session_state.id = str(data.id(st.session_state.index))
+
+    # Display the controls
+    b1, b2 = st.columns(2)
+    # Previous and Next Buttons
+    with b1:
+        st.button("prev", on_click=update_index, args=[-1])
+        st.button("next", on_click=update_index, args=[1])
+        st.button("random", on_click=set_random_index)
+    # Jump around widgets
+    with b2:
+        index_input = st.number_input(
+            "Index:",
+            min_value=0,
+            max_value=len(data) - 1,
+            on_change=fix_by_index,
+            key="index",
+        )
+        # There can be too many ids to list them all, so they are typed in.
+        id_input = st.text_input("Id:", on_change=fix_by_id, key="id")
+
+    # Only the example being shown is read from disk.
+    old_example, new_example = data[st.session_state.index]
+    if title := (new_example.get("metadata") or {}).get("title"):
+        st.subheader(title)
+
+    # Display the examples
+    old_col, new_col = st.columns(2)
+
+    with old_col:
+        st.subheader("Old Text")
+        # Creating a container sets the height of it, this forces a scroll wheel
+        # that /only/ moves the text in this box. This makes it easy to scroll the
+        # two examples independently and align related sections.
+        with st.container(height=st.session_state.height):
+            text = old_example["text"]
+            # Use st.text as `st.write` and `st.markdown` use markdown rules,
+            # removing single newlines and only counting doubles as new
+            # paragraphs. Text lets us keeep these newlines, but it the reason we
+            # needed our own wrap function.
+            if to_wrap:
+                st.text(wrap(text, st.session_state.width))
+            else:
+                st.text(text)
+
+    # Same comments as above, but for the /new/ example.
+    with new_col:
+        st.subheader("New Text")
+        with st.container(height=st.session_state.height):
+            text = new_example["text"]
+            if to_wrap:
+                st.text(wrap(text, st.session_state.width))
+            else:
+                st.text(text)
+
+    # Show the metadata for the example. We don't expect it to change much so we
+    # just show it for the new version.
+    st.header("Metadata")
+    st.json(new_example.get("metadata", {}), expanded=False)
+
+
+def main():
+    mp.set_start_method("spawn")
+    parser = argparse.ArgumentParser(
+        description="Summarize what changed between two versions of dolma data."
+    )
+    parser.add_argument("--old", required=True, help="The old dolma data.")
+    parser.add_argument("--new", required=True, help="The new dolma data.")
+    parser.add_argument("--output", help="Where to save the summary as json.")
+    parser.add_argument("--html", help="Where to save the summary as a html page.")
+    parser.add_argument(
+        "--processes",
+        type=int,
+        default=mp.cpu_count(),
+        help="Number of processors for multicore.",
+    )
+    parser.add_argument(
+        "--top",
+        type=int,
+        default=50,
+        help="How many of the most common removed and added lines to show.",
+    )
+    args = parser.parse_args()
+    configure_logging()
+    logger = get_logger()
+
+    old_files = glob.glob(utils.dolma_input(args.old))
+    new_files = glob.glob(utils.dolma_input(args.new))
+    if not old_files or not new_files:
+        raise ValueError(
+            f"Cannot find files with {args.old if not old_files else args.new}."
+        )
+    stats = compare.diff_datasets(old_files, new_files, processes=args.processes)
+    summary = stats.summary(args.top)
+    logger.info(
+        "%d/%d examples changed, %d dropped, %d added",
+        summary["changed"],
+        summary["aligned"],
+        summary["dropped"],
+        summary["added"],
+    )
+    if args.output:
+        with open(args.output, "w") as wf:
+            json.dump(summary, wf, indent=2)
+    if args.html:
+        with open(args.html, "w") as wf:
+            wf.write(compare.summary_html(summary, f"{args.old} vs {args.new}"))
+
+
+# Diff workers are spawned, so they import this file too, only the main
+# process should do anything.
+if in_streamlit():
+    app()
+elif __name__ == "__main__":
+    main()
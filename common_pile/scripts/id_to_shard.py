@@ -1,58 +1,46 @@
 #!/usr/bin/env python3
+"""Build an index of which shard each example id is in, see `common_pile.id_index`."""
 
 import argparse
 import glob
-import json
 import multiprocessing as mp
-import os
-import re
-from tempfile import TemporaryDirectory
 
-import smart_open
-
-from common_pile import utils, write
-
-
-class IdToShardParallel(write.ShardParallelProcessor):
-    @classmethod
-    def process_example(cls, example, **kwargs):
-        return {"id": example["id"]}
+from common_pile import id_index, utils
+from common_pile.logs import configure_logging
 
 
 def main():
     mp.set_start_method("spawn")
-    parser = argparse.ArgumentParser(description="")
-    parser.add_argument("--input", help="", required=True)
+    parser = argparse.ArgumentParser(
+        description="Build an on-disk index of which shard each example id is in."
+    )
+    parser.add_argument("--input", help="The dolma data to index.", required=True)
     parser.add_argument(
         "--output",
-        help="",
-        default="id_to_shards.json",
+        help="The directory to save the index in.",
+        default="id_to_shard",
     )
     parser.add_argument("--processes", type=int, default=mp.cpu_count(), help="")
+    parser.add_argument(
+        "--run_size",
+        type=int,
+        default=10_000_000,
+        help="The most ids each worker sorts in memory at once.",
+    )
+    parser.add_argument(
+        "--tmp_dir", help="Where to save sorted runs, defaults to --output."
+    )
     args = parser.parse_args()
+    configure_logging()
 
     args.input = utils.dolma_input(args.input)
-
-    with TemporaryDirectory() as tempdir:
-        processor = IdToShardParallel(
-            source_prefix=args.input,
-            destination_prefix=tempdir,
-            metadata_prefix=tempdir,
-            num_processes=args.processes,
-        )
-        processor()
-
-        id_to_shard = {}
-        for shard_file in glob.iglob(
-            os.path.join(tempdir, os.path.basename(args.input))
-        ):
-            if shard := re.search("^(\d{5})_", os.path.basename(shard_file)):
-                shard = shard.group(1)
-                with smart_open.smart_open(shard_file) as f:
-                    ids = [json.loads(l)["id"] for l in f if l]
-                    id_to_shard |= dict.fromkeys(ids, shard)
-        with smart_open.smart_open(args.output, "w") as wf:
-            json.dump(id_to_shard, wf)
+    id_index.build_id_index(
+        glob.glob(args.input),
+        args.output,
+        processes=args.processes,
+        run_size=args.run_size,
+        tmp_dir=args.tmp_dir,
+    )
 
 
 if __name__ == "__main__":
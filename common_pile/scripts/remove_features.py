@@ -19,8 +19,9 @@ parser.add_argument(
 )
 parser.add_argument(
     "--filename",
-    default="*.jsonl.gz",
-    help="The filename to match with globs, probably needs to be escaped.",
+    default="auto",
+    help="The filename to match with globs, probably needs to be escaped. "
+    "`auto` uses .jsonl.gz or .jsonl.zst based on the files found.",
 )
 # TODO: Respect this flag
 parser.add_argument(
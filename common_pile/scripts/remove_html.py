@@ -23,8 +23,9 @@ parser.add_argument(
 )
 parser.add_argument(
     "--filename",
-    default="*.jsonl.gz",
-    help="The filename to match with globs, probably needs to be escaped.",
+    default="auto",
+    help="The filename to match with globs, probably needs to be escaped. "
+    "`auto` uses .jsonl.gz or .jsonl.zst based on the files found.",
 )
 # TODO: Respect this flag
 parser.add_argument(
@@ -66,6 +67,8 @@ class CaptureMatches:
 
 
 class RegexRemoveHTMLParallel(ShardParallelProcessor):
+    fields = ("id", "source", "text")
+
     @classmethod
     def process_example(cls, example, **kwargs):
         logger = cls.get_logger()
@@ -94,6 +97,8 @@ class RegexRemoveHTMLParallel(ShardParallelProcessor):
 class BS4RemoveHTMLParallel(ShardParallelProcessor):
     """There are issues with using bs4 to remove partial html."""
 
+    fields = ("id", "source", "text")
+
     @classmethod
     def process_example(cls, example, **kwargs):
         logger = cls.get_logger()
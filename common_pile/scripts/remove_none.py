@@ -1,7 +1,6 @@
 """Count the number of (whitespace-delineated) tokens in a dolma dataset."""
 
 import argparse
-import json
 import multiprocessing as mp
 import os
 import re
@@ -9,19 +8,15 @@ from queue import Queue
 from tempfile import TemporaryDirectory
 
 import smart_open
-from dolma.core.parallel import BaseParallelProcessor
 
-from common_pile import utils
+from common_pile import codec, utils
 from common_pile.logs import configure_logging, get_logger
+from common_pile.parallel import ParallelProcessor
 
 configure_logging()
 
 
-class RemoveNoneParallel(BaseParallelProcessor):
-    @classmethod
-    def get_logger(cls):
-        return get_logger()
-
+class RemoveNoneParallel(ParallelProcessor):
     @classmethod
     def increment_progressbar(
         cls,
@@ -49,7 +44,7 @@ class RemoveNoneParallel(BaseParallelProcessor):
         logger = cls.get_logger()
         with logger(file=source_path):
             logger.debug("Removing None's from Dolma files at %s", source_path)
-            with smart_open.open(source_path) as f, smart_open.open(
+            with utils.open_dolma(source_path) as f, smart_open.open(
                 destination_path, "w"
             ) as wf:
                 document_count = 0
@@ -60,8 +55,8 @@ class RemoveNoneParallel(BaseParallelProcessor):
                     with logger(line=i):
                         try:
                             try:
-                                data = json.loads(line)
-                            except json.JSONDecodeError as e:
+                                data = codec.loads(line)
+                            except codec.JSONDecodeError as e:
                                 logger.error(
                                     "Failed to parse JSON from `%s...`",
                                     line[:80],
@@ -73,7 +68,7 @@ class RemoveNoneParallel(BaseParallelProcessor):
                             if data is None:
                                 none_count += 1
                             else:
-                                wf.write(json.dumps(data) + "\n")
+                                wf.write(codec.dumps(data) + "\n")
 
                             if document_count % update_interval == 0:
                                 cls.increment_progressbar(
@@ -81,8 +76,6 @@ class RemoveNoneParallel(BaseParallelProcessor):
                                     documents=document_count,
                                     nones=none_count,
                                 )
-                                if queue.qsize() >= mp.cpu_count():
-                                    update_interval *= 2
                                 document_count = 0
                                 none_count = 0
                         except Exception:
@@ -1,27 +1,307 @@
-"""Count the number of (whitespace-delineated) tokens in a dolma dataset."""
+"""Count the number of (whitespace-delineated) tokens in a dolma dataset.
+
+Along with the totals, this collects counts per source and per license, length
+histograms (in power of 2 buckets), and length quantiles for each measure of
+size. The number of distinct ids and texts are counted with HyperLogLogs and,
+optionally, the number of near duplicate documents with MinHash. Each worker
+saves the stats for its shards as a partial state file, these are merged into
+the final stats at the end.
+"""
 
 import argparse
+import hashlib
 import json
 import multiprocessing as mp
 import os
-import re
 from queue import Queue
-from tempfile import TemporaryDirectory
+from typing import Dict, List, Optional, Sequence, Tuple
 
-import smart_open
-from dolma.core.parallel import BaseParallelProcessor
+import fsspec
+import numpy as np
 
-from common_pile import utils
+from common_pile import codec, utils
 from common_pile.logs import configure_logging, get_logger
+from common_pile.parallel import ParallelProcessor
+from common_pile.sketches import HyperLogLog, LogHistogram, MinHasher, QuantileSketch
 
 configure_logging()
 
+METRICS = ("tokens", "bytes", "characters")
+# Tokens from a real tokenizer, only counted when one is given.
+TOKENIZER_METRIC = "tokenizer_tokens"
+QUANTILES = (0.5, 0.9, 0.99)
+# Added to a shard's output path for its partial stats.
+PARTIAL_SUFFIX = ".stats.json"
+
+_TOKENIZERS = {}
+
+
+def load_tokenizer(name: str):
+    """Load (once per process) a `tokenizers` tokenizer by hub name or path."""
+    if name not in _TOKENIZERS:
+        # Only required when counting tokens with a real tokenizer.
+        from tokenizers import Tokenizer
+
+        if os.path.exists(name):
+            _TOKENIZERS[name] = Tokenizer.from_file(name)
+        else:
+            _TOKENIZERS[name] = Tokenizer.from_pretrained(name)
+    return _TOKENIZERS[name]
+
+
+def document_license(data: Dict) -> Optional[str]:
+    return (data.get("metadata") or {}).get("license")
+
+
+def hash_strings(values: Sequence) -> np.ndarray:
+    """Stable 64-bit hashes of `values`, as strings, to count distinct ones."""
+    return np.fromiter(
+        (
+            int.from_bytes(
+                hashlib.blake2b(
+                    str(v).encode("utf-8", "surrogatepass"), digest_size=8
+                ).digest(),
+                "little",
+            )
+            for v in values
+        ),
+        dtype=np.uint64,
+        count=len(values),
+    )
+
+
+# Every worker has to use the same hash functions for their sketches to be
+# mergeable, so these come from a fixed seed.
+MINHASHER = MinHasher()
+# Estimated duplicates within this many standard errors of 0 are reported as 0.
+DUPLICATE_NOISE = 3
+
+
+def duplicates(documents: int, sketch: HyperLogLog) -> Tuple[int, int]:
+    """How many of the `documents` repeat a value counted by `sketch`, and the error."""
+    count, error = documents - sketch.count(), sketch.error()
+    # Exact counts have no error, so this only clips estimates.
+    return (count if count > DUPLICATE_NOISE * error else 0), error
+
+
+class SizeStats:
+    """The size stats for a set of documents, mergeable with those of other sets."""
+
+    def __init__(self, metrics: Sequence[str] = METRICS, near_duplicates: bool = False):
+        self.metrics = tuple(metrics)
+        self.documents = 0
+        # Documents whose text is None, they are only counted as documents.
+        self.null_text = 0
+        self.totals = dict.fromkeys(self.metrics, 0)
+        self.by_source: Dict[str, Dict[str, int]] = {}
+        self.by_license: Dict[str, Dict[str, int]] = {}
+        self.histograms = {m: LogHistogram() for m in self.metrics}
+        self.quantiles = {m: QuantileSketch() for m in self.metrics}
+        self.ids = HyperLogLog()
+        self.texts = HyperLogLog()
+        # The number of documents added to `texts`, those with text.
+        self.hashed_texts = 0
+        # The distinct keys of each MinHash band, and how many documents had a
+        # signature, when counting near duplicates.
+        self.bands = (
+            [HyperLogLog() for _ in range(MINHASHER.bands)] if near_duplicates else None
+        )
+        self.minhashed = 0
+
+    def _group(self, groups: Dict[str, Dict[str, int]], key) -> Dict[str, int]:
+        if (group := groups.get(str(key))) is None:
+            group = groups[str(key)] = dict.fromkeys(("documents", *self.metrics), 0)
+        return group
+
+    def add(
+        self,
+        sources: Sequence[Optional[str]],
+        licenses: Sequence[Optional[str]],
+        **values: Sequence[int],
+    ):
+        """Add documents, `values` has the size of each document for each metric."""
+        self.documents += len(sources)
+        for metric in self.metrics:
+            sizes = np.asarray(values[metric], dtype=np.int64)
+            self.totals[metric] += int(sizes.sum())
+            self.histograms[metric].add(sizes)
+            self.quantiles[metric].add(sizes)
+        for groups, keys in ((self.by_source, sources), (self.by_license, licenses)):
+            for i, key in enumerate(keys):
+                group = self._group(groups, key)
+                group["documents"] += 1
+                for metric in self.metrics:
+                    group[metric] += values[metric][i]
+
+    def add_distinct(self, ids: Sequence, texts: Sequence[str]):
+        """Add the `ids` of documents and their `texts` to the distinct counts."""
+        self.ids.add(hash_strings(ids))
+        self.texts.add(hash_strings(texts))
+        self.hashed_texts += len(texts)
+        if self.bands is not None:
+            signatures = [MINHASHER.signature(text) for text in texts]
+            signatures = [s for s in signatures if s is not None]
+            if signatures:
+                keys = MINHASHER.band_keys(np.stack(signatures))
+                for band, sketch in enumerate(self.bands):
+                    sketch.add(keys[:, band])
+                self.minhashed += len(signatures)
+
+    def add_null_text(self, source: Optional[str], license: Optional[str]):
+        self.documents += 1
+        self.null_text += 1
+        self._group(self.by_source, source)["documents"] += 1
+        self._group(self.by_license, license)["documents"] += 1
+
+    def merge(self, other: "SizeStats"):
+        if other.metrics != self.metrics:
+            raise ValueError(
+                f"Can't merge stats for {other.metrics} into stats for {self.metrics}."
+            )
+        self.documents += other.documents
+        self.null_text += other.null_text
+        for metric in self.metrics:
+            self.totals[metric] += other.totals[metric]
+            self.histograms[metric].merge(other.histograms[metric])
+            self.quantiles[metric].merge(other.quantiles[metric])
+        for groups, others in (
+            (self.by_source, other.by_source),
+            (self.by_license, other.by_license),
+        ):
+            for key, counts in others.items():
+                group = self._group(groups, key)
+                for name, count in counts.items():
+                    group[name] += count
+        self.ids.merge(other.ids)
+        self.texts.merge(other.texts)
+        self.hashed_texts += other.hashed_texts
+        if (self.bands is None) != (other.bands is None):
+            raise ValueError("Can't merge stats with and without near duplicates.")
+        if self.bands is not None:
+            for sketch, other_sketch in zip(self.bands, other.bands):
+                sketch.merge(other_sketch)
+            self.minhashed += other.minhashed
+
+    def to_dict(self) -> Dict:
+        """The full state, to save and merge later."""
+        return {
+            "metrics": self.metrics,
+            "documents": self.documents,
+            "null_text": self.null_text,
+            "totals": self.totals,
+            "by_source": self.by_source,
+            "by_license": self.by_license,
+            "histograms": {m: h.to_dict() for m, h in self.histograms.items()},
+            "quantiles": {m: q.to_dict() for m, q in self.quantiles.items()},
+            "ids": self.ids.to_dict(),
+            "texts": self.texts.to_dict(),
+            "hashed_texts": self.hashed_texts,
+            "bands": (
+                [b.to_dict() for b in self.bands] if self.bands is not None else None
+            ),
+            "minhashed": self.minhashed,
+        }
 
-class SizeStatsParallel(BaseParallelProcessor):
     @classmethod
-    def get_logger(cls):
-        return get_logger()
+    def from_dict(cls, d: Dict) -> "SizeStats":
+        stats = cls(d["metrics"], near_duplicates=d["bands"] is not None)
+        stats.documents = d["documents"]
+        stats.null_text = d["null_text"]
+        stats.totals = d["totals"]
+        stats.by_source = d["by_source"]
+        stats.by_license = d["by_license"]
+        stats.histograms = {
+            m: LogHistogram.from_dict(h) for m, h in d["histograms"].items()
+        }
+        stats.quantiles = {
+            m: QuantileSketch.from_dict(q) for m, q in d["quantiles"].items()
+        }
+        stats.ids = HyperLogLog.from_dict(d["ids"])
+        stats.texts = HyperLogLog.from_dict(d["texts"])
+        stats.hashed_texts = d["hashed_texts"]
+        if d["bands"] is not None:
+            stats.bands = [HyperLogLog.from_dict(b) for b in d["bands"]]
+        stats.minhashed = d["minhashed"]
+        return stats
+
+    def distinct(self) -> Dict:
+        """Counts of the distinct ids and texts, and of duplicates, with errors.
+
+        Documents with the same key for a MinHash band are near duplicates of
+        each other, so the documents minus the distinct keys of a band is the
+        number that are a near duplicate of an earlier one in that band, the
+        largest of these is reported.
+
+        The counts are exact until there are more than 65k distinct values,
+        after that they are HyperLogLog estimates, `*_error` is their standard
+        error (about 0.8%). Duplicate counts are differences of two large
+        numbers, so ones that aren't above the noise (`DUPLICATE_NOISE`
+        standard errors) are reported as 0.
+        """
+        ids = self.ids.count()
+        distinct = {
+            "ids": ids,
+            "ids_error": self.ids.error(),
+            "texts": min(self.texts.count(), self.hashed_texts),
+            "texts_error": self.texts.error(),
+        }
+        distinct["exact_duplicates"], distinct["exact_duplicates_error"] = duplicates(
+            self.hashed_texts, self.texts
+        )
+        if self.bands is not None:
+            distinct["near_duplicates"], distinct["near_duplicates_error"] = max(
+                duplicates(self.minhashed, band) for band in self.bands
+            )
+        return distinct
 
+    def summary(self) -> Dict:
+        """The stats to report, with histograms and quantiles read off the sketches."""
+        return {
+            "documents": self.documents,
+            "null_text": self.null_text,
+            "totals": self.totals,
+            "distinct": self.distinct(),
+            "quantiles": {
+                m: {
+                    **{f"p{round(q * 100)}": sketch.quantile(q) for q in QUANTILES},
+                    "max": sketch.max if sketch.count else None,
+                }
+                for m, sketch in self.quantiles.items()
+            },
+            "histograms": {m: list(h.buckets()) for m, h in self.histograms.items()},
+            "by_source": self.by_source,
+            "by_license": self.by_license,
+        }
+
+
+def partial_path(destination_path: str) -> str:
+    return f"{destination_path}{PARTIAL_SUFFIX}"
+
+
+def save_partial(path: str, stats: SizeStats):
+    fs, fs_path = fsspec.core.url_to_fs(path)
+    fs.makedirs(fs._parent(fs_path), exist_ok=True)
+    with fs.open(fs_path, "w") as wf:
+        wf.write(codec.dumps(stats.to_dict()))
+
+
+def merge_partials(root: str) -> Optional[SizeStats]:
+    """Merge all the partial stats saved under `root`, which can be remote."""
+    stats = None
+    fs, fs_root = fsspec.core.url_to_fs(root)
+    # `find` instead of a `**` glob, which doesn't match files directly in
+    # `root` in every version of fsspec.
+    for path in sorted(p for p in fs.find(fs_root) if p.endswith(PARTIAL_SUFFIX)):
+        with fs.open(path, "r") as f:
+            partial = SizeStats.from_dict(codec.loads(f.read()))
+        if stats is None:
+            stats = partial
+        else:
+            stats.merge(partial)
+    return stats
+
+
+class SizeStatsParallel(ParallelProcessor):
     @classmethod
     def increment_progressbar(
         cls,
@@ -42,6 +322,48 @@ class SizeStatsParallel(BaseParallelProcessor):
             characters=characters,
         )
 
+    @classmethod
+    def add_batch(
+        cls,
+        stats: SizeStats,
+        batch: List[Dict],
+        queue: Queue,
+        tokenizer: Optional[str] = None,
+    ):
+        """Add the stats for a batch of parsed documents."""
+        # TODO: Make this configurable
+        documents = [data for data in batch if data["text"] is not None]
+        for data in batch:
+            if data["text"] is None:
+                stats.add_null_text(data.get("source"), document_license(data))
+        texts = [data["text"] for data in documents]
+        values = {
+            "tokens": [len(text.split()) for text in texts],
+            "characters": [len(text) for text in texts],
+            # There are some sources that have invalid unicode that result
+            # in rendering errors in webpages. Thus we ignore them here.
+            # Example: https://math.stackexchange.com/a/8849
+            "bytes": [len(text.encode("utf-8", "ignore")) for text in texts],
+        }
+        if tokenizer is not None:
+            encodings = load_tokenizer(tokenizer).encode_batch(
+                texts, add_special_tokens=False
+            )
+            values[TOKENIZER_METRIC] = [len(e.ids) for e in encodings]
+        stats.add(
+            [data.get("source") for data in documents],
+            [document_license(data) for data in documents],
+            **values,
+        )
+        stats.add_distinct([data.get("id") for data in batch], texts)
+        cls.increment_progressbar(
+            queue,
+            documents=len(batch),
+            tokens=sum(values["tokens"]),
+            bytes_utf8=sum(values["bytes"]),
+            characters=sum(values["characters"]),
+        )
+
     @classmethod
     def process_single(
         cls,
@@ -50,70 +372,52 @@ class SizeStatsParallel(BaseParallelProcessor):
         queue: Queue,
         **kwargs,
     ):
-        del destination_path
         logger = cls.get_logger()
         logger.debug("Counting Tokens from Dolma files at %s", source_path)
-        with logger(file=source_path):
-            with smart_open.open(source_path) as f:
-                document_count = 0
-                token_count = 0
-                byte_count = 0
-                char_count = 0
-                update_interval = kwargs.pop("update_interval", 1)
+        # Also count tokens from this `tokenizers` tokenizer, a name on the
+        # huggingface hub or a path to a tokenizer.json.
+        tokenizer = kwargs.pop("tokenizer", None)
+        # Documents are measured, and tokenized, in batches of this size.
+        batch_size = kwargs.pop("batch_size", 1000)
+        # Also estimate the number of near duplicates, this is slower.
+        near_duplicates = kwargs.pop("near_duplicates", False)
+        stats = SizeStats(
+            METRICS + ((TOKENIZER_METRIC,) if tokenizer else ()), near_duplicates
+        )
 
+        def add_batch(batch):
+            try:
+                cls.add_batch(stats, batch, queue, tokenizer)
+            except Exception:
+                logger.error("Failed to process batch", exc_info=True)
+                raise
+
+        with logger(file=source_path):
+            with utils.open_dolma(source_path) as f:
+                batch = []
                 for i, line in enumerate(f):
                     with logger(line=i):
                         try:
-                            try:
-                                data = json.loads(line)
-                            except json.JSONDecodeError:
-                                logger.error(
-                                    "Failed to parse JSON from `%s...`",
-                                    line[:80],
-                                    exc_info=True,
-                                )
-                                continue
-                            # TODO: Dolma file generation should not be adding null lines
-                            if data is None:
-                                continue
-                            # TODO: Make this configurable
-                            if data["text"] is None:
-                                document_count += 1
-                                continue
-                            tokens = data["text"].split()
-                            document_count += 1
-                            token_count += len(tokens)
-                            char_count += len(data["text"])
-                            # There are some sources that have invalid unicode that result
-                            # in rendering errors in webpages. Thus we ignore them here.
-                            # Example: https://math.stackexchange.com/a/8849
-                            byte_count += len(data["text"].encode("utf-8", "ignore"))
-
-                            if document_count % update_interval == 0:
-                                cls.increment_progressbar(
-                                    queue,
-                                    documents=document_count,
-                                    tokens=token_count,
-                                    bytes_utf8=byte_count,
-                                    characters=char_count,
-                                )
-                                if queue.qsize() >= mp.cpu_count():
-                                    update_interval *= 2
-                                document_count = 0
-                                token_count = 0
-                                char_count = 0
-                                byte_count = 0
-                        except Exception as e:
-                            logger.error("Failed to process example", exc_info=True)
-                            raise
-                cls.increment_progressbar(
-                    queue,
-                    shards=1,
-                    documents=document_count,
-                    tokens=token_count,
-                    bytes_utf8=byte_count,
-                    characters=char_count,
-                )
+                            data = codec.loads(line)
+                        except codec.JSONDecodeError:
+                            logger.error(
+                                "Failed to parse JSON from `%s...`",
+                                line[:80],
+                                exc_info=True,
+                            )
+                            continue
+                        # TODO: Dolma file generation should not be adding null lines
+                        if data is None:
+                            continue
+                        batch.append(data)
+                        if len(batch) >= batch_size:
+                            add_batch(batch)
+                            batch = []
+                if batch:
+                    add_batch(batch)
+            # Each worker saves the stats for its shard, they are merged at the end.
+            save_partial(partial_path(destination_path), stats)
+            cls.increment_progressbar(queue, shards=1)
 
 
 def main():
@@ -131,21 +435,60 @@ def main():
         help="Number of processors for multicore.",
     )
     parser.add_argument(
-        "--meta", help="Location to store dolma metadata while processing."
+        "--meta",
+        help="Location to store dolma metadata, and the partial stats for each "
+        "shard, while processing. Finished shards are skipped when rerun.",
+    )
+    parser.add_argument("--output", help="Where to save the stats as json.")
+    parser.add_argument(
+        "--tokenizer",
+        help="Also count tokens with this tokenizer, a huggingface hub name or "
+        "a path to a tokenizer.json. Requires `tokenizers`.",
+    )
+    parser.add_argument(
+        "--batch_size",
+        type=int,
+        default=1000,
+        help="How many documents to measure (and tokenize) at once.",
+    )
+    parser.add_argument(
+        "--near_duplicates",
+        action="store_true",
+        help="Also estimate how many documents are near duplicates with MinHash.",
     )
     args = parser.parse_args()
+    logger = get_logger()
 
     source = utils.dolma_input(args.input)
 
     with utils.maybe_temp_dir(path=args.meta) as meta_dir:
         processor = SizeStatsParallel(
             source_prefix=source,
-            # Unused
+            # The partial stats for each shard are saved here.
             destination_prefix=meta_dir,
             metadata_prefix=meta_dir,
             num_processes=args.processes,
         )
-        processor()
+        kwargs = {"batch_size": args.batch_size}
+        if args.tokenizer:
+            kwargs["tokenizer"] = args.tokenizer
+        if args.near_duplicates:
+            kwargs["near_duplicates"] = True
+        processor(**kwargs)
+        stats = merge_partials(meta_dir)
+    if stats is None:
+        logger.warning("No documents found in %s", source)
+        return
+    summary = stats.summary()
+    logger.info(
+        "Totals: %s, distinct: %s, quantiles: %s",
+        summary["totals"],
+        summary["distinct"],
+        summary["quantiles"],
+    )
+    if args.output:
+        with fsspec.open(args.output, "w") as wf:
+            json.dump(summary, wf, indent=2)
 
 
 if __name__ == "__main__":
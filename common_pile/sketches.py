@@ -0,0 +1,299 @@
+"""Small, mergeable summaries of a stream of values.
+
+Each worker builds its own sketch over the documents it sees, these are saved
+as json and merged at the end, so the result is the same as if one process had
+seen everything. Memory doesn't grow with the number of values.
+"""
+
+import base64
+import math
+import zlib
+from typing import Dict, Iterator, Optional, Tuple
+
+import numpy as np
+
+
+class LogHistogram:
+    """Counts of non-negative integers in power of 2 buckets.
+
+    Bucket 0 is just 0 and bucket k holds [2^(k - 1), 2^k).
+    """
+
+    BUCKETS = 65
+
+    def __init__(self):
+        self.counts = np.zeros(self.BUCKETS, dtype=np.int64)
+
+    def add(self, values: np.ndarray):
+        values = np.asarray(values, dtype=np.float64)
+        # frexp gives x = m * 2^e with m in [0.5, 1), so e is the bucket.
+        self.counts += np.bincount(np.frexp(values)[1], minlength=self.BUCKETS)
+
+    def merge(self, other: "LogHistogram"):
+        self.counts += other.counts
+
+    def buckets(self) -> Iterator[Tuple[int, int, int]]:
+        """Yield (min, max, count) for each bucket with values in it, max is exclusive."""
+        for k, count in enumerate(self.counts):
+            if count:
+                yield 2 ** (k - 1) if k else 0, 2**k, int(count)
+
+    def to_dict(self) -> Dict:
+        return {"counts": self.counts.tolist()}
+
+    @classmethod
+    def from_dict(cls, d: Dict) -> "LogHistogram":
+        histogram = cls()
+        histogram.counts[:] = d["counts"]
+        return histogram
+
+
+class QuantileSketch:
+    """Quantiles of non-negative values with a bounded relative error.
+
+    This is a DDSketch (https://arxiv.org/abs/1908.10693). Values are counted
+    in logarithmic buckets that are `relative_accuracy` wide, so any quantile
+    is within that fraction of the true value, and merging two sketches is just
+    adding their counts.
+    """
+
+    def __init__(self, relative_accuracy: float = 0.01):
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.buckets: Dict[int, int] = {}
+        self.zeros = 0
+        self.count = 0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def add(self, values: np.ndarray):
+        values = np.asarray(values, dtype=np.float64)
+        if not len(values):
+            return
+        self.count += len(values)
+        self.min = min(self.min, float(values.min()))
+        self.max = max(self.max, float(values.max()))
+        positive = values[values > 0]
+        self.zeros += len(values) - len(positive)
+        keys, counts = np.unique(
+            np.ceil(np.log(positive) / self.log_gamma).astype(np.int64),
+            return_counts=True,
+        )
+        for key, count in zip(keys.tolist(), counts.tolist()):
+            self.buckets[key] = self.buckets.get(key, 0) + count
+
+    def merge(self, other: "QuantileSketch"):
+        if other.relative_accuracy != self.relative_accuracy:
+            raise ValueError("Only sketches with the same accuracy can be merged.")
+        for key, count in other.buckets.items():
+            self.buckets[key] = self.buckets.get(key, 0) + count
+        self.zeros += other.zeros
+        self.count += other.count
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    def quantile(self, q: float) -> float:
+        if not self.count:
+            return math.nan
+        rank = q * (self.count - 1)
+        seen = self.zeros
+        if rank < seen:
+            return 0.0
+        for key in sorted(self.buckets):
+            seen += self.buckets[key]
+            if rank < seen:
+                value = 2 * self.gamma**key / (self.gamma + 1)
+                return min(max(value, self.min), self.max)
+        return self.max
+
+    def to_dict(self) -> Dict:
+        return {
+            "relative_accuracy": self.relative_accuracy,
+            "buckets": {str(k): v for k, v in self.buckets.items()},
+            "zeros": self.zeros,
+            "count": self.count,
+            "min": self.min if self.count else None,
+            "max": self.max if self.count else None,
+        }
+
+    @classmethod
+    def from_dict(cls, d: Dict) -> "QuantileSketch":
+        sketch = cls(d["relative_accuracy"])
+        sketch.buckets = {int(k): v for k, v in d["buckets"].items()}
+        sketch.zeros = d["zeros"]
+        sketch.count = d["count"]
+        if sketch.count:
+            sketch.min, sketch.max = d["min"], d["max"]
+        return sketch
+
+
+def mix64(x: np.ndarray) -> np.ndarray:
+    """The splitmix64 finalizer, spreads the bits of uint64s into uniform hashes."""
+    x = np.asarray(x, dtype=np.uint64)
+    with np.errstate(over="ignore"):
+        x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+        return x ^ (x >> np.uint64(31))
+
+
+def _bit_length(x: np.ndarray) -> np.ndarray:
+    # Floats can't hold every uint64 exactly, so look at each 32-bit half.
+    high = (x >> np.uint64(32)).astype(np.float64)
+    low = (x & np.uint64(0xFFFFFFFF)).astype(np.float64)
+    return np.where(high > 0, np.frexp(high)[1] + 32, np.frexp(low)[1])
+
+
+class HyperLogLog:
+    """An estimate of the number of distinct values, from 64-bit hashes of them.
+
+    With `precision` p there are 2^p one byte registers, the standard error
+    is about 1.04 / sqrt(2^p), 0.8% for the default. Merging two sketches is
+    the max of their registers.
+
+    Until there are more than `exact_limit` distinct hashes they are also
+    kept, so small counts are exact rather than estimates.
+    """
+
+    def __init__(self, precision: int = 14, exact_limit: int = 1 << 16):
+        self.precision = precision
+        self.registers = np.zeros(1 << precision, dtype=np.uint8)
+        self.exact_limit = exact_limit
+        # The sorted, distinct hashes, None once there are too many.
+        self.exact: Optional[np.ndarray] = np.zeros(0, dtype=np.uint64)
+
+    def _add_exact(self, hashes: np.ndarray):
+        if self.exact is not None:
+            self.exact = np.union1d(self.exact, hashes)
+            if len(self.exact) > self.exact_limit:
+                self.exact = None
+
+    def add(self, hashes: np.ndarray):
+        hashes = np.asarray(hashes, dtype=np.uint64)
+        if not len(hashes):
+            return
+        bits = 64 - self.precision
+        buckets = (hashes >> np.uint64(bits)).astype(np.intp)
+        rest = hashes & np.uint64((1 << bits) - 1)
+        # The position of the first 1 bit in the rest of the hash.
+        ranks = (bits - _bit_length(rest) + 1).astype(np.uint8)
+        np.maximum.at(self.registers, buckets, ranks)
+        self._add_exact(hashes)
+
+    def merge(self, other: "HyperLogLog"):
+        if other.precision != self.precision:
+            raise ValueError("Only sketches with the same precision can be merged.")
+        np.maximum(self.registers, other.registers, out=self.registers)
+        if other.exact is None:
+            self.exact = None
+        else:
+            self._add_exact(other.exact)
+
+    @property
+    def is_exact(self) -> bool:
+        return self.exact is not None
+
+    def count(self) -> int:
+        if self.exact is not None:
+            return len(self.exact)
+        m = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / np.sum(np.ldexp(1.0, -self.registers.astype(int)))
+        zeros = int(np.count_nonzero(self.registers == 0))
+        if estimate <= 2.5 * m and zeros:
+            # Linear counting is more accurate for small counts.
+            estimate = m * math.log(m / zeros)
+        return round(estimate)
+
+    def error(self) -> int:
+        """The standard error of `count`, 0 when it is exact."""
+        if self.exact is not None:
+            return 0
+        return round(1.04 / math.sqrt(len(self.registers)) * self.count())
+
+    def to_dict(self) -> Dict:
+        return {
+            "precision": self.precision,
+            "registers": base64.b64encode(self.registers.tobytes()).decode("ascii"),
+            "exact_limit": self.exact_limit,
+            "exact": (
+                base64.b64encode(self.exact.tobytes()).decode("ascii")
+                if self.exact is not None
+                else None
+            ),
+        }
+
+    @classmethod
+    def from_dict(cls, d: Dict) -> "HyperLogLog":
+        sketch = cls(d["precision"], d.get("exact_limit", 1 << 16))
+        sketch.registers[:] = np.frombuffer(
+            base64.b64decode(d["registers"]), dtype=np.uint8
+        )
+        # Sketches saved before exact counts were kept are estimates.
+        exact = d.get("exact")
+        sketch.exact = (
+            np.frombuffer(base64.b64decode(exact), dtype=np.uint64).copy()
+            if exact is not None
+            else None
+        )
+        return sketch
+
+
+class MinHasher:
+    """MinHash signatures of the word n-grams in documents, split into LSH bands.
+
+    Two documents with a Jaccard similarity of s have the same key for a band
+    with probability s^rows, so documents that are near duplicates (above
+    about (1 / bands)^(1 / rows) similar) are likely to share at least one band
+    key. Words are hashed with crc32 so signatures are the same in every
+    process.
+    """
+
+    def __init__(self, bands: int = 8, rows: int = 8, ngram: int = 5, seed: int = 0):
+        self.bands = bands
+        self.rows = rows
+        self.ngram = ngram
+        rng = np.random.default_rng(seed)
+        permutations = bands * rows
+        # Multiply-add hashes with odd multipliers, one per permutation.
+        self.a = rng.integers(1, 2**63, permutations, dtype=np.uint64) | np.uint64(1)
+        self.b = rng.integers(0, 2**63, permutations, dtype=np.uint64)
+        self.powers = mix64(np.arange(1, ngram + 1, dtype=np.uint64))
+
+    def shingles(self, text: str) -> np.ndarray:
+        """Hashes of the word n-grams in `text`."""
+        words = np.fromiter(
+            (zlib.crc32(w.encode("utf-8", "surrogatepass")) for w in text.split()),
+            dtype=np.uint64,
+        )
+        if len(words) < self.ngram:
+            return mix64(words.sum(keepdims=True)) if len(words) else words
+        n = len(words) - self.ngram + 1
+        with np.errstate(over="ignore"):
+            shingles = np.zeros(n, dtype=np.uint64)
+            for j in range(self.ngram):
+                shingles += words[j : j + n] * self.powers[j]
+        return mix64(shingles)
+
+    def signature(self, text: str, chunk_size: int = 8192) -> Optional[np.ndarray]:
+        """The MinHash signature of `text`, None if it has no words."""
+        shingles = self.shingles(text)
+        if not len(shingles):
+            return None
+        signature = np.full(len(self.a), np.iinfo(np.uint64).max, dtype=np.uint64)
+        # Chunked so huge documents don't make a huge (shingles x permutations) array.
+        with np.errstate(over="ignore"):
+            for start in range(0, len(shingles), chunk_size):
+                chunk = shingles[start : start + chunk_size, None]
+                hashed = chunk * self.a + self.b
+                np.minimum(signature, hashed.min(axis=0), out=signature)
+        return signature
+
+    def band_keys(self, signatures: np.ndarray) -> np.ndarray:
+        """A (documents, bands) array of hashes of each band of the `signatures`."""
+        bands = signatures.reshape(len(signatures), self.bands, self.rows)
+        with np.errstate(over="ignore"):
+            keys = np.zeros(bands.shape[:2], dtype=np.uint64)
+            for row in range(self.rows):
+                keys = mix64(keys ^ bands[:, :, row])
+        return keys
@@ -0,0 +1,150 @@
+"""Tests for the mergeable summaries used by stats.py."""
+
+import json
+
+import numpy as np
+import pytest
+
+from common_pile import sketches
+
+
+def test_log_histogram_buckets():
+    histogram = sketches.LogHistogram()
+    histogram.add([0, 1, 2, 3, 4, 7, 8, 1000])
+    assert list(histogram.buckets()) == [
+        (0, 1, 1),
+        (1, 2, 1),
+        (2, 4, 2),
+        (4, 8, 2),
+        (8, 16, 1),
+        (512, 1024, 1),
+    ]
+
+
+@pytest.mark.parametrize("relative_accuracy", [0.01, 0.05])
+def test_quantile_sketch_relative_error(relative_accuracy):
+    values = np.random.default_rng(0).lognormal(8, 2, size=100_000).round()
+    sketch = sketches.QuantileSketch(relative_accuracy)
+    sketch.add(values)
+    assert sketch.count == len(values)
+    for q in [0, 0.01, 0.25, 0.5, 0.9, 0.99, 1]:
+        # The sketch ranks with q * (n - 1), like numpy's "lower" method.
+        expected = np.quantile(values, q, method="lower")
+        assert sketch.quantile(q) == pytest.approx(expected, rel=relative_accuracy)
+
+
+def test_quantile_sketch_merge_is_associative():
+    rng = np.random.default_rng(0)
+    parts = [rng.integers(0, 10_000, size=n) for n in [1000, 10, 5000]]
+
+    def sketch(*values):
+        s = sketches.QuantileSketch()
+        for v in values:
+            s.add(v)
+        return s
+
+    a, b, c = (sketch(p) for p in parts)
+    left = sketch(parts[0])
+    left.merge(b)
+    left.merge(c)
+    right = sketch(parts[1])
+    right.merge(c)
+    a.merge(right)
+    everything = sketch(np.concatenate(parts))
+    for merged in [left, a]:
+        assert merged.to_dict() == everything.to_dict()
+
+
+def test_quantile_sketch_round_trips_through_json():
+    sketch = sketches.QuantileSketch()
+    sketch.add([0, 0, 5, 50, 500])
+    copy = sketches.QuantileSketch.from_dict(json.loads(json.dumps(sketch.to_dict())))
+    assert copy.to_dict() == sketch.to_dict()
+    assert copy.quantile(0.5) == sketch.quantile(0.5)
+    empty = sketches.QuantileSketch.from_dict(sketches.QuantileSketch().to_dict())
+    assert np.isnan(empty.quantile(0.5))
+
+
+def random_hashes(n, seed=0):
+    return np.random.default_rng(seed).integers(
+        0, np.iinfo(np.uint64).max, size=n, dtype=np.uint64, endpoint=True
+    )
+
+
+def test_hyperloglog_is_exact_for_small_counts():
+    sketch = sketches.HyperLogLog(exact_limit=1000)
+    hashes = random_hashes(800)
+    sketch.add(hashes)
+    sketch.add(hashes[:100])
+    assert sketch.is_exact
+    assert sketch.count() == 800
+    assert sketch.error() == 0
+    sketch.add(random_hashes(300, seed=1))
+    assert not sketch.is_exact
+
+
+@pytest.mark.parametrize("n", [5_000, 200_000])
+def test_hyperloglog_error_bound(n):
+    sketch = sketches.HyperLogLog(exact_limit=0)
+    hashes = random_hashes(n)
+    sketch.add(hashes)
+    sketch.add(hashes[: n // 2])
+    assert not sketch.is_exact
+    assert sketch.error() > 0
+    # Within 4 standard errors, this fails about once in 15,000 seeds.
+    assert abs(sketch.count() - n) <= 4 * sketch.error()
+
+
+def test_hyperloglog_merge_is_associative():
+    parts = [random_hashes(n, seed=i) for i, n in enumerate([50_000, 10, 20_000])]
+    # Overlapping parts, like ids that show up in more than one shard.
+    parts[2][:1000] = parts[0][:1000]
+    for exact_limit in [0, 1 << 17]:
+
+        def sketch(*values):
+            s = sketches.HyperLogLog(exact_limit=exact_limit)
+            for v in values:
+                s.add(v)
+            return s
+
+        left = sketch(parts[0])
+        left.merge(sketch(parts[1]))
+        left.merge(sketch(parts[2]))
+        right = sketch(parts[1])
+        right.merge(sketch(parts[2]))
+        merged = sketch(parts[0])
+        merged.merge(right)
+        everything = sketch(*parts)
+        for s in [left, merged]:
+            assert s.to_dict() == everything.to_dict()
+        if exact_limit:
+            assert everything.count() == 70_010 - 1000
+
+
+def test_hyperloglog_round_trips_through_json():
+    for exact_limit in [0, 1000]:
+        sketch = sketches.HyperLogLog(exact_limit=exact_limit)
+        sketch.add(random_hashes(500))
+        copy = sketches.HyperLogLog.from_dict(json.loads(json.dumps(sketch.to_dict())))
+        assert copy.count() == sketch.count()
+        assert copy.is_exact == sketch.is_exact
+    # Sketches saved without exact hashes are estimates.
+    legacy = sketch.to_dict()
+    del legacy["exact"], legacy["exact_limit"]
+    assert not sketches.HyperLogLog.from_dict(legacy).is_exact
+
+
+def test_minhash_finds_near_duplicates():
+    minhasher = sketches.MinHasher()
+    rng = np.random.default_rng(0)
+    words = [f"word{i}" for i in rng.integers(0, 5000, size=500)]
+    text = " ".join(words)
+    near = " ".join(words[:-5] + ["changed"] * 5)
+    other = " ".join(f"word{i}" for i in rng.integers(0, 5000, size=500))
+    signatures = np.stack([minhasher.signature(t) for t in [text, near, other, text]])
+    keys = minhasher.band_keys(signatures)
+    assert keys.shape == (4, minhasher.bands)
+    assert np.array_equal(keys[0], keys[3])
+    assert np.any(keys[0] == keys[1])
+    assert not np.any(keys[0] == keys[2])
+    assert minhasher.signature("") is None
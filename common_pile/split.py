@@ -0,0 +1,125 @@
+"""Split large dolma shards into block ranges that can be processed in parallel.
+
+Shards written by `common_pile.write.ShardWriter` are a series of independent
+blocks (gzip members or zstd frames). A range of blocks can be read without
+touching the rest of the file, and the outputs for consecutive ranges can be
+appended back together into a single valid shard.
+"""
+
+import os
+import shutil
+from typing import List, Optional, Tuple
+
+import smart_open
+
+from common_pile import blocked_gzip, logs, utils
+from common_pile.write import compression_type
+
+
+def part_path(path: str, part: int) -> str:
+    """The path for the output of block range `part` of `path`."""
+    h, t = os.path.split(path)
+    # Add the part at the start to keep the extension (and the compression).
+    return os.path.join(h, f"part{part:05}.{t}")
+
+
+def block_sizes(path: str) -> Optional[List[int]]:
+    """The compressed size of each block in `path`, None if it can't be split."""
+    compression = compression_type(path)
+    if compression is None:
+        return None
+    with smart_open.open(path, "rb", compression="disable") as f:
+        try:
+            if compression == "gz":
+                return [b.compressed_size for b in blocked_gzip.read_blocks(f)]
+            from common_pile import zstd
+
+            return [fr.compressed_size for fr in zstd.read_seek_table(f)]
+        except ValueError:
+            return None
+
+
+def plan_splits(path: str, split_size: int) -> List[Tuple[int, int]]:
+    """Group the blocks of `path` into ranges of about `split_size` bytes.
+
+    Returns a list of [start, stop) block ranges, a file that is smaller than
+    `split_size`, or that isn't made of blocks, is a single range.
+    """
+    sizes = block_sizes(path)
+    if not sizes or sum(sizes) <= split_size:
+        return [(0, len(sizes) if sizes else None)]
+    splits = []
+    start = 0
+    total = 0
+    for i, size in enumerate(sizes):
+        total += size
+        if total >= split_size:
+            splits.append((start, i + 1))
+            start = i + 1
+            total = 0
+    if start < len(sizes):
+        splits.append((start, len(sizes)))
+    return splits
+
+
+def open_blocks(path: str, start: int = 0, stop: Optional[int] = None):
+    """Open blocks [start, stop) of a dolma shard to read text lines."""
+    if compression_type(path) == "zst":
+        from common_pile import zstd
+
+        return zstd.open_seekable(path, start, stop)
+    f = smart_open.open(path, "rb", compression="disable")
+    blocks = blocked_gzip.read_blocks(f)
+    return utils.open_chunks(f, blocked_gzip.read_block_data(f, blocks, start, stop))
+
+
+def merge_parts(parts: List[str], destination: str):
+    """Append the shards in `parts`, in order, into `destination`.
+
+    The first part is renamed to `destination` and the rest are appended to it,
+    so this is only for local files. For zstd the seek tables of each part are
+    combined into one at the end of the file.
+    """
+    logger = logs.get_logger()
+    logger.info("Merging %d parts into %s", len(parts), destination)
+    zstd_entries = None
+    if compression_type(destination) == "zst":
+        from common_pile import zstd
+
+        zstd_entries = []
+        for part in parts:
+            with open(part, "rb") as f:
+                zstd_entries.extend(
+                    (fr.compressed_size, fr.decompressed_size)
+                    for fr in zstd.read_seek_table(f)
+                )
+    os.rename(parts[0], destination)
+    with open(destination, "r+b") as wf:
+        if zstd_entries is not None:
+            # Drop the seek table for just the first part.
+            with open(destination, "rb") as f:
+                wf.truncate(sum(fr.compressed_size for fr in zstd.read_seek_table(f)))
+        wf.seek(0, os.SEEK_END)
+        for part in parts[1:]:
+            with open(part, "rb") as f:
+                if zstd_entries is not None:
+                    frames = zstd.read_seek_table(f)
+                    f.seek(0)
+                    _copy(f, wf, sum(fr.compressed_size for fr in frames))
+                else:
+                    shutil.copyfileobj(f, wf)
+            os.remove(part)
+        if zstd_entries is not None:
+            writer = zstd.SeekableZstdWriter(wf)
+            writer.entries = zstd_entries
+            wf.write(writer.seek_table())
+
+
+def _copy(f, wf, size: int, chunk_size: int = 16 * 1024 * 1024):
+    """Copy the first `size` bytes of `f` into `wf`."""
+    while size > 0:
+        chunk = f.read(min(size, chunk_size))
+        if not chunk:
+            break
+        wf.write(chunk)
+        size -= len(chunk)
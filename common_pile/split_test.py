@@ -0,0 +1,67 @@
+"""Tests for splitting shards into block ranges and merging them back."""
+
+import gzip
+import os
+
+import pytest
+
+from common_pile import split
+from common_pile.write import ShardWriter
+
+
+def write_shard(path, lines, frame_documents=10):
+    with ShardWriter(str(path), frame_documents=frame_documents) as writer:
+        for line in lines:
+            writer.write(line)
+
+
+def read_lines(path, start=0, stop=None):
+    with split.open_blocks(str(path), start, stop) as f:
+        return [line.rstrip("\n") for line in f]
+
+
+@pytest.mark.parametrize("extension", ["gz", "zst"])
+def test_plan_splits_covers_every_block(tmp_path, extension):
+    path = tmp_path / f"shard.jsonl.{extension}"
+    lines = [f'{{"id": "{i}", "text": "document {i}"}}' for i in range(100)]
+    write_shard(path, lines)
+    sizes = split.block_sizes(str(path))
+    assert len(sizes) == 10
+    splits = split.plan_splits(str(path), 3 * max(sizes))
+    assert len(splits) > 1
+    # The ranges are in order, don't overlap, and cover every block.
+    assert splits[0][0] == 0
+    assert splits[-1][1] == len(sizes)
+    for (_, stop), (start, _) in zip(splits, splits[1:]):
+        assert stop == start
+    assert [line for s in splits for line in read_lines(path, *s)] == lines
+
+
+def test_plan_splits_small_file_is_one_range(tmp_path):
+    path = tmp_path / "shard.jsonl.gz"
+    write_shard(path, ["{}"] * 20)
+    assert split.plan_splits(str(path), 1 << 30) == [(0, 2)]
+    # Plain gzip can't be split.
+    plain = tmp_path / "plain.jsonl.gz"
+    with gzip.open(plain, "wt") as wf:
+        wf.write("{}\n")
+    assert split.plan_splits(str(plain), 1) == [(0, None)]
+
+
+@pytest.mark.parametrize("extension", ["gz", "zst"])
+def test_merge_parts_keeps_part_order(tmp_path, extension):
+    destination = tmp_path / f"shard.jsonl.{extension}"
+    parts, lines = [], []
+    for part in range(3):
+        path = split.part_path(str(destination), part)
+        part_lines = [f'{{"id": "{part}-{i}"}}' for i in range(25)]
+        write_shard(path, part_lines)
+        parts.append(path)
+        lines.extend(part_lines)
+    split.merge_parts(parts, str(destination))
+    assert os.listdir(tmp_path) == [destination.name]
+    assert read_lines(destination) == lines
+    # The merged shard can still be split at each block.
+    sizes = split.block_sizes(str(destination))
+    assert len(sizes) == 9
+    assert read_lines(destination, 3, 4) == lines[25:35]
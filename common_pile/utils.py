@@ -1,11 +1,17 @@
 """Shared utilities like string processing."""
 
 import glob
+import io
 import os
 import re
 from contextlib import contextmanager
 from tempfile import TemporaryDirectory
-from typing import Optional
+from typing import Iterator, Optional
+
+import smart_open
+
+# The file patterns for dolma shards we write, .jsonl.gz is the default.
+DOLMA_PATTERNS = ("*.jsonl.gz", "*.jsonl.zst")
 
 
 # We don't use snake case as the string methods added in PIP616 are named like this.
@@ -25,7 +31,13 @@ def removesuffix(s: str, suffix: str) -> str:
     return s[:]
 
 
-def dolma_input(input_path: str, filepattern: str = "*.jsonl.gz") -> str:
+def dolma_input(input_path: str, filepattern: Optional[str] = "auto") -> str:
+    """Find the dolma files in `input_path`.
+
+    When `filepattern` is "auto", the first pattern in `DOLMA_PATTERNS` that
+    matches files in the `documents` dir is used, so .jsonl.zst datasets work
+    without needing to pass a pattern.
+    """
     # If the input is directly to a file, or it is a glob that returns matches,
     # use as is.
     if (
@@ -40,9 +52,29 @@ def dolma_input(input_path: str, filepattern: str = "*.jsonl.gz") -> str:
         raise ValueError(
             "filepattern must be provided when input_path isn't a file/matched glob."
         )
+    if filepattern == "auto":
+        filepattern = find_dolma_pattern(os.path.join(input_path, "documents"))
     return os.path.join(input_path, "documents", filepattern)
 
 
+def find_dolma_pattern(documents_dir: str) -> str:
+    """Which of the `DOLMA_PATTERNS` has files in `documents_dir`."""
+    for pattern in DOLMA_PATTERNS:
+        if next(glob.iglob(os.path.join(documents_dir, pattern)), None):
+            return pattern
+    return DOLMA_PATTERNS[0]
+
+
+def open_dolma(path: str):
+    """Open a dolma file to read text lines, handles our seekable .zst shards."""
+    if path.endswith(".zst"):
+        # Only required when reading zstd shards.
+        from common_pile import zstd
+
+        return zstd.open_seekable(path)
+    return smart_open.open(path)
+
+
 def dolma_output(output_path: str):
     # Make sure the output ends in .../documents, many people forget this.
     if re.match(".*/documents/?$", output_path):
@@ -57,3 +89,42 @@ def maybe_temp_dir(path: Optional[str] = None):
     else:
         with TemporaryDirectory() as tmpdir:
             yield tmpdir
+
+
+class ChunksReader(io.RawIOBase):
+    """Present an iterator of bytes (e.g. decompressed blocks) as a readable file.
+
+    Closing the reader closes `fileobj`, the file the chunks are read from.
+    """
+
+    def __init__(self, fileobj, chunks: Iterator[bytes]):
+        self.fileobj = fileobj
+        self.chunks = chunks
+        # A memoryview so consuming part of a chunk doesn't copy the rest.
+        self.buffer = memoryview(b"")
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self.buffer:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                return 0
+            self.buffer = memoryview(chunk)
+        n = min(len(b), len(self.buffer))
+        b[:n] = self.buffer[:n]
+        self.buffer = self.buffer[n:]
+        return n
+
+    def close(self):
+        if not self.closed:
+            self.fileobj.close()
+        super().close()
+
+
+def open_chunks(fileobj, chunks: Iterator[bytes]) -> io.TextIOWrapper:
+    """Read the utf-8 text in `chunks` as a file."""
+    return io.TextIOWrapper(
+        io.BufferedReader(ChunksReader(fileobj, chunks)), encoding="utf-8"
+    )
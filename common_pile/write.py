@@ -1,22 +1,30 @@
 """Utilities that have to do with writing data."""
 
 import abc
-import copy
+import collections
 import datetime
-import json
+import enum
+import hashlib
+import itertools
 import logging
 import multiprocessing as mp
 import os
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import ExitStack
 from queue import Queue
-from typing import Dict, Iterator
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
 
 import contextual_logger
 import smart_open
 import tqdm
-from dolma.core.parallel import BaseParallelProcessor
+from dolma.core.parallel import AllPathsTuple
 
+from common_pile import blocked_gzip, codec, manifest, rawjson, utils
+from common_pile.codec import serialize_datetime
 from common_pile.logs import configure_logging, get_logger
+from common_pile.parallel import ParallelProcessor
 
 
 def shard_name(filename: str, shard: str, padding: int = 5):
@@ -24,12 +32,374 @@ def shard_name(filename: str, shard: str, padding: int = 5):
     return f"{shard:>0{padding}}_{filename}"
 
 
-def serialize_datetime(obj):
-    """Convert datetime.datetime to ISO format string for JSON serialization."""
-    if isinstance(obj, datetime.datetime):
-        return obj.isoformat()
-    else:
-        raise ValueError(f"Object of type {type(obj)} is not serializable.")
+class SizePolicy(enum.Enum):
+    """How the size of a shard is measured when deciding to start a new one.
+
+    BYTES: The number of uncompressed utf-8 bytes, including newlines.
+    COMPRESSED: The number of bytes the compressor has output, i.e. the on-disk
+      size. Documents are compressed a block at a time, so this lags by at most
+      one block.
+    DOCUMENTS: The number of documents, `shard_size` is then a count, not GB.
+    """
+
+    BYTES = "bytes"
+    COMPRESSED = "compressed"
+    DOCUMENTS = "documents"
+
+    def max_size(self, shard_size: float) -> float:
+        if self is SizePolicy.DOCUMENTS:
+            return shard_size
+        # Gigabytes, not Gibibytes
+        return shard_size * 1000 * 1000 * 1000
+
+    def measure(self, line: str) -> int:
+        """How much writing `line` adds to the shard before it is compressed."""
+        if self is SizePolicy.DOCUMENTS:
+            return 1
+        if self is SizePolicy.BYTES:
+            return utf8_length(line) + 1
+        # The compressed size of a line is only known after it is written.
+        return 0
+
+
+def utf8_length(line: str) -> int:
+    """The number of bytes in the utf-8 encoding of `line`."""
+    # str.isascii is O(1) for python's compact ascii strings, and English text
+    # often is ascii, so skip the encode then. orjson writes raw utf-8 rather
+    # than escaping unicode, so other text still pays for the encode.
+    if line.isascii():
+        return len(line)
+    return len(line.encode("utf-8", "surrogatepass"))
+
+
+# Compression is picked based on the file extension.
+COMPRESSION_EXTENSIONS = {".gz": "gz", ".zst": "zst"}
+DEFAULT_COMPRESSLEVEL = {"gz": 9, "zst": 3}
+
+
+def compression_type(path: str) -> Optional[str]:
+    """The compression we use for `path`, "gz", "zst", or None for uncompressed."""
+    return COMPRESSION_EXTENSIONS.get(os.path.splitext(path)[1])
+
+
+def with_compression(path: str, compression: Optional[str]) -> str:
+    """Swap the compression extension of `path`, e.g. .jsonl.gz -> .jsonl.zst"""
+    if compression_type(path) is not None:
+        path = os.path.splitext(path)[0]
+    return f"{path}.{compression}" if compression else path
+
+
+class CountingWriter:
+    """Wrap a binary file and count (and hash) the bytes written through it.
+
+    `digest` is the sha256 of anything that was already in the file.
+    """
+
+    def __init__(self, fileobj, bytes_written: int = 0, digest=None):
+        self.fileobj = fileobj
+        self.bytes_written = bytes_written
+        self.digest = digest if digest is not None else hashlib.sha256()
+        self.closed = False
+
+    def write(self, b: bytes):
+        self.bytes_written += len(b)
+        self.digest.update(b)
+        return self.fileobj.write(b)
+
+    def flush(self):
+        self.fileobj.flush()
+
+    def fsync(self):
+        """Make sure written data survives the machine going down, if we can."""
+        self.flush()
+        if hasattr(self.fileobj, "fileno"):
+            os.fsync(self.fileobj.fileno())
+
+    def close(self):
+        if not self.closed:
+            self.fileobj.close()
+            self.closed = True
+
+
+class ShardWriter:
+    """Write serialized json lines to one dolma shard, tracking its size.
+
+    The compression is selected by the file extension, `.gz` is gzip and `.zst`
+    is zstd, anything else is written uncompressed. Compressed shards are
+    written as a series of independent blocks, each with at most
+    `frame_documents` documents or `block_bytes` bytes. For gzip each block is
+    a member (see `blocked_gzip`), for zstd each block is a frame in the
+    seekable format (see `zstd`). This lets readers jump to, or split work at,
+    block boundaries.
+
+    `resume` is a dict returned by `checkpoint`, the (local) file is truncated
+    to the checkpoint and new lines are appended after it.
+
+    With `write_behind` > 0, full blocks are handed to a background thread that
+    compresses and writes them, with at most `write_behind` blocks waiting.
+    The caller can then keep working while the compression (which releases the
+    GIL) and the (possibly slow, remote) writes happen. Uncompressed shards are
+    also written in blocks in this mode. Errors from the writer are raised on
+    the next `write` or on `close`.
+
+    With `index=True` a sidecar index of where each document is, by position
+    and id, is saved next to the shard when it is closed, see `index`.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        size_policy: SizePolicy = SizePolicy.BYTES,
+        compresslevel: Optional[int] = None,
+        frame_documents: int = 1000,
+        block_bytes: int = 8 * 1024 * 1024,
+        resume: Optional[Dict] = None,
+        write_behind: int = 0,
+        index: bool = False,
+    ):
+        self.path = path
+        self.size_policy = SizePolicy(size_policy)
+        self.compression = compression_type(path)
+        if compresslevel is None:
+            compresslevel = DEFAULT_COMPRESSLEVEL.get(self.compression)
+        self.compresslevel = compresslevel
+        self.frame_documents = frame_documents
+        self.block_bytes = block_bytes
+        self.documents = 0
+        self.bytes = 0
+        if resume is None:
+            # We handle compression ourselves so we can see the compressor output.
+            self._raw = CountingWriter(
+                smart_open.open(path, "wb", compression="disable")
+            )
+        else:
+            # Checkpoints are only made for local (shadow) files, so we can use
+            # truncate to drop anything written after the checkpoint.
+            fileobj = open(path, "r+b")
+            fileobj.truncate(resume["offset"])
+            digest = hashlib.sha256()
+            while chunk := fileobj.read(16 * 1024 * 1024):
+                digest.update(chunk)
+            self._raw = CountingWriter(fileobj, resume["offset"], digest)
+            self.documents = resume["documents"]
+            self.bytes = resume["bytes"]
+        self._zstd = None
+        if self.compression == "zst":
+            # Only required when writing zstd shards.
+            from common_pile import zstd
+
+            self._zstd = zstd.SeekableZstdWriter(self._raw, compresslevel)
+            if resume is not None:
+                self._zstd.entries = [tuple(e) for e in resume["frames"]]
+        # Encoded lines for the block that is currently being built.
+        self._block = []
+        self._block_size = 0
+        # The number of blocks that have been flushed.
+        self._blocks = 0
+        self._index = None
+        # The index entries for a resumed shard are rebuilt from the file.
+        self._reindex = index and resume is not None
+        if index and resume is None:
+            # Only required when writing an index.
+            from common_pile.index import IndexBuilder
+
+            self._index = IndexBuilder()
+        self._queue = None
+        self._writer_error = None
+        if write_behind:
+            self._queue = Queue(maxsize=write_behind)
+            self._writer = threading.Thread(target=self._write_blocks, daemon=True)
+            self._writer.start()
+
+    @property
+    def compressed_bytes(self) -> int:
+        return self._raw.bytes_written
+
+    @property
+    def sha256(self) -> str:
+        """The hash of the file, only final once the writer is closed."""
+        return self._raw.digest.hexdigest()
+
+    @property
+    def size(self) -> int:
+        if self.size_policy is SizePolicy.DOCUMENTS:
+            return self.documents
+        if self.size_policy is SizePolicy.BYTES:
+            return self.bytes
+        return self.compressed_bytes
+
+    def write(self, line: str, doc_id=None):
+        """Write a single json line, the newline is added for you.
+
+        `doc_id` is only used for the index, if it isn't given it is read from
+        the line.
+        """
+        data = f"{line}\n".encode("utf-8", "surrogatepass")
+        if self._index is not None:
+            self._index_line(line, self._block_size, doc_id)
+        if self.compression is None and self._queue is None:
+            self._raw.write(data)
+        else:
+            self._block.append(data)
+            self._block_size += len(data)
+            if (
+                len(self._block) >= self.frame_documents
+                or self._block_size >= self.block_bytes
+            ):
+                self._flush_block()
+        self.documents += 1
+        self.bytes += len(data)
+
+    def _flush_block(self):
+        if self._block:
+            data, lines = b"".join(self._block), len(self._block)
+            self._block = []
+            self._block_size = 0
+            self._blocks += 1
+            if self._queue is None:
+                self._append(self._compress(data, lines), len(data))
+            else:
+                self._raise_writer_error()
+                self._queue.put((data, lines))
+
+    def _write_blocks(self):
+        """Compress and write blocks from the queue, runs on the writer thread."""
+        while (item := self._queue.get()) is not None:
+            try:
+                # After an error keep draining so the producer never blocks.
+                if self._writer_error is None:
+                    data, lines = item
+                    self._append(self._compress(data, lines), len(data))
+            except BaseException as e:
+                self._writer_error = e
+            finally:
+                self._queue.task_done()
+        self._queue.task_done()
+
+    def _raise_writer_error(self):
+        if self._writer_error is not None:
+            raise self._writer_error
+
+    def _wait_for_writer(self):
+        """Block until every queued block is on disk."""
+        if self._queue is not None:
+            self._queue.join()
+            self._raise_writer_error()
+
+    def _compress(self, data: bytes, lines: int) -> bytes:
+        if self.compression == "gz":
+            return blocked_gzip.compress_block(data, lines, self.compresslevel)
+        if self.compression == "zst":
+            return self._zstd.compress(data)
+        return data
+
+    def _index_line(self, line: str, offset: int, doc_id=None):
+        """Add `line`, which starts `offset` bytes into the current block, to the index."""
+        if self.compression is None:
+            # Uncompressed lines are indexed by where they are in the file, so
+            # the index doesn't depend on how they were buffered. `bytes`
+            # counts the lines buffered in the current block too.
+            self._index.add_block(self.bytes - self._block_size + offset)
+            self._index.add(line, len(self._index.block_offsets) - 1, 0, doc_id)
+        else:
+            self._index.add(line, self._blocks, offset, doc_id)
+
+    def _append(self, block: bytes, size: int):
+        if self._index is not None and self.compression is not None:
+            self._index.add_block(self.compressed_bytes)
+        if self._zstd is not None:
+            self._zstd.write_compressed_frame(block, size)
+        else:
+            self._raw.write(block)
+
+    def checkpoint(self) -> Dict:
+        """Make everything written so far durable and return how to resume here.
+
+        This ends the current block, so the output file is valid if it is
+        truncated to the returned offset.
+        """
+        self._flush_block()
+        self._wait_for_writer()
+        self._raw.fsync()
+        return {
+            "offset": self.compressed_bytes,
+            "documents": self.documents,
+            "bytes": self.bytes,
+            "frames": list(self._zstd.entries) if self._zstd is not None else [],
+        }
+
+    def encode_block(self, lines: List[str]) -> bytes:
+        """Encode `lines` into a block that can be appended with `write_block`.
+
+        This doesn't touch the file, so it can run on a worker thread.
+        """
+        return self._compress(
+            "".join(f"{line}\n" for line in lines).encode("utf-8", "surrogatepass"),
+            len(lines),
+        )
+
+    def write_block(
+        self,
+        block: bytes,
+        documents: int,
+        size: int,
+        lines: Optional[List[str]] = None,
+    ):
+        """Append a block made by `encode_block`, `size` is its uncompressed size.
+
+        When writing an index, `lines` are the lines that were encoded.
+        """
+        self._flush_block()
+        self._wait_for_writer()
+        if self._index is not None:
+            if lines is None:
+                raise ValueError("The lines in a block are needed to index it.")
+            offset = 0
+            for line in lines:
+                self._index_line(line, offset)
+                offset += utf8_length(line) + 1
+        self._blocks += 1
+        self._append(block, size)
+        self.documents += documents
+        self.bytes += size
+
+    def full(self, line: str, max_size: float) -> bool:
+        """Would writing `line` push this shard over `max_size`?
+
+        An empty shard is never full, so a single huge document still gets written.
+        """
+        return bool(self.documents) and (
+            self.size + self.size_policy.measure(line) > max_size
+        )
+
+    def close(self):
+        if self._raw.closed:
+            return
+        try:
+            self._flush_block()
+        finally:
+            if self._queue is not None and self._writer.is_alive():
+                self._queue.put(None)
+                self._writer.join()
+        try:
+            self._raise_writer_error()
+            if self._zstd is not None:
+                # Writes the seek table.
+                self._zstd.close()
+        finally:
+            self._raw.close()
+        if self._index is not None:
+            self._index.save(self.path)
+        elif self._reindex:
+            from common_pile.index import build_index
+
+            build_index(self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
 
 
 # TODO: Add overwrite protection
@@ -40,30 +410,193 @@ def to_dolma(
     shard_size: int = 1,
     quiet: bool = False,
     shard_idx: int = 0,
+    compress_workers: int = 0,
+    block_size: int = 1000,
+    size_policy: SizePolicy = SizePolicy.BYTES,
+    frame_documents: int = 1000,
+    index: bool = False,
 ):
-    """Write `examples` to `path` in the dolma format with `shard_size`GB shards."""
+    """Write `examples` to `path` in the dolma format with `shard_size`GB shards.
+
+    When `compress_workers` > 0, compression is moved to a pool of background
+    threads, see `to_dolma_parallel`. `size_policy` controls
+    how the size of a shard is measured, see `SizePolicy`.
+
+    The shard format follows `filename`, use `.jsonl.zst` for seekable zstd
+    shards with a frame every `frame_documents` documents (`block_size` when
+    using `compress_workers`) instead of `.jsonl.gz`. With `index=True` each
+    shard gets a sidecar index for random access, see `common_pile.index`.
+    """
+    if compress_workers > 0:
+        return to_dolma_parallel(
+            examples,
+            path,
+            filename,
+            shard_size=shard_size,
+            quiet=quiet,
+            shard_idx=shard_idx,
+            workers=compress_workers,
+            block_size=block_size,
+            size_policy=size_policy,
+            index=index,
+        )
     logger = get_logger()
     logger.info("Writing Dolma Shards to %s", path)
     os.makedirs(path, exist_ok=True)
-    size = 0
-    # Gigabytes, not Gibibytes
-    max_bytes = shard_size * 1000 * 1000 * 1000
+    size_policy = SizePolicy(size_policy)
+    max_size = size_policy.max_size(shard_size)
     with ExitStack() as stack:
         wf = stack.enter_context(
-            smart_open.open(os.path.join(path, shard_name(filename, shard_idx)), "w")
+            ShardWriter(
+                os.path.join(path, shard_name(filename, shard_idx)),
+                size_policy,
+                frame_documents=frame_documents,
+                index=index,
+            )
         )
         for example in tqdm.tqdm(examples, disable=quiet):
-            data = json.dumps(example, default=serialize_datetime)
-            # Assume one character is about 1 bytes, good enough as we use utf-8
-            size += len(data)
-            if size >= max_bytes:
+            data = codec.dumps(example, default=serialize_datetime)
+            if wf.full(data, max_size):
                 wf.close()
                 shard_idx += 1
                 shard_file = os.path.join(path, shard_name(filename, shard_idx))
-                wf = stack.enter_context(smart_open.open(shard_file, "w"))
+                wf = stack.enter_context(
+                    ShardWriter(
+                        shard_file,
+                        size_policy,
+                        frame_documents=frame_documents,
+                        index=index,
+                    )
+                )
+                logger.info("Shard size exceeded, creating new shard at %s", shard_file)
+            wf.write(data, example.get("id"))
+
+
+def batched(iterable, n: int):
+    """Group `iterable` into lists of at most `n` items, itertools.batched is 3.12+"""
+    it = iter(iterable)
+    while batch := list(itertools.islice(it, n)):
+        yield batch
+
+
+def serialize_block(examples: List[Dict]) -> List[str]:
+    """Convert a block of examples into json lines."""
+    return [codec.dumps(example, default=serialize_datetime) for example in examples]
+
+
+def to_dolma_parallel(
+    examples: Iterator[Dict],
+    path: str,
+    filename: str,
+    shard_size: int = 1,
+    quiet: bool = False,
+    shard_idx: int = 0,
+    workers: int = mp.cpu_count(),
+    block_size: int = 1000,
+    compresslevel: Optional[int] = None,
+    size_policy: SizePolicy = SizePolicy.BYTES,
+    index: bool = False,
+):
+    """Write `examples` like `to_dolma` but compress blocks on background threads.
+
+    The pipeline has three stages:
+      1. Blocks of `block_size` examples are serialized to json on the calling
+         thread. Serialization holds the GIL, so threads wouldn't speed it up.
+      2. The serialized lines are assigned to shards, in order, on the calling
+         thread using the same size check as `to_dolma`. Once a block of lines
+         for a shard is full it is sent to the pool for compression, as a gzip
+         member or a zstd frame. zlib and zstd release the GIL, so `workers`
+         blocks are compressed at once, overlapping with the calling thread.
+      3. Compressed blocks are appended, in order, to their shard.
+
+    `workers` only controls compression, to parallelize making and serializing
+    the examples use processes, e.g. a `ShardParallelProcessor`.
+
+    The number of blocks in flight in each stage is bounded so a slow disk
+    doesn't result in all of `examples` being buffered in memory. With the
+    `COMPRESSED` size policy the shard size only includes blocks that have been
+    written, so shards can overshoot by the blocks that are in flight.
+    """
+    logger = get_logger()
+    logger.info("Writing Dolma Shards to %s with %d workers", path, workers)
+    os.makedirs(path, exist_ok=True)
+    size_policy = SizePolicy(size_policy)
+    max_size = size_policy.max_size(shard_size)
+    # The writer only sees blocks once they are written, so track the size of
+    # the lines assigned to the current shard here.
+    documents = 0
+    size = 0
+    max_in_flight = 2 * workers
+    # (file, compressed block, lines, bytes) or (file, None, None, 0) which
+    # means close the file once everything before it has been written.
+    writing = collections.deque()
+
+    def drain_writes(limit: int):
+        while len(writing) > limit:
+            wf, block, block_lines, block_bytes = writing.popleft()
+            if block is None:
+                wf.close()
+            else:
+                wf.write_block(
+                    block.result(), len(block_lines), block_bytes, block_lines
+                )
+
+    def open_shard(idx: int):
+        shard_file = os.path.join(path, shard_name(filename, idx))
+        return shard_file, ShardWriter(
+            shard_file, size_policy, compresslevel, index=index
+        )
+
+    _, wf = open_shard(shard_idx)
+    lines = []
+    lines_size = 0
+
+    def flush_lines():
+        nonlocal lines, lines_size
+        if lines:
+            block = pool.submit(wf.encode_block, lines)
+            writing.append((wf, block, lines, lines_size))
+            lines = []
+            lines_size = 0
+        drain_writes(max_in_flight)
+
+    def assign_shards(block: List[str]):
+        nonlocal documents, size, shard_idx, wf, lines_size
+        for data in block:
+            line_size = SizePolicy.BYTES.measure(data)
+            if size_policy is SizePolicy.COMPRESSED:
+                current = wf.compressed_bytes
+            elif size_policy is SizePolicy.DOCUMENTS:
+                current = documents + 1
+            else:
+                current = size + line_size
+            if documents and current > max_size:
+                flush_lines()
+                writing.append((wf, None, None, 0))
+                shard_idx += 1
+                shard_file, wf = open_shard(shard_idx)
                 logger.info("Shard size exceeded, creating new shard at %s", shard_file)
+                documents = 0
                 size = 0
-            wf.write(data + "\n")
+            lines.append(data)
+            lines_size += line_size
+            documents += 1
+            size += line_size
+        if len(lines) >= block_size:
+            flush_lines()
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        try:
+            with tqdm.tqdm(disable=quiet) as pbar:
+                for block in batched(examples, block_size):
+                    assign_shards(serialize_block(block))
+                    pbar.update(len(block))
+            flush_lines()
+        finally:
+            # Make sure everything that was produced ends up on disk and every
+            # shard is closed, even if the generator raised.
+            drain_writes(0)
+            wf.close()
 
 
 def smart_open_exists(path):
@@ -80,8 +613,250 @@ def create_shadow(path):
     return os.path.join(h, f"shadow.{t}")
 
 
-class ShardParallelProcessor(BaseParallelProcessor):
-    """Handle read/writes to jsonl.gz so our processor code only needs to processing a single example."""
+def checkpoint_path(path: str) -> str:
+    """Where the checkpoint for the shadow file `path` is saved."""
+    return f"{path}.checkpoint"
+
+
+def read_checkpoint(path: str) -> Optional[Dict]:
+    """Read the checkpoint for shadow file `path`, None if there isn't one."""
+    if not (os.path.exists(path) and os.path.exists(checkpoint_path(path))):
+        return None
+    with open(checkpoint_path(path)) as f:
+        return codec.loads(f.read())
+
+
+def write_checkpoint(path: str, checkpoint: Dict):
+    """Atomically save the `checkpoint` for shadow file `path`."""
+    ckpt = checkpoint_path(path)
+    with open(f"{ckpt}.tmp", "w") as wf:
+        wf.write(codec.dumps(checkpoint))
+    os.replace(f"{ckpt}.tmp", ckpt)
+
+
+class ShardParallelProcessor(ParallelProcessor):
+    """Handle read/writes to jsonl.gz so our processor code only needs to processing a single example.
+
+    Calling the processor with `split_size=N` splits (local) input shards that
+    are larger than N bytes on disk into ranges of blocks that are processed
+    as separate tasks, so one huge shard doesn't leave a single worker busy
+    long after the others have finished. The outputs for each range are
+    merged back, in order, into a single shard at the usual destination.
+
+    Processors that only look at a few fields can list them in `fields`, e.g.
+    `fields = ("metadata.authors",)`. Then only those values are decoded,
+    `process_example` gets a dict with just them, and the values it returns
+    are spliced back into the original line so the rest of the document is
+    copied through as is. Fields missing from the result are removed.
+    """
+
+    # Dotted paths to the only fields this processor reads or writes, None
+    # means the whole document is decoded.
+    fields: Optional[Sequence[str]] = None
+    # Bump this when a change to the processor should invalidate old outputs.
+    version: str = "1"
+
+    def __call__(self, **process_single_kwargs):
+        self.split_size = process_single_kwargs.pop("split_size", 0)
+        # Track outputs in a manifest in each destination dir, see `manifest`.
+        self.use_manifest = process_single_kwargs.pop("manifest", True)
+        self.overwrite = process_single_kwargs.get("overwrite", False)
+        self.compression = process_single_kwargs.get("compression", "match")
+        self.options = manifest.options_digest(process_single_kwargs)
+        # The destination for each split source, the (destination, metadata)
+        # paths of its parts, and its manifest info, filled in by `_get_all_paths`.
+        self.splits: Dict[str, Tuple[str, str, List[Tuple[str, str]], Dict]] = {}
+        super().__call__(**process_single_kwargs)
+        self.merge_splits(self.compression)
+        if self.use_manifest:
+            for root in self.dst_prefixes:
+                manifest.Manifest(root).save()
+
+    @classmethod
+    def processor_name(cls) -> str:
+        module = cls.__module__
+        if module in ("__main__", "__mp_main__"):
+            # A script is `__main__` here but `__mp_main__` in spawned workers,
+            # which record the manifest entries, so name it by its file.
+            path = getattr(sys.modules[module], "__file__", module)
+            module = os.path.splitext(os.path.basename(path))[0]
+        return f"{module}.{cls.__qualname__}"
+
+    def output_path(self, destination_path: str) -> str:
+        """Where `process_single` will actually write `destination_path`."""
+        if self.compression != "match":
+            return with_compression(destination_path, self.compression)
+        return destination_path
+
+    def _get_all_paths(self) -> AllPathsTuple:
+        if self.use_manifest:
+            # dolma drops inputs with a `.done.txt` metadata file before we see
+            # them, list them all so the manifest can rerun stale ones.
+            ignore_existing = self.ignore_existing
+            self.ignore_existing = True
+            try:
+                all_paths = super()._get_all_paths()
+            finally:
+                self.ignore_existing = ignore_existing
+            all_paths = self.skip_current(all_paths)
+        else:
+            all_paths = super()._get_all_paths()
+        if not self.split_size:
+            return all_paths
+        # Avoid a circular import, split needs our compression helpers.
+        from common_pile import split
+
+        logger = self.get_logger()
+        tasks = AllPathsTuple.empty()
+        for src, dst, meta, kwargs in zip(*all_paths):
+            ranges = (
+                split.plan_splits(src, self.split_size)
+                # Parts are merged with local renames/appends.
+                if os.path.exists(src)
+                and os.path.getsize(src) > self.split_size
+                and "://" not in dst
+                and (
+                    self.overwrite
+                    or not os.path.exists(self.output_path(dst))
+                    # The manifest says the existing output is stale.
+                    or not (kwargs or {}).get("manifest", {}).get("check_exists", True)
+                )
+                else [None]
+            )
+            if len(ranges) == 1:
+                tasks.src.append(src)
+                tasks.dst.append(dst)
+                tasks.meta.append(meta)
+                tasks.kwargs.append(kwargs)
+                continue
+            logger.info("Splitting %s into %d parts", src, len(ranges))
+            parts = []
+            for k, blocks in enumerate(ranges):
+                part_dst, part_meta = split.part_path(dst, k), split.part_path(meta, k)
+                parts.append((part_dst, part_meta))
+                # Parts that finished in an earlier, failed, run are kept.
+                if not self.ignore_existing and os.path.exists(part_meta):
+                    continue
+                tasks.src.append(src)
+                tasks.dst.append(part_dst)
+                tasks.meta.append(part_meta)
+                # The manifest entry is recorded for the merged shard.
+                part_kwargs = {
+                    k: v for k, v in (kwargs or {}).items() if k != "manifest"
+                }
+                tasks.kwargs.append({**part_kwargs, "blocks": blocks})
+            self.splits[src] = (dst, meta, parts, (kwargs or {}).get("manifest"))
+        return tasks
+
+    def skip_current(self, all_paths: AllPathsTuple) -> AllPathsTuple:
+        """Drop the tasks whose outputs the manifests say are up to date.
+
+        Directories without a manifest yet (e.g. outputs from before we wrote
+        them) fall back to dolma's `.done.txt` metadata files.
+        """
+        logger = self.get_logger()
+        manifests = {root: manifest.Manifest(root) for root in self.dst_prefixes}
+        # The longest prefix is the output directory each file is in.
+        roots = [
+            max((r for r in manifests if dst.startswith(r)), key=len)
+            for dst in all_paths.dst
+        ]
+        check_done = not (self.overwrite or self.ignore_existing)
+
+        def is_done(meta: str, root: str) -> bool:
+            return check_done and not manifests[root] and smart_open_exists(meta)
+
+        def is_current(dst: str, root: str, info: Dict) -> bool:
+            output = manifest.relative_path(root, self.output_path(dst))
+            return not self.overwrite and manifests[root].is_current(
+                output, info, self.processor_name(), self.version, self.options
+            )
+
+        # Stat-ing remote files is a round trip each, so do them concurrently.
+        with ThreadPoolExecutor(max_workers=32) as pool:
+            infos = list(pool.map(manifest.file_info, all_paths.src))
+            done = list(pool.map(is_done, all_paths.meta, roots))
+            current = list(pool.map(is_current, all_paths.dst, roots, infos))
+        tasks = AllPathsTuple.empty()
+        skipped = 0
+        for src, dst, meta, kwargs, info, root, finished, up_to_date in zip(
+            *all_paths, infos, roots, done, current
+        ):
+            if finished or up_to_date:
+                skipped += 1
+                continue
+            tasks.src.append(src)
+            tasks.dst.append(dst)
+            tasks.meta.append(meta)
+            tasks.kwargs.append(
+                {
+                    **(kwargs or {}),
+                    "manifest": {
+                        "root": root,
+                        "source_info": info,
+                        "version": self.version,
+                        "options": self.options,
+                        # Without a manifest, fall back to checking if the
+                        # output exists and record it as current if it does.
+                        "check_exists": not manifests[root],
+                    },
+                }
+            )
+        logger.info("Skipping %d shards that are up to date", skipped)
+        return tasks
+
+    def merge_splits(self, compression: str = "match"):
+        """Merge the outputs of each split shard back into a single shard."""
+        from common_pile import index, split
+
+        for src, (dst, meta, parts, manifest_info) in self.splits.items():
+            if compression != "match":
+                dst = with_compression(dst, compression)
+                parts = [(with_compression(p, compression), m) for p, m in parts]
+            indexed = os.path.exists(index.index_path(parts[0][0]))
+            split.merge_parts([p for p, _ in parts], dst)
+            if indexed:
+                # Block offsets change when parts are appended, so reindex.
+                for part, _ in parts:
+                    os.remove(index.index_path(part))
+                index.build_index(dst)
+            if manifest_info is not None:
+                self.record(
+                    src,
+                    dst,
+                    manifest_info,
+                    manifest.file_sha256(dst),
+                    os.path.getsize(dst),
+                )
+            with smart_open.open(meta, "w") as wf:
+                wf.write(datetime.datetime.now().isoformat())
+            for _, part_meta in parts:
+                os.remove(part_meta)
+
+    @classmethod
+    def record(
+        cls,
+        source_path: str,
+        destination_path: str,
+        manifest_info: Dict,
+        sha256: Optional[str],
+        size: Optional[int] = None,
+    ):
+        """Add `destination_path` to the manifest of its output directory."""
+        root = manifest_info["root"]
+        manifest.record(
+            root,
+            manifest.make_entry(
+                output=manifest.relative_path(root, destination_path),
+                source=source_path,
+                source_info=manifest_info["source_info"],
+                processor=cls.processor_name(),
+                version=manifest_info["version"],
+                options=manifest_info["options"],
+                output_sha256=sha256,
+                output_size=size,
+            ),
+        )
 
     @classmethod
     def increment_progressbar(
@@ -99,8 +874,49 @@ class ShardParallelProcessor(BaseParallelProcessor):
         """Code to process a single example in the dolma format, not the whole file."""
 
     @classmethod
-    def get_logger(cls):
-        return get_logger()
+    def process_batch(cls, examples: List[Dict], **kwargs) -> List[Optional[Dict]]:
+        """Code to process a batch of examples, set the size with `batch_size=...`
+
+        Override this when setup can be shared across examples, or the work can
+        be vectorized. It must return one result per example, in the same order,
+        where `None` means the example is dropped. `line_numbers` gives the line
+        each example came from. The default calls `process_example` on each.
+        """
+        line_numbers = kwargs.pop("line_numbers")
+        return [
+            cls.process_example(example, line_number=i, **kwargs)
+            for example, i in zip(examples, line_numbers)
+        ]
+
+    @classmethod
+    def read_examples(
+        cls, f, start: int = 0
+    ) -> Iterator[Tuple[int, Dict, Optional[rawjson.PartialDocument]]]:
+        """Yield (line number, example, raw document) for each parsable line in `f`.
+
+        Lines before `start` are skipped. The raw document is only kept when
+        the processor declares its `fields`, otherwise it is None.
+        """
+        logger = cls.get_logger()
+        paths = rawjson.parse_fields(cls.fields) if cls.fields is not None else None
+        for i, line in enumerate(f):
+            # Skip lines before we parse them when resuming from a checkpoint.
+            if i < start:
+                continue
+            try:
+                if paths is None:
+                    yield i, codec.loads(line), None
+                else:
+                    document = rawjson.PartialDocument(line, paths)
+                    yield i, document.example(), document
+            # The raw scanner raises json's errors, which are ValueErrors.
+            except (codec.JSONDecodeError, ValueError) as e:
+                with logger(line=i):
+                    logger.warning(
+                        "Failed to parse JSON from `%s...`",
+                        line[:80],
+                        exc_info=True,
+                    )
 
     @classmethod
     def process_single(
@@ -113,59 +929,130 @@ class ShardParallelProcessor(BaseParallelProcessor):
         logger = cls.get_logger()
         overwrite = kwargs.pop("overwrite", False)
         shadow = kwargs.pop("shadow", True)
-        with logger(file=source_path):
+        size_policy = SizePolicy(kwargs.pop("size_policy", SizePolicy.BYTES))
+        # Write the output as "gz", "zst", or None (uncompressed) regardless of
+        # the input format. The default is to match the input.
+        if (compression := kwargs.pop("compression", "match")) != "match":
+            destination_path = with_compression(destination_path, compression)
+        frame_documents = kwargs.pop("frame_documents", 1000)
+        # How many blocks can wait for the background writer, 0 writes inline.
+        write_behind = kwargs.pop("write_behind", 4)
+        # Save progress every `checkpoint_interval` input lines so a restarted
+        # run can continue a shard where it left off. Requires shadow paging.
+        checkpoint_interval = kwargs.pop("checkpoint_interval", 0) if shadow else 0
+        # Save a sidecar index of the output shard, see `common_pile.index`.
+        write_index = kwargs.pop("index", False)
+        # Only process this [start, stop) range of blocks, set for split shards.
+        blocks = kwargs.pop("blocks", None)
+        # Set when run through `__call__`, the manifest has already skipped
+        # shards that are up to date.
+        manifest_info = kwargs.pop("manifest", None)
+        check_exists = manifest_info is None or manifest_info["check_exists"]
+        context = {"file": source_path}
+        if blocks is not None:
+            context["blocks"] = blocks
+        with logger(**context):
             logger.debug("Processing %s into %s", source_path, destination_path)
-            if not overwrite and smart_open_exists(destination_path):
+            if not overwrite and check_exists and smart_open_exists(destination_path):
                 logger.info("%s already exists, skipping", destination_path)
+                if manifest_info is not None:
+                    cls.record(source_path, destination_path, manifest_info, None)
                 cls.increment_progressbar(queue, shards=1)
                 return
             output_path = (
                 create_shadow(destination_path) if shadow else destination_path
             )
-            with smart_open.open(source_path) as f, smart_open.open(
-                output_path, "w"
+            resume = None
+            if checkpoint_interval and not overwrite:
+                if resume := read_checkpoint(output_path):
+                    logger.info(
+                        "Resuming %s after line %d with %d documents written",
+                        output_path,
+                        resume["line"],
+                        resume["documents"],
+                    )
+            start_line = resume["line"] + 1 if resume else 0
+            if blocks is not None:
+                from common_pile import split
+
+                f = split.open_blocks(source_path, *blocks)
+            else:
+                f = utils.open_dolma(source_path)
+            with f, ShardWriter(
+                output_path,
+                size_policy,
+                frame_documents=frame_documents,
+                resume=resume,
+                write_behind=write_behind,
+                index=write_index,
             ) as wf:
                 document_count = 0
                 update_interval = kwargs.pop("update_interval", 1)
                 debug = kwargs.pop("debug", False)
+                # The text can only be compared when it is decoded.
+                check_text = debug and (cls.fields is None or "text" in cls.fields)
+                batch_size = kwargs.pop("batch_size", 1)
+                i = None
+                since_checkpoint = 0
 
                 try:
-                    for i, line in enumerate(f):
+                    for batch in batched(cls.read_examples(f, start_line), batch_size):
+                        line_numbers, examples, documents = zip(*batch)
+                        line_numbers, examples = list(line_numbers), list(examples)
+                        i = line_numbers[0]
+                        # Strings are immutable, so there is no need to copy them.
+                        og = (
+                            [data.get("text") for data in examples]
+                            if check_text
+                            else None
+                        )
                         with logger(line=i):
-                            try:
-                                data = json.loads(line)
-                            except json.JSONDecodeError as e:
-                                logger.warning(
-                                    "Failed to parse JSON from `%s...`",
-                                    line[:80],
-                                    exc_info=True,
-                                )
-                                continue
-
-                            og = copy.deepcopy(data["text"]) if debug else None
-                            processed = cls.process_example(
-                                data, source_file=source_path, line_number=i, **kwargs
+                            processed = cls.process_batch(
+                                examples,
+                                source_file=source_path,
+                                line_numbers=line_numbers,
+                                **kwargs,
                             )
-                            if processed is None:
-                                logger.warning(
-                                    "Preprocessing has reduced example to nothing, skipping"
-                                )
-                                document_count += 1
-                                continue
-
-                            if debug and og == processed["text"]:
-                                logger.warning("Text unchanged for example.")
+                        if len(processed) != len(examples):
+                            raise ValueError(
+                                f"process_batch returned {len(processed)} results "
+                                f"for {len(examples)} examples."
+                            )
+                        for j, (i, result) in enumerate(zip(line_numbers, processed)):
+                            with logger(line=i):
+                                if result is None:
+                                    logger.warning(
+                                        "Preprocessing has reduced example to nothing, skipping"
+                                    )
+                                    document_count += 1
+                                    continue
 
-                            wf.write(json.dumps(processed) + "\n")
-                            document_count += 1
+                                if check_text and og[j] == result.get("text"):
+                                    logger.warning("Text unchanged for example.")
 
-                            if document_count % update_interval == 0:
-                                cls.increment_progressbar(
-                                    queue, documents=document_count
+                                wf.write(
+                                    codec.dumps(result)
+                                    if documents[j] is None
+                                    else documents[j].update(result),
+                                    result.get("id"),
                                 )
-                                if queue.qsize() >= mp.cpu_count():
-                                    update_interval *= 2
-                                document_count = 0
+                                document_count += 1
+
+                                if document_count % update_interval == 0:
+                                    cls.increment_progressbar(
+                                        queue, documents=document_count
+                                    )
+                                    document_count = 0
+                        since_checkpoint += len(batch)
+                        if (
+                            checkpoint_interval
+                            and since_checkpoint >= checkpoint_interval
+                        ):
+                            write_checkpoint(
+                                output_path,
+                                {"line": line_numbers[-1], **wf.checkpoint()},
+                            )
+                            since_checkpoint = 0
                 except Exception as e:
                     e.add_note(f"Exception occured while processing {source_path}:{i}")
                     logger.warning(
@@ -173,8 +1060,31 @@ class ShardParallelProcessor(BaseParallelProcessor):
                         exc_info=True,
                     )
                     raise
-                # Cloud Storage generally doesn't have a cheap way to rename files. So
-                # shadow paging should generally only be used for local data.
-                if shadow:
-                    os.rename(output_path, destination_path)
-                cls.increment_progressbar(queue, shards=1, documents=document_count)
+            logger.info(
+                "Wrote %d documents to %s, shard size is %d (%s)",
+                wf.documents,
+                destination_path,
+                wf.size,
+                size_policy.value,
+            )
+            # Cloud Storage generally doesn't have a cheap way to rename files. So
+            # shadow paging should generally only be used for local data. This is
+            # done after the file is closed so the shard is complete when it
+            # appears at the destination.
+            if shadow:
+                if write_index:
+                    from common_pile.index import index_path
+
+                    os.rename(index_path(output_path), index_path(destination_path))
+                os.rename(output_path, destination_path)
+                if os.path.exists(ckpt := checkpoint_path(output_path)):
+                    os.remove(ckpt)
+            if manifest_info is not None:
+                cls.record(
+                    source_path,
+                    destination_path,
+                    manifest_info,
+                    wf.sha256,
+                    wf.compressed_bytes,
+                )
+            cls.increment_progressbar(queue, shards=1, documents=document_count)
@@ -1,10 +1,31 @@
 """Tools to help with xml parsing."""
 
-from typing import List
+import io
+import os
+from functools import partial
+from typing import Callable, Iterator, List, Optional, Sequence, Tuple
 
 import lxml.etree as ET
 
-from common_pile import logs
+from common_pile import logs, parallel
+
+# Bytes that can come after the name in an opening tag, so `<row` doesn't also
+# match `<rowset`.
+_TAG_NAME_END = frozenset(b" \t\r\n/>")
+
+
+def _free(elem: ET._Element):
+    """Clear `elem`, and delete everything before it, from the tree being parsed.
+
+    Earlier siblings are deleted at every level, so elements we don't iterate
+    over (like the wiki `<siteinfo>`) are dropped too, not just our matches.
+    """
+    elem.clear(keep_tail=True)
+    node = elem
+    while (parent := node.getparent()) is not None:
+        while node.getprevious() is not None:
+            del parent[0]
+        node = parent
 
 
 def iterate_xml(path: str, tag: str):
@@ -12,24 +33,25 @@ def iterate_xml(path: str, tag: str):
 
     Args:
       path: The path to the xml file
-      tag: The tag for the xml objects we want to iterate over.
+      tag: The tag for the xml objects we want to iterate over. This matches
+        the tag in any namespace, unless it includes one, i.e. `{ns}tag`.
+
+    Only end events for `tag` are generated, and once the consumer moves on to
+    the next element the last one is cleared and deleted, along with anything
+    before it, so memory stays flat however large the file is. This means an
+    element can't be used after the next one is requested.
 
     See https://web.archive.org/web/20201111201837/http://effbot.org/zone/element-iterparse.htm
     for more details on what it is doing.
     """
     logger = logs.get_logger()
-    context = ET.iterparse(path, events=("start", "end"))
-    context = iter(context)
-    event, root = next(context)
+    # lxml matches `{*}tag` in any namespace, or none.
+    match = tag if tag.startswith("{") else f"{{*}}{tag}"
+    context = ET.iterparse(path, events=("end",), tag=match, huge_tree=True)
     try:
-        for event, elem in context:
-            # This `.localname` only exists for lxml. Include this or so you can
-            # still do a full namespace match if you need too.
-            if event == "end" and (
-                ET.QName(elem.tag).localname == tag or elem.tag == tag
-            ):
-                yield elem
-                root.clear()
+        for _, elem in context:
+            yield elem
+            _free(elem)
     except Exception as e:
         logger.exception(f"Failed iterating over <{tag}> in {path}")
 
@@ -38,3 +60,159 @@ def iterate_xmls(paths: List[str], tag: str):
     """Iterable version of parsing multiple xml files with the same structure as a single iterator."""
     for path in paths:
         yield from iterate_xml(path, tag)
+
+
+def row_values(elem: ET._Element, attributes: Optional[Sequence[str]] = None):
+    """A dict of `elem`'s attributes, or a tuple of just `attributes` (None if unset)."""
+    if attributes is None:
+        return dict(elem.attrib)
+    return tuple(elem.get(a) for a in attributes)
+
+
+def iterate_xml_rows(
+    path: str,
+    tag: str = "row",
+    attributes: Optional[Sequence[str]] = None,
+    batch_size: Optional[int] = None,
+) -> Iterator:
+    """Iterate over the attributes of `<tag>` elements, like the rows in a dump.
+
+    Yields plain python values (see `row_values`) instead of lxml elements, so
+    they are cheap to send to other processes. With a `batch_size` lists of up
+    to that many rows are yielded instead.
+
+    Only `tag` elements (in any namespace) are built into python objects and
+    only end events are generated. Each row is freed, along with anything
+    before it, as soon as its values are read, so memory doesn't grow with the
+    size of the file. `iterate_xml_parallel` is the multicore version of this.
+    """
+    logger = logs.get_logger()
+    context = ET.iterparse(path, events=("end",), tag=f"{{*}}{tag}", huge_tree=True)
+    batch = []
+    try:
+        for _, elem in context:
+            batch.append(row_values(elem, attributes))
+            _free(elem)
+            if batch_size is None:
+                yield batch.pop()
+            elif len(batch) >= batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+    except Exception:
+        logger.exception(f"Failed iterating over <{tag}> rows in {path}")
+
+
+def _find_tag(f, pattern: bytes, offset: int, end: int, window: int = 1 << 20) -> int:
+    """Where the first tag opened with `pattern` is at or after `offset`, else `end`."""
+    while offset < end:
+        f.seek(offset)
+        # Read a little past the window so tags that straddle it are found.
+        data = f.read(min(window + len(pattern) + 1, end - offset))
+        i = data.find(pattern)
+        while i != -1 and i < window:
+            following = i + len(pattern)
+            if following < len(data) and data[following] in _TAG_NAME_END:
+                return offset + i
+            i = data.find(pattern, i + 1)
+        offset += window
+    return end
+
+
+def record_ranges(
+    path: str, tag: str, chunk_bytes: int = 16 * 1024 * 1024
+) -> Iterator[Tuple[int, int]]:
+    """Split a flat xml file into (start, end) byte ranges of whole `<tag>` records.
+
+    This only scans bytes, it doesn't parse anything. Each range starts at a
+    `<tag` and ends where the first `<tag` after `chunk_bytes` starts, the last
+    one ends at the root's closing tag. This is only right for dumps where the
+    records are siblings, don't nest, and `<tag` never shows up in the file
+    other than as a record, which is true when `<` in text and attributes is
+    escaped, like in the StackExchange or wiki dumps.
+    """
+    size = os.path.getsize(path)
+    pattern = f"<{tag}".encode("utf-8")
+    with open(path, "rb") as f:
+        # The records end where the root is closed, the last `</` in the file.
+        tail_start = max(0, size - 4096)
+        f.seek(tail_start)
+        closing = f.read().rfind(b"</")
+        end = tail_start + closing if closing != -1 else size
+        start = _find_tag(f, pattern, 0, end)
+        while start < end:
+            stop = _find_tag(f, pattern, min(start + chunk_bytes, end), end)
+            yield start, stop
+            start = stop
+
+
+def parse_range(
+    task: Tuple[str, int, int], tag: str, fn: Callable = row_values
+) -> List:
+    """Parse the `tag` records in a byte range from `record_ranges` with `fn`.
+
+    Malformed xml is logged and ends the range early, with the records parsed
+    before it, like `iterate_xml` does for a whole file. Errors from `fn` are
+    raised.
+    """
+    path, start, end = task
+    with open(path, "rb") as f:
+        f.seek(start)
+        data = f.read(end - start)
+    # The records on their own aren't a document, give them a root.
+    data = io.BytesIO(b"<records>" + data + b"</records>")
+    elements = ET.iterparse(data, events=("end",), tag=tag, huge_tree=True)
+    results = []
+    while True:
+        try:
+            _, elem = next(elements)
+        except StopIteration:
+            break
+        except ET.XMLSyntaxError:
+            logs.get_logger().exception(
+                f"Failed parsing <{tag}> in {path}, bytes {start} to {end}"
+            )
+            break
+        results.append(fn(elem))
+        _free(elem)
+    return results
+
+
+def iterate_xml_parallel(
+    path: str,
+    tag: str,
+    fn: Callable = row_values,
+    processes: Optional[int] = None,
+    pool=None,
+    chunk_bytes: int = 16 * 1024 * 1024,
+) -> Iterator:
+    """Parse the `<tag>` records of a large, flat xml file on multiple cores.
+
+    The file is split into chunks of whole records (see `record_ranges`), each
+    chunk is parsed in a worker and its records are passed to `fn`, which must
+    be picklable and defaults to `row_values`. The results are yielded in file
+    order. Uses `pool` if given, otherwise a new pool of `processes`.
+
+    Unlike `iterate_xml`, `tag` has to be the name as it is written in the
+    file, without a namespace prefix, and the file has to be utf-8. Records
+    lose the namespace of the root, if it has one.
+
+    A chunk with malformed xml is logged and cut short (see `parse_range`),
+    but an error raised by `fn` stops the iteration and is raised here.
+    """
+    yield from (
+        result
+        for results in parallel.bounded_imap(
+            partial(parse_range, tag=tag, fn=fn),
+            (
+                (path, start, end)
+                for start, end in record_ranges(path, tag, chunk_bytes)
+            ),
+            pool=pool,
+            processes=processes,
+            # Each result is a whole chunk of records.
+            max_in_flight=2 * (processes or os.cpu_count()),
+        )
+        for result in results
+    )
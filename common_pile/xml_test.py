@@ -0,0 +1,60 @@
+"""Tests for parsing xml dumps in parallel."""
+
+import pytest
+
+from common_pile import xml
+
+
+def write_rows(path, rows):
+    with open(path, "w") as f:
+        f.write('<?xml version="1.0" encoding="utf-8"?>\n<posts>\n')
+        for row in rows:
+            f.write(f"  {row}\n")
+        f.write("</posts>\n")
+
+
+def row_id(elem):
+    return int(elem.get("Id"))
+
+
+def score(elem):
+    # Like `int(None)` for a missing Score in the StackExchange preprocessing.
+    return int(elem.get("Score"))
+
+
+def test_iterate_xml_parallel_is_in_file_order(tmp_path):
+    path = tmp_path / "Posts.xml"
+    write_rows(path, [f'<row Id="{i}" Score="1" />' for i in range(1000)])
+    results = list(
+        xml.iterate_xml_parallel(str(path), "row", row_id, processes=2, chunk_bytes=512)
+    )
+    assert results == list(range(1000))
+
+
+def test_iterate_xml_parallel_raises_errors_from_fn(tmp_path):
+    path = tmp_path / "Posts.xml"
+    rows = [f'<row Id="{i}" Score="1" />' for i in range(1000)]
+    rows[500] = '<row Id="500" />'
+    write_rows(path, rows)
+    with pytest.raises(TypeError):
+        list(
+            xml.iterate_xml_parallel(
+                str(path), "row", score, processes=2, chunk_bytes=512
+            )
+        )
+
+
+def test_iterate_xml_parallel_skips_the_rest_of_a_malformed_chunk(tmp_path):
+    path = tmp_path / "Posts.xml"
+    rows = [f'<row Id="{i}" Score="1" />' for i in range(1000)]
+    rows[500] = '<row Id="500" Body="a & b" />'
+    write_rows(path, rows)
+    results = list(
+        xml.iterate_xml_parallel(str(path), "row", row_id, processes=2, chunk_bytes=512)
+    )
+    # Only the chunk with the bad row is cut short, parsing picks back up in
+    # the next one.
+    assert results[:500] == list(range(500))
+    assert 500 not in results
+    assert results[-1] == 999
+    assert results == sorted(results)
@@ -0,0 +1,134 @@
+"""Reading and writing zstd files in the seekable format.
+
+A seekable zstd file is a normal series of zstd frames followed by a skippable
+frame that holds a seek table (the compressed and decompressed size of each
+frame). Regular zstd decoders skip the table, so these are still valid .zst
+files, but we can also jump straight to frame N without decompressing the
+frames before it.
+
+See https://github.com/facebook/zstd/blob/dev/contrib/seekable_format/zstd_seekable_compression_format.md
+"""
+
+import dataclasses
+import io
+import itertools
+import struct
+from typing import BinaryIO, Iterator, List, Optional, Tuple
+
+import smart_open
+import zstandard
+
+from common_pile import utils
+
+SKIPPABLE_MAGIC = 0x184D2A5E
+SEEKABLE_MAGIC = 0x8F92EAB1
+# Number_Of_Frames (4), Seek_Table_Descriptor (1), Seekable_Magic_Number (4)
+FOOTER = struct.Struct("<IBI")
+# Compressed_Size (4), Decompressed_Size (4), we don't write the optional checksum.
+ENTRY = struct.Struct("<II")
+CHECKSUM_FLAG = 0x80
+DEFAULT_LEVEL = 3
+
+
+@dataclasses.dataclass
+class Frame:
+    """Where a frame lives in a seekable zstd file."""
+
+    offset: int
+    compressed_size: int
+    decompressed_size: int
+
+
+def compress_frame(data: bytes, level: int = DEFAULT_LEVEL) -> bytes:
+    """Compress `data` into a single frame, safe to call from worker threads."""
+    # Compressors aren't thread safe, so make a new one each call.
+    return zstandard.ZstdCompressor(level=level).compress(data)
+
+
+class SeekableZstdWriter:
+    """Write frames to `fileobj` and the seek table when it is closed."""
+
+    def __init__(self, fileobj: BinaryIO, level: int = DEFAULT_LEVEL):
+        self.fileobj = fileobj
+        self.level = level
+        self.entries: List[Tuple[int, int]] = []
+
+    def compress(self, data: bytes) -> bytes:
+        """Compress `data` into a frame for `write_compressed_frame`, thread safe."""
+        return compress_frame(data, self.level)
+
+    def write_frame(self, data: bytes):
+        """Compress `data` as a new frame."""
+        self.write_compressed_frame(compress_frame(data, self.level), len(data))
+
+    def write_compressed_frame(self, frame: bytes, decompressed_size: int):
+        """Append a frame that was already made with `compress_frame`."""
+        self.fileobj.write(frame)
+        self.entries.append((len(frame), decompressed_size))
+
+    def seek_table(self) -> bytes:
+        entries = b"".join(ENTRY.pack(*e) for e in self.entries)
+        footer = FOOTER.pack(len(self.entries), 0, SEEKABLE_MAGIC)
+        return (
+            struct.pack("<II", SKIPPABLE_MAGIC, len(entries) + len(footer))
+            + entries
+            + footer
+        )
+
+    def close(self):
+        self.fileobj.write(self.seek_table())
+        self.fileobj.close()
+
+
+def read_seek_table(f: BinaryIO) -> List[Frame]:
+    """Read the seek table from the end of a seekable zstd file.
+
+    Raises a ValueError if the file doesn't end with a seek table.
+    """
+    f.seek(-FOOTER.size, io.SEEK_END)
+    num_frames, descriptor, magic = FOOTER.unpack(f.read(FOOTER.size))
+    if magic != SEEKABLE_MAGIC:
+        raise ValueError("File does not end with a zstd seek table.")
+    entry_size = ENTRY.size + (4 if descriptor & CHECKSUM_FLAG else 0)
+    f.seek(-(FOOTER.size + num_frames * entry_size), io.SEEK_END)
+    table = f.read(num_frames * entry_size)
+    frames = []
+    offset = 0
+    for i in range(num_frames):
+        compressed, decompressed = ENTRY.unpack_from(table, i * entry_size)
+        frames.append(Frame(offset, compressed, decompressed))
+        offset += compressed
+    return frames
+
+
+def read_frames(
+    f: BinaryIO, frames: List[Frame], start: int = 0, stop: Optional[int] = None
+) -> Iterator[bytes]:
+    """Decompress frames [start, stop) without touching the ones before them."""
+    dctx = zstandard.ZstdDecompressor()
+    for frame in itertools.islice(frames, start, stop):
+        f.seek(frame.offset)
+        yield dctx.decompress(
+            f.read(frame.compressed_size), max_output_size=frame.decompressed_size
+        )
+
+
+def open_seekable(path: str, start: int = 0, stop: Optional[int] = None):
+    """Open (frames [start, stop) of) a .zst file as text.
+
+    Files without a seek table can only be read from the start.
+    """
+    f = smart_open.open(path, "rb", compression="disable")
+    try:
+        frames = read_seek_table(f)
+    except (ValueError, OSError):
+        if start or stop is not None:
+            f.close()
+            raise
+        f.seek(0)
+        # Dolma shards are many frames, without this the reader stops after one.
+        reader = zstandard.ZstdDecompressor().stream_reader(
+            f, read_across_frames=True, closefd=True
+        )
+        return io.TextIOWrapper(reader, encoding="utf-8")
+    return utils.open_chunks(f, read_frames(f, frames, start, stop))
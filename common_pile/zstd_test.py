@@ -0,0 +1,61 @@
+"""Tests for the seekable zstd format."""
+
+
+import pytest
+import zstandard
+
+from common_pile import zstd
+
+
+def write_frames(path, n=5):
+    chunks = [
+        "".join(f"frame {f} line {i}\n" for i in range(10)).encode("utf-8")
+        for f in range(n)
+    ]
+    writer = zstd.SeekableZstdWriter(open(path, "wb"))
+    for chunk in chunks:
+        writer.write_frame(chunk)
+    writer.close()
+    return chunks
+
+
+def test_seekable_files_are_valid_zstd(tmp_path):
+    path = tmp_path / "shard.jsonl.zst"
+    chunks = write_frames(path)
+    with open(path, "rb") as f:
+        reader = zstandard.ZstdDecompressor().stream_reader(f, read_across_frames=True)
+        assert reader.read() == b"".join(chunks)
+
+
+def test_read_seek_table(tmp_path):
+    path = tmp_path / "shard.jsonl.zst"
+    chunks = write_frames(path)
+    with open(path, "rb") as f:
+        frames = zstd.read_seek_table(f)
+        assert [fr.decompressed_size for fr in frames] == [len(c) for c in chunks]
+        assert frames[0].offset == 0
+        for a, b in zip(frames, frames[1:]):
+            assert b.offset == a.offset + a.compressed_size
+        assert list(zstd.read_frames(f, frames, 1, 3)) == chunks[1:3]
+
+
+def test_open_seekable_reads_a_range(tmp_path):
+    path = tmp_path / "shard.jsonl.zst"
+    chunks = write_frames(path)
+    with zstd.open_seekable(str(path)) as f:
+        assert f.read() == b"".join(chunks).decode("utf-8")
+    with zstd.open_seekable(str(path), 3) as f:
+        assert f.read() == b"".join(chunks[3:]).decode("utf-8")
+
+
+def test_open_seekable_without_a_seek_table(tmp_path):
+    path = tmp_path / "plain.jsonl.zst"
+    path.write_bytes(zstandard.ZstdCompressor().compress(b"a\nb\n"))
+    with open(path, "rb") as f:
+        with pytest.raises(ValueError):
+            zstd.read_seek_table(f)
+    with zstd.open_seekable(str(path)) as f:
+        assert f.read() == "a\nb\n"
+    # Without a seek table it can only be read from the start.
+    with pytest.raises(ValueError):
+        zstd.open_seekable(str(path), 1)
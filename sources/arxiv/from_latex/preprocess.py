@@ -61,6 +61,8 @@ l2t_db.add_context_category(
 
 
 class ArxivParallel(ShardParallelProcessor):
+    fields = ("id", "text")
+
     @classmethod
     def process_example(cls, example, **kwargs):
         latex = example["text"]
@@ -36,6 +36,12 @@ parser.add_argument(
 parser.add_argument(
     "--shard_size", type=int, default=1, help="Size, in GB, for each shard."
 )
+parser.add_argument(
+    "--compress_workers",
+    type=int,
+    default=0,
+    help="Number of background threads used to compress shards.",
+)
 
 
 def format_dolma(
@@ -75,7 +81,13 @@ def main(args):
             glob.iglob(os.path.join(args.data, "**", "*.txt"), recursive=True),
         ),
     )
-    to_dolma(content_pages, args.output_dir, args.filename, args.shard_size)
+    to_dolma(
+        content_pages,
+        args.output_dir,
+        args.filename,
+        args.shard_size,
+        compress_workers=args.compress_workers,
+    )
 
 
 if __name__ == "__main__":
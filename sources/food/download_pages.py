@@ -6,11 +6,8 @@ be skipped).
 """
 
 import argparse
-import functools
 import json
-import multiprocessing.dummy as mp
 import os
-import time
 
 from common_pile import logs, scrape
 
@@ -33,7 +30,7 @@ parser.add_argument(
     "--num_threads",
     type=int,
     default=64,
-    help="The number of threads to use when downloaded, mostly I/O bound so threads are ok.",
+    help="The number of pages to download at once.",
 )
 parser.add_argument(
     "--test_run",
@@ -44,30 +41,10 @@ parser.add_argument(
     "--wait",
     type=int,
     default=2,
-    help="Time to wait between requests on a single thread.",
+    help="Time to wait between requests on a single connection, used as a per-host rate limit.",
 )
 
 
-def download_page(page_info, output_dir, overwrite: bool = True, wait: int = 0):
-    """Download the page and save it to disk, unless it is already there."""
-    logger = logs.get_logger("food")
-    page_path = os.path.join(output_dir, page_info["filename"])
-
-    if not overwrite and os.path.exists(page_path):
-        logger.info(f"{page_path} already exists, not downloading {page_info['url']}")
-        return
-    try:
-        logger.info(f"Downloading {page_info['url']}")
-        page = scrape.get_page(page_info["url"])
-        with open(page_path, "wb") as f:
-            f.write(page.content)
-    except Exception as err:
-        logger.error(f"Failed to fetch {page_info['url']}: {err}")
-    if wait:
-        # time.sleep releases the GIL so we can use it in threads.
-        time.sleep(wait)
-
-
 def main(args):
     args.output_dir = (
         args.output_dir
@@ -85,21 +62,28 @@ def main(args):
         logger.info(f"Test Run, only downloading {args.test_run} pages.")
         page_index = page_index[: args.test_run]
 
-    # Download all the pages
-    # We don't process the results, just write them to disk, so we use map over
-    # imap to ensure it actually gets run.
-    # Downloading pages is mostly I/O bound so we use threads.
+    # Download all the pages, this is I/O bound so the requests are made
+    # concurrently with asyncio. Pages that already exist are skipped unless
+    # --overwrite is used, so this can be rerun to finish a download.
     logger.info(f"Saving pages to {args.output_dir}")
-    with mp.Pool(args.num_threads) as pool:
-        _ = pool.map(
-            functools.partial(
-                download_page,
-                output_dir=args.output_dir,
-                overwrite=args.overwrite,
-                wait=args.wait,
-            ),
-            page_index,
-        )
+    # Requests to each host are limited so that, on average, each connection
+    # waits `--wait` seconds between them.
+    scrape.set_rate_limit(
+        args.num_threads / args.wait if args.wait else None, burst=args.num_threads
+    )
+    counts = scrape.download_all(
+        (
+            (page["url"], os.path.join(args.output_dir, page["filename"]))
+            for page in page_index
+        ),
+        concurrency=args.num_threads,
+        per_host=args.num_threads,
+        overwrite=args.overwrite,
+    )
+    logger.info(
+        f"Downloaded {counts['downloaded']} pages, skipped {counts['skipped']} "
+        f"that already existed, {counts['failed']} failed."
+    )
 
 
 if __name__ == "__main__":
@@ -70,6 +70,8 @@ def strip_footer(text: str, footer=FOOTER) -> str:
 
 
 class ProjectGutenbergParallel(ShardParallelProcessor):
+    fields = ("text",)
+
     @classmethod
     def process_example(cls, example, **kwargs):
         example["text"] = strip_footer(strip_header(example["text"])).strip()
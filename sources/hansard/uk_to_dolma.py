@@ -25,6 +25,12 @@ parser.add_argument(
 parser.add_argument(
     "--shard_size", type=int, default=1, help="Size, in GB, for each shard."
 )
+parser.add_argument(
+    "--compress_workers",
+    type=int,
+    default=0,
+    help="Number of background threads used to compress shards.",
+)
 
 FILE_NAMES = {
     "debates": {"source": "commons-debates"},
@@ -147,6 +153,7 @@ def main(args):
         path=args.output_dir,
         shard_size=args.shard_size,
         filename="ukhansard.jsonl.gz",
+        compress_workers=args.compress_workers,
     )
 
 
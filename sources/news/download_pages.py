@@ -1,12 +1,9 @@
 """Download all the files from a site."""
 
 import argparse
-import functools
 import json
-import multiprocessing.dummy as mp
 import os
 import random
-import time
 
 import utils
 
@@ -42,42 +39,19 @@ parser.add_argument(
     "--wait",
     type=int,
     default=1,
-    help="Time to wait between requests.",
+    help="Time each worker waits between requests, used as a per-host rate limit.",
 )
 parser.add_argument(
     "--dry_run", action="store_true", help="Don't actually download anything."
 )
 
 
-def get_pages(
-    page_index, output_dir, overwrite: bool = True, wait: int = 0, dry_run: bool = False
-):
-    idx = page_index["idx"]
+def page_record(page_index, output_dir):
+    """The (url, path) to download a page to, None if it should be skipped."""
     url = page_index["url"]
-    filename = page_index["filename"]
-
-    page_file_path = os.path.join(output_dir, filename)
-    logger = logs.get_logger("news")
-
     if not utils.filter_url(url):
-        return
-
-    if not overwrite and os.path.exists(page_file_path):
-        logger.info(f"{page_file_path} already exists, not downloading.")
-        return
-
-    if dry_run:
-        logger.info(f"Not downloading {url} as --dry_run was set.")
-        return
-    try:
-        logger.info(f"Downloading {url}")
-        page = scrape.get_page(url)
-        with open(page_file_path, "wb") as fp:
-            fp.write(page.content)
-    except Exception as err:
-        logger.error(f"Failed to fetch {url}")
-    if wait:
-        time.sleep(wait)
+        return None
+    return url, os.path.join(output_dir, page_index["filename"])
 
 
 def main(args):
@@ -103,21 +77,29 @@ def main(args):
         random.shuffle(page_index)
         page_index = page_index[: args.test_run]
 
-    # Download all pages
-    # We don't process the results, they are just written to disk, so we
-    # use map to make sure it actually gets run.
+    records = [r for p in page_index if (r := page_record(p, args.output_dir))]
+    if args.dry_run:
+        logger.info(f"Not downloading {len(records)} pages as --dry_run was set.")
+        return
+
+    # Download all pages, the requests are I/O bound so they are made
+    # concurrently with asyncio. Existing pages are skipped unless --overwrite.
     logger.info(f"Saving pages to {args.output_dir}")
-    with mp.Pool(args.num_workers) as p:
-        _ = p.map(
-            functools.partial(
-                get_pages,
-                output_dir=args.output_dir,
-                overwrite=args.overwrite,
-                wait=args.wait,
-                dry_run=args.dry_run,
-            ),
-            page_index,
-        )
+    # Requests to each host are limited so that, on average, each connection
+    # waits `--wait` seconds between them.
+    scrape.set_rate_limit(
+        args.num_workers / args.wait if args.wait else None, burst=args.num_workers
+    )
+    counts = scrape.download_all(
+        records,
+        concurrency=args.num_workers,
+        per_host=args.num_workers,
+        overwrite=args.overwrite,
+    )
+    logger.info(
+        f"Downloaded {counts['downloaded']} pages, skipped {counts['skipped']} "
+        f"that already existed, {counts['failed']} failed."
+    )
 
 
 if __name__ == "__main__":
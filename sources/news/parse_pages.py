@@ -10,7 +10,7 @@ from datetime import datetime
 import utils
 from charset_normalizer import from_bytes
 
-from common_pile import licenses, logs
+from common_pile import licenses, logs, parallel
 from common_pile.write import to_dolma
 
 parser = argparse.ArgumentParser(description="Parse pages downloaded from a News Sites")
@@ -116,7 +116,8 @@ def main(args):
     )
 
     with mp.Pool(args.num_workers) as p:
-        page_data = p.imap(
+        # Bounded so pages don't pile up in memory when writing is the bottleneck.
+        page_data = parallel.bounded_imap(
             functools.partial(
                 parse_page,
                 input_dir=args.input_dir,
@@ -127,6 +128,8 @@ def main(args):
                 attrs=args.attrs,
             ),
             page_index,
+            pool=p,
+            processes=args.num_workers,
         )
         page_data = filter(lambda p: p is not None, page_data)
 
@@ -9,7 +9,6 @@ import multiprocessing.dummy as mp
 import os
 import re
 import textwrap
-import time
 from urllib.parse import urljoin
 
 import requests
@@ -25,7 +24,7 @@ from utils import (
     parse_date,
 )
 
-from common_pile import logs
+from common_pile import logs, scrape
 from common_pile.licenses import PermissiveLicenses
 from common_pile.utils import removeprefix
 from common_pile.write import to_dolma
@@ -186,13 +185,9 @@ def make_record(
     example_type: str,
     parse_example,
     source_name: str = SOURCE_NAME,
-    wait: int = 0,
 ):
     html = get_content(link)
     author, date, essay = parse_example(html)
-    # Add some delay so we don't hammer their servers.
-    if wait:
-        time.sleep(wait)
     return {
         "id": link.strip("/").split("/")[-1],
         "text": essay,
@@ -240,13 +235,17 @@ def main(args):
         links = itertools.islice(links, args.test_run)
     # Using threads is ok because I think we will be I/O bound most of the time.
     logger.info(f"Scraping and formatting examples using {args.num_threads} threds.")
+    # Add some delay so we don't hammer their servers, on average each thread
+    # makes a request every `--wait` seconds.
+    scrape.set_rate_limit(
+        args.num_threads / args.wait if args.wait else None, burst=args.num_threads
+    )
     with mp.Pool(args.num_threads) as pool:
         records = pool.imap(
             functools.partial(
                 make_record,
                 example_type=args.type,
                 parse_example=parse_example,
-                wait=args.wait,
             ),
             links,
         )
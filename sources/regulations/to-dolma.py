@@ -65,6 +65,12 @@ def parse_args():
         "--shard-size", type=int, default=1, help="Size, in GB, for each shard"
     )
     parser.add_argument("--workers", type=int, default=10, help="Number of threads")
+    parser.add_argument(
+        "--compress-workers",
+        type=int,
+        default=0,
+        help="Number of background threads used to compress shards",
+    )
     args = parser.parse_args()
     return args
 
@@ -119,7 +125,13 @@ def generate_records(args):
 
 
 def main(args):
-    to_dolma(generate_records(args), args.output_dir, args.filename, args.shard_size)
+    to_dolma(
+        generate_records(args),
+        args.output_dir,
+        args.filename,
+        args.shard_size,
+        compress_workers=args.compress_workers,
+    )
 
 
 if __name__ == "__main__":
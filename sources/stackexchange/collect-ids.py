@@ -2,35 +2,28 @@
 
 import argparse
 import glob
-import json
 
-import smart_open
-from tqdm import tqdm
-
-from common_pile import utils
+from common_pile import id_index, utils
 
 parser = argparse.ArgumentParser(description="Collect all ids from dolma files.")
 parser.add_argument("--input", required=True, help="The input dir.")
 parser.add_argument(
-    "--output", default="ids.json", help="Where to save the resulting file."
+    "--output", default="ids", help="The directory to save the id index in."
 )
 parser.add_argument(
     "--filename", default="*.jsonl.gz", help="The default file name glob pattern."
 )
+parser.add_argument("--processes", type=int, help="The number of workers to use.")
 
 
 def main():
     args = parser.parse_args()
 
-    ids = set()
-    for file_name in tqdm(glob.glob(utils.dolma_input(args.input, args.filename))):
-        with smart_open.open(file_name) as f:
-            for line in f:
-                if line:
-                    data = json.loads(line)
-                    ids.add(data["id"])
-    with open(args.output, "w") as wf:
-        json.dump(list(ids), wf)
+    id_index.build_id_index(
+        glob.glob(utils.dolma_input(args.input, args.filename)),
+        args.output,
+        processes=args.processes,
+    )
 
 
 if __name__ == "__main__":
@@ -8,28 +8,28 @@ import os
 import smart_open
 from tqdm import tqdm
 
-from common_pile import utils
-from common_pile.write import to_dolma
+from common_pile import id_index, utils
+from common_pile.write import batched, to_dolma
 
 parser = argparse.ArgumentParser(description="Collect all ids from dolma files.")
 parser.add_argument("--input", required=True, help="The input dir.")
 parser.add_argument("--old", required=True, help="The old dolma data.")
-parser.add_argument(
-    "--ids", default="ids.json", help="Where to save the resulting file."
-)
+parser.add_argument("--ids", default="ids", help="The id index made by collect-ids.py.")
 parser.add_argument(
     "--filename", default="*.jsonl.gz", help="The default file name glob pattern."
 )
 
 
-def find_missing_examples(input_dir, filename, ids):
+def find_missing_examples(input_dir, filename, ids, batch_size=10_000):
     for file_name in tqdm(glob.glob(utils.dolma_input(input_dir, filename))):
         with smart_open.open(file_name) as f:
-            for line in f:
-                if line:
-                    data = json.loads(line)
-                    if data["id"] not in ids:
-                        yield data
+            for lines in batched((line for line in f if line.strip()), batch_size):
+                # Check the whole batch against the index at once, only the
+                # missing examples are fully decoded.
+                found = ids.contains(id_index.line_hashes(lines))
+                for line, present in zip(lines, found):
+                    if not present:
+                        yield json.loads(line)
 
 
 def next_shard(input_dir, filename):
@@ -41,8 +41,7 @@ def next_shard(input_dir, filename):
 def main():
     args = parser.parse_args()
 
-    with open(args.ids) as f:
-        ids = set(json.load(f))
+    ids = id_index.IdIndex(args.ids)
 
     shard_idx = next_shard(args.input, args.filename)
 
@@ -2,7 +2,6 @@
 
 import argparse
 import collections
-import copyreg
 import dataclasses
 import datetime
 import functools
@@ -15,16 +14,14 @@ import re
 import shelve
 import urllib.parse
 from dataclasses import dataclass
-from io import StringIO
 from typing import Dict, List, Sequence
 
 import bs4
 import tqdm
-from lxml import etree
 from markdown_it import MarkdownIt
 
 import common_pile.xml as xml
-from common_pile import logs
+from common_pile import logs, parallel
 from common_pile.licenses import PermissiveLicenses
 from common_pile.write import to_dolma
 
@@ -72,30 +69,6 @@ LICENSES = {
 }
 
 
-def element_unpickler(data):
-    return etree.fromstring(data)
-
-
-def element_pickler(element):
-    data = etree.tostring(element)
-    return element_unpickler, (data,)
-
-
-def elementtree_unpickler(data):
-    data = StringIO(data)
-    return etree.parse(data)
-
-
-def elementtree_pickler(tree):
-    data = StringIO()
-    tree.write(data)
-    return elementtree_unpickler, (data.getvalue(),)
-
-
-copyreg.pickle(etree._Element, element_pickler, element_unpickler)
-copyreg.pickle(etree._ElementTree, elementtree_pickler, elementtree_unpickler)
-
-
 @dataclass
 class Post:
     text: str
@@ -129,10 +102,9 @@ def cache_path(path: str, cache_type: str):
     return f"cache-{os.path.basename(path)}-{cache_type}.p"
 
 
-def get_attr(xml_obj, key):
-    if key in xml_obj.attrib:
-        return xml_obj.attrib[key]
-    return None
+def get_attr(row, key):
+    """Get an attribute from a row, the attribute dict from `iterate_xml_rows`."""
+    return row.get(key)
 
 
 def get_html_text(html):
@@ -166,16 +138,28 @@ def process_user(user, site):
     }
 
 
+def process_row(elem, process, attributes=None):
+    """Read the attributes of a row and `process` them, run in the xml workers."""
+    return process(xml.row_values(elem, attributes))
+
+
+# Revisions include the full text of the post, only read what we need.
+REVISION_ATTRIBUTES = ("Id", "PostId")
+
+
 def process_revision(revision):
     """Extract post revision information from xml.
 
+    Args:
+      revision: The `REVISION_ATTRIBUTES` of the revision, as a tuple.
+
     Returns:
       The id of the post and the id of the user who made the post.
     """
-    user_id = get_attr(revision, "Id")
+    user_id, post_id = revision
     if user_id in (-1, None):
         return None, None
-    return get_attr(revision, "PostId"), user_id
+    return post_id, user_id
 
 
 def process_comment(comment):
@@ -379,11 +363,15 @@ def main(args):
                 author_display = pickle.load(f)
         else:
             logger.info("Building Lookup from user id -> user names")
-            user_xml = xml.iterate_xml(find_file(args.input, "Users.xml"), "row")
+            user_xml = xml.iterate_xml_rows(find_file(args.input, "Users.xml"))
             # This table is fairly small so we don't need to create a shelve for it.
             author_display = collections.defaultdict(set)
-            for user_id, user_names in pool.imap_unordered(
-                functools.partial(process_user, site=site), user_xml, chunksize=100
+            for user_id, user_names in parallel.bounded_imap(
+                functools.partial(process_user, site=site),
+                user_xml,
+                pool=pool,
+                ordered=False,
+                chunksize=100,
             ):
                 if user_id is None:
                     continue
@@ -400,9 +388,6 @@ def main(args):
                 post_authors = pickle.load(f)
         else:
             logger.info("Building Lookup from post id -> authors")
-            history_xml = xml.iterate_xml(
-                find_file(args.input, "PostHistory.xml"), "row"
-            )
             # It would probably be better/faster to use a database to store these
             # intermediate lookups instead of a shelve (which requires multiple
             # pickle serialization/deserialization) but I didn't want to implement
@@ -412,8 +397,17 @@ def main(args):
                 post_authors = shelve.open(os.path.join(args.output, "authors.shelve"))
             else:
                 post_authors = {}
-            for post_id, user_id in pool.imap_unordered(
-                process_revision, history_xml, chunksize=100
+            # The history is the largest file, so it is parsed in chunks on
+            # each core, not just processed there.
+            for post_id, user_id in xml.iterate_xml_parallel(
+                find_file(args.input, "PostHistory.xml"),
+                "row",
+                functools.partial(
+                    process_row,
+                    process=process_revision,
+                    attributes=REVISION_ATTRIBUTES,
+                ),
+                pool=pool,
             ):
                 if post_id is None:
                     continue
@@ -444,11 +438,15 @@ def main(args):
                 comments = {}
             if args.include_comments:
                 logger.info("Building Lookup from post/answer id -> comments")
-                comment_xml = xml.iterate_xml(
-                    find_file(args.input, "Comments.xml"), "row"
+                comment_xml = xml.iterate_xml_rows(
+                    find_file(args.input, "Comments.xml")
                 )
-                for post_id, user_id, text, date, license in pool.imap_unordered(
-                    process_comment, comment_xml, chunksize=100
+                for post_id, user_id, text, date, license in parallel.bounded_imap(
+                    process_comment,
+                    comment_xml,
+                    pool=pool,
+                    ordered=False,
+                    chunksize=100,
                 ):
                     if post_id is None:
                         continue
@@ -490,9 +488,12 @@ def main(args):
             # Questions are the "document" level for this dataset, therefore we do
             # no need to sort them.
             logger.info("Parsing Questions")
-            post_xml = xml.iterate_xml(find_file(args.input, "Posts.xml"), "row")
-            for post_id, text, date, license, accepted_id in pool.imap_unordered(
-                process_question, post_xml, chunksize=100
+            # Posts are parsed in chunks on each core, like the history.
+            for post_id, text, date, license, accepted_id in xml.iterate_xml_parallel(
+                find_file(args.input, "Posts.xml"),
+                "row",
+                functools.partial(process_row, process=process_question),
+                pool=pool,
             ):
                 if post_id is None:
                     continue
@@ -516,12 +517,21 @@ def main(args):
                     pickle.dump(parsed_dump, wf)
 
         logger.info("Parsing Answers")
-        # Reinitialize the iterator over the Posts as it was consumed when
-        # looking for questions. We do this as a second pass so we know that
-        # there will always be a question we can attach this answer to.
-        post_xml = xml.iterate_xml(find_file(args.input, "Posts.xml"), "row")
-        for question_id, answer_id, answer, date, score, license in pool.imap_unordered(
-            process_answer, post_xml, chunksize=100
+        # Read the Posts again, the first pass only looked for questions. We do
+        # this as a second pass so we know that there will always be a question
+        # we can attach this answer to.
+        for (
+            question_id,
+            answer_id,
+            answer,
+            date,
+            score,
+            license,
+        ) in xml.iterate_xml_parallel(
+            find_file(args.input, "Posts.xml"),
+            "row",
+            functools.partial(process_row, process=process_answer),
+            pool=pool,
         ):
             if question_id is None:
                 continue
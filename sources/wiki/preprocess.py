@@ -56,6 +56,13 @@ parser.add_argument(
     action="store_false",
     help="Disable shadow paging, for things like cloud storage.",
 )
+parser.add_argument(
+    "--checkpoint_interval",
+    type=int,
+    default=0,
+    help="Save progress every N documents so restarts resume mid-shard. "
+    "Requires shadow paging, 0 disables it.",
+)
 
 logs.configure_logging(level="INFO")
 
@@ -211,7 +218,12 @@ def main(args):
             metadata_prefix=meta_dir,
             num_processes=args.processes,
         )
-        processor(debug=args.debug, overwrite=args.overwrite, shadow=not args.no_shadow)
+        processor(
+            debug=args.debug,
+            overwrite=args.overwrite,
+            shadow=not args.no_shadow,
+            checkpoint_interval=args.checkpoint_interval,
+        )
 
 
 if __name__ == "__main__":
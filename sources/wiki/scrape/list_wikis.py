@@ -5,14 +5,13 @@ import functools
 import glob
 import multiprocessing.dummy as mp
 import os
-import time
 import urllib.parse
 from typing import List
 
 import tenacity
 from utils import enumerate_pages, get_page, get_soup, get_wiki_name, make_wiki_url
 
-from common_pile import logs
+from common_pile import logs, scrape
 
 parser = argparse.ArgumentParser(description="Convert a list of wikinames to urls.")
 parser.add_argument(
@@ -50,16 +49,13 @@ parser.add_argument(
 )
 
 
-def get_wiki_link(
-    page_title: str, wiki_url: str, url_prefix: str = "", wait: int = 0
-) -> str:
+def get_wiki_link(page_title: str, wiki_url: str, url_prefix: str = "") -> str:
     url = make_wiki_url(wiki_url, page_title, url_prefix)
     logger = logs.get_logger()
     logger.info(f"Finding external link to {url}")
     try:
         soup = get_soup(get_page(url))
         ext_url = get_external_link(soup)
-        time.sleep(wait)
         logger.info(f"Found {ext_url} as the external url for {url}")
         return ext_url
     except tenacity.RetryError:
@@ -91,13 +87,17 @@ def main(args):
     pages = pages[: args.test_pages]
 
     logger.info(f"Fetching wiki links with {args.num_threads} threads.")
+    # Requests to each host are limited so that, on average, each thread waits
+    # `--wait` seconds between them.
+    scrape.set_rate_limit(
+        args.num_threads / args.wait if args.wait else None, burst=args.num_threads
+    )
     with mp.Pool(args.num_threads) as pool:
         links = pool.map(
             functools.partial(
                 get_wiki_link,
                 wiki_url=args.wiki,
                 url_prefix=args.wiki_prefix,
-                wait=args.wait,
             ),
             pages,
         )
@@ -0,0 +1,192 @@
+"""Check that parsing a wiki history export keeps memory flat.
+
+Every page is read the way `to_dolma.py` does without `--last_author`, i.e.
+looking at the contributor of each revision, and the resident memory is logged
+as it goes. With `--tag revision` each revision is read on its own instead,
+which shows whether memory grows within a page with a long history. Without an
+`--export` a synthetic history export of about `--size` GB is written first.
+`--legacy` uses the old `iterate_xml` (start and end events, only clearing the
+root after each page) for comparison.
+"""
+
+import argparse
+import glob
+import json
+import os
+import resource
+import tempfile
+import time
+from xml.sax.saxutils import escape
+
+import lxml.etree as ET
+
+from common_pile import logs
+from common_pile.xml import iterate_xmls
+
+parser = argparse.ArgumentParser(
+    description="Measure memory use while iterating over a wiki xml export."
+)
+parser.add_argument("--export", help="A glob of exported xml files to read.")
+parser.add_argument(
+    "--size",
+    type=float,
+    default=2,
+    help="Size, in GB, of the synthetic export written when --export isn't given.",
+)
+parser.add_argument(
+    "--revisions",
+    type=int,
+    default=50,
+    help="Revisions per page in the synthetic export.",
+)
+parser.add_argument("--tmp_dir", help="Where to write the synthetic export.")
+parser.add_argument(
+    "--every", type=int, default=10_000, help="Log memory every this many pages."
+)
+parser.add_argument(
+    "--legacy",
+    action="store_true",
+    help="Use the old start/end event, root clearing, parser.",
+)
+parser.add_argument(
+    "--tag",
+    default="page",
+    choices=("page", "revision"),
+    help="What to iterate over, revisions show growth within long page histories.",
+)
+parser.add_argument("--output", help="Where to save the measurements as json.")
+
+HEADER = """<mediawiki xmlns="http://www.mediawiki.org/xml/export-0.11/" version="0.11">
+  <siteinfo>
+    <sitename>Benchmark</sitename>
+    <namespaces>
+{namespaces}
+    </namespaces>
+  </siteinfo>
+"""
+REVISION = """    <revision>
+      <id>{rid}</id>
+      <timestamp>2020-01-01T00:00:00Z</timestamp>
+      <contributor>
+        <username>user-{uid}</username>
+        <id>{uid}</id>
+      </contributor>
+      <text bytes="{size}" xml:space="preserve">{text}</text>
+    </revision>
+"""
+
+
+def write_export(path: str, size: int, revisions: int):
+    """Write a history export with `revisions` per page until it is `size` bytes."""
+    text = escape("Some <b>wiki</b> text & more. " * 32)
+    namespaces = "\n".join(
+        f'      <namespace key="{i}" case="first-letter">NS{i}</namespace>'
+        for i in range(1000)
+    )
+    with open(path, "w") as wf:
+        wf.write(HEADER.format(namespaces=namespaces))
+        page = 0
+        while wf.tell() < size:
+            wf.write(f"  <page>\n    <title>Page {page}</title>\n")
+            wf.write(f"    <ns>0</ns>\n    <id>{page}</id>\n")
+            for r in range(revisions):
+                wf.write(
+                    REVISION.format(
+                        rid=page * revisions + r, uid=r, size=len(text), text=text
+                    )
+                )
+            wf.write("  </page>\n")
+            page += 1
+        wf.write("</mediawiki>\n")
+
+
+def legacy_iterate_xml(path: str, tag: str):
+    """`common_pile.xml.iterate_xml` before it deleted preceding siblings."""
+    context = iter(ET.iterparse(path, events=("start", "end"), huge_tree=True))
+    _, root = next(context)
+    for event, elem in context:
+        if event == "end" and ET.QName(elem.tag).localname == tag:
+            yield elem
+            root.clear()
+
+
+def rss() -> int:
+    """The current resident memory of this process in bytes, the peak off Linux."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def contributors(elem) -> set:
+    """The contributors of every revision, like `to_dolma.format_dolma`."""
+    found = set()
+    if elem.tag.endswith("revision"):
+        revisions = [elem]
+    else:
+        revisions = [r for r in elem if r.tag.endswith("revision")]
+    for revision in revisions:
+        contribs = [c for c in revision if c.tag.endswith("contributor")]
+        names = [u.text for c in contribs for u in c if u.tag.endswith("username")]
+        uid = [u.text for c in contribs for u in c if u.tag.endswith("id")]
+        found.update(zip(names, uid))
+    return found
+
+
+def main(args):
+    logger = logs.get_logger()
+    with tempfile.TemporaryDirectory(dir=args.tmp_dir) as tmp_dir:
+        if args.export:
+            paths = sorted(glob.glob(args.export))
+        else:
+            paths = [os.path.join(tmp_dir, "export.xml")]
+            logger.info("Writing a %.1fGB export to %s", args.size, paths[0])
+            write_export(paths[0], int(args.size * 1024**3), args.revisions)
+        total = sum(os.path.getsize(p) for p in paths)
+        if args.legacy:
+            elems = (e for path in paths for e in legacy_iterate_xml(path, args.tag))
+        else:
+            elems = iterate_xmls(paths, tag=args.tag)
+        samples = []
+        i = 0
+        start = time.perf_counter()
+        for i, elem in enumerate(elems, 1):
+            contributors(elem)
+            if i % args.every == 0:
+                samples.append((i, rss()))
+                logger.info(
+                    "%d %ss, rss: %.1fMB", i, args.tag, samples[-1][1] / 1024**2
+                )
+        elapsed = time.perf_counter() - start
+    results = {
+        "parser": "legacy" if args.legacy else "iterate_xml",
+        "tag": args.tag,
+        "bytes": total,
+        "elements": i,
+        "seconds": elapsed,
+        "peak_rss": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+        "samples": samples,
+    }
+    if samples:
+        # Memory should be flat after the start, so compare the first sample
+        # to the last.
+        results["rss_growth"] = samples[-1][1] - samples[0][1]
+    logger.info(
+        "Read %d %ss (%.1fGB) in %.0fs, peak rss %.1fMB, growth %.1fMB",
+        i,
+        args.tag,
+        total / 1024**3,
+        elapsed,
+        results["peak_rss"] / 1024**2,
+        results.get("rss_growth", 0) / 1024**2,
+    )
+    if args.output:
+        with open(args.output, "w") as wf:
+            json.dump(results, wf, indent=2)
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    logs.configure_logging()
+    main(args)
@@ -69,6 +69,8 @@ class CaptureMatches:
 
 
 class RegexRemoveHTMLParallel(ShardParallelProcessor):
+    fields = ("id", "source", "text")
+
     @classmethod
     def process_example(cls, example, **kwargs):
         logger = cls.get_logger()
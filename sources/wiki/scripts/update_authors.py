@@ -46,16 +46,20 @@ logs.configure_logging()
 
 
 class AuthorRenameParallel(ShardParallelProcessor):
+    fields = ("metadata.authors",)
+
     @classmethod
     def process_example(cls, example, **kwargs):
-        authors = example["metadata"].get("authors", [])
+        # Only the authors are decoded, so documents without them are empty.
+        metadata = example.setdefault("metadata", {})
+        authors = metadata.get("authors", [])
         new_authors = []
         for author in authors:
             if not isinstance(author, list):
                 author = [author, ""]
             author = [str(a) for a in author]
             new_authors.append(author)
-        example["metadata"]["authors"] = new_authors
+        metadata["authors"] = new_authors
         return example
 
 
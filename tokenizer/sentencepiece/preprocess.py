@@ -1,7 +1,6 @@
 #!/usr/bin/env python3
 
 import argparse
-import json
 import logging
 import multiprocessing as mp
 import os
@@ -9,9 +8,9 @@ import re
 from queue import Queue
 
 import smart_open
-from dolma.core.parallel import BaseParallelProcessor
 
-from common_pile import logs, utils
+from common_pile import codec, logs, utils
+from common_pile.parallel import ParallelProcessor
 
 parser = argparse.ArgumentParser(
     description="Preprocess Dolma Data for SentencePiece tokenizer training."
@@ -49,7 +48,7 @@ def create_shadow(path):
     return os.path.join(h, f"shadow.{t}")
 
 
-class SentencePieceProcessor(BaseParallelProcessor):
+class SentencePieceProcessor(ParallelProcessor):
     @classmethod
     def increment_progressbar(
         cls,
@@ -60,10 +59,6 @@ class SentencePieceProcessor(BaseParallelProcessor):
     ):
         return super().increment_progressbar(queue, shards=shards, documents=documents)
 
-    @classmethod
-    def get_logger(cls):
-        return logs.get_logger()
-
     @classmethod
     def process_single(
         cls,
@@ -96,8 +91,8 @@ class SentencePieceProcessor(BaseParallelProcessor):
                     with logger(line=i):
                         try:
                             try:
-                                data = json.loads(line)
-                            except json.JSONDecodeError as e:
+                                data = codec.loads(line)
+                            except codec.JSONDecodeError as e:
                                 logger.warning(
                                     "Failed to parse JSON from `%s...`",
                                     line[:80],
@@ -121,8 +116,6 @@ class SentencePieceProcessor(BaseParallelProcessor):
                                 cls.increment_progressbar(
                                     queue, documents=document_count
                                 )
-                                if queue.qsize() >= mp.cpu_count():
-                                    update_interval *= 2
                                 document_count = 0
                         except Exception as e:
                             e.add_note(
@@ -3,13 +3,12 @@
 import argparse
 import dataclasses
 import glob
-import json
 from typing import Iterator, List
 
 import datasets
 import smart_open
 
-from common_pile import logs, utils
+from common_pile import codec, logs, utils
 
 parser = argparse.ArgumentParser(description="Train a common-pile tokenizer.")
 parser.add_argument(
@@ -123,7 +122,7 @@ def load_jsonl_data(pattern: str, batch_size: int, **kwargs) -> Iterator[List[st
         with smart_open.open(file_path) as f:
             for line in f:
                 if line:
-                    batch.append(json.loads(line)["text"])
+                    batch.append(codec.loads(line)["text"])
                 if len(batch) == batch_size:
                     yield batch
                     batch = []